@@ -2,22 +2,36 @@
 import streamlit as st  # För att bygga webbapplikationen
 from dotenv import load_dotenv # För att ladda miljövariabler från en .env-fil
 import os # För operativsysteminteraktioner, t.ex. filhantering
-import requests # För att göra HTTP-anrop (används här för Lottie-animationen)
+import json # För att läsa Lottie-animationen från disk
+import time # För att mäta tid till första token vid strömmade svar
+import hashlib # För att känna igen en uppladdad fil på dess innehåll
 
 # Importerar anpassade funktioner för RAGAS (Retrieval Augmented Generation Assessment) och LLM (Large Language Model)
-from utils.evaluation_utils import ragas_evaluate # Funktion för att utvärdera RAG-systemet
+from utils.evaluation_queue import get_evaluation_queue # Kö som utvärderar RAG-svar i bakgrunden
 from core.gpt_logic import (
-    search_relevant_chunks,    # Funktion för att hitta relevanta textdelar (chunks)
-    generate_gpt_answer,       # Funktion för att generera svar med GPT
-    chunk_text,                # Funktion för att dela upp text i mindre delar
-    full_rapportanalys         # Funktion för att göra en fullständig rapportanalys
+    search_context,            # Funktion för att hitta relevanta textdelar (chunks) och bygga kontexten
+    stream_gpt_answer,         # Funktion för att strömma svar från GPT token för token
+    stream_full_rapportanalys, # Funktion för att strömma en fullständig rapportanalys
+    detect_language,           # Funktion för att avgöra om en text är på svenska eller engelska
+    ANSWER_PROMPT_VERSION      # Version av RAG-prompten (ingår i svarscachens nyckel)
 )
+from core.retrieval import DocumentIndex # Förnormaliserad embedding-matris för snabb sökning
+from core.key_figures import format_facts # Nyckeltal (värde, enhet, period) extraherade vid inläsning
 from core.embedding_utils import get_embedding # Funktion för att skapa text-embeddings
+from core.ingestion import CHUNKER_PARAMS, EmptyDocumentError, ingest_document # Chunkning, embedding och cachning (inkrementellt mot tidigare versioner)
 
 # Importerar anpassade funktioner för fil- och datahantering
-from core.file_processing import extract_text_from_file # Funktion för att extrahera text från olika filtyper
-from utils.cache_utils import get_embedding_cache_name, save_embeddings, load_embeddings_if_exists # Funktioner för att hantera cachning av embeddings
-from utils.ocr_utils import extract_text_from_image_or_pdf # Funktion för att extrahera text från bilder eller PDFer med OCR
+from core.file_processing import extract_text_from_file, iter_document_text # Textextraktion (PDF:er sida för sida)
+from utils.cache_utils import ( # Funktioner för att hantera cachning av embeddings
+    get_embedding_cache_name,  # Sökväg till gamla pickle-cachen (för migrering)
+    get_document_cache_dir,    # Katalog för dokumentets binära, memmappade cache
+    open_document_cache,       # Öppnar en binär cache utan att läsa in vektorerna
+    migrate_pickle_cache,      # Konverterar en gammal pickle-cache till binärt format
+    get_document_fingerprint   # Innehållsbaserat id för dokumentet (nyckel i svarscachen)
+)
+from utils.answer_cache import get_answer_cache # Cache för svar på (nästan) samma fråga mot samma rapport
+from utils.ocr_utils import ocr_image # Funktion för OCR av en bild i minnet (modellen laddas först vid behov)
+from utils.metrics import metrics, span # Tider per steg, tokens och cacheträffar för debugpanelen
 from utils.pdf_utils import answer_to_pdf # Funktion för att konvertera text till PDF
 from utils.file_utils import save_output_file, save_uploaded_file # Funktioner för att spara filer
 from services.html_downloader import fetch_html_text # Funktion för att hämta textinnehåll från en HTML-länk
@@ -26,6 +40,149 @@ from services.html_downloader import fetch_html_text # Funktion för att hämta
 from streamlit_lottie import st_lottie # Komponent för att visa Lottie-animationer i Streamlit
 import traceback # För att få detaljerad felinformation vid undantag
 
+def timed_stream(chunks, timings: dict):
+    """
+    Skickar vidare textbitarna från en ström och sparar tiden till första token i 'timings'.
+    """
+    start = time.perf_counter()
+    for chunk in chunks:
+        if "ttft" not in timings:
+            timings["ttft"] = time.perf_counter() - start
+        yield chunk
+    timings["total"] = time.perf_counter() - start
+
+# Lottie-animationen ligger i repot och läses från disk (en gång per process)
+LOTTIE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1GRWuk0lXN.json")
+
+@st.cache_resource
+def load_lottie_animation(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def render_ragas_result(ragas_result: dict):
+    """
+    Visar RAGAS-resultatet (Faithfulness och Answer Relevancy) eller felet.
+    """
+    if "error" in ragas_result:
+        st.info(f"(RAGAS) Kunde inte utvärdera svaret: {ragas_result['error']}")
+        return
+    # Hämtar RAGAS-metrics: Faithfulness och Answer Relevancy
+    faith_score = ragas_result.get('faithfulness')
+    ans_rel_score = ragas_result.get('answer_relevancy')
+    # Visar RAGAS-metrics i två kolumner
+    col_ragas1, col_ragas2 = st.columns(2)
+    with col_ragas1:
+        st.metric("Faithfulness", f"{faith_score:.2f}" if faith_score is not None else "N/A",
+                  help="Mäter hur väl AI:ns svar grundar sig på den information som hämtats från rapporten (0-1). Högre är bättre.")
+    with col_ragas2:
+        st.metric("Answer Relevancy", f"{ans_rel_score:.2f}" if ans_rel_score is not None else "N/A",
+                  help="Mäter hur relevant AI:ns svar är på den ställda frågan (0-1). Högre är bättre.")
+
+def fetch_ragas_result(evaluation_key: str, answer_key: str = None):
+    """
+    Hämtar RAGAS-resultatet, i första hand ur session state; ett färdigt resultat sparas
+    där (och lyckade utvärderingar med det cachade svaret), så att kön bara frågas tills det finns.
+    """
+    results = st.session_state.setdefault("ragas_results", {})
+    if evaluation_key in results:
+        return results[evaluation_key]
+    ragas_result = get_evaluation_queue().get(evaluation_key)
+    if ragas_result is None:
+        return None
+    results[evaluation_key] = ragas_result
+    if answer_key and "error" not in ragas_result:
+        get_answer_cache().set_evaluation(answer_key, ragas_result)
+    return ragas_result
+
+def show_ragas_result_when_ready(evaluation_key: str, answer_key: str = None):
+    """
+    Visar RAGAS-resultatet direkt om det redan finns; annars visas det av ett fragment
+    som frågar bakgrundskön varannan sekund, utan att resten av sidan körs om.
+    """
+    ragas_result = fetch_ragas_result(evaluation_key, answer_key)
+    if ragas_result is not None:
+        render_ragas_result(ragas_result)
+    else:
+        poll_ragas_result(evaluation_key, answer_key)
+
+@st.fragment(run_every=2)
+def poll_ragas_result(evaluation_key: str, answer_key: str = None):
+    """
+    Fragmentets timer lever tills sidan körs om i sin helhet (då visas resultatet utan
+    fragment, se show_ragas_result_when_ready). När resultatet kommit läses det därför ur
+    session state vid varje omkörning, i stället för ur kön.
+    """
+    ragas_result = fetch_ragas_result(evaluation_key, answer_key)
+    if ragas_result is None:
+        st.caption("⏳ Svaret utvärderas i bakgrunden...")
+        return
+    render_ragas_result(ragas_result)
+
+def render_debug_panel():
+    """
+    Visar processens mätvärden: tid per steg, tokens, cacheträffar, omförsök och de senaste spannen.
+    Mätvärdena gäller hela Streamlit-processen, inte bara den egna sessionen.
+    """
+    snapshot = metrics.snapshot()
+    counters = snapshot["counters"]
+    with st.expander("🛠️ Debug: prestanda och förbrukning"):
+        stages = [
+            {
+                "Steg": " ".join([labels["stage"]] + [f"{k}={v}" for k, v in sorted(labels.items()) if k != "stage"]),
+                "Antal": count,
+                "Total (s)": round(total, 3),
+                "Snitt (s)": round(total / count, 3) if count else 0.0,
+            }
+            for labels, count, total in snapshot["histograms"].get("stage_duration_seconds", [])
+        ]
+        st.markdown("**Tid per steg**")
+        st.dataframe(sorted(stages, key=lambda row: -row["Total (s)"]), use_container_width=True)
+
+        tokens = [
+            {"Steg": labels.get("stage"), "Modell": labels.get("model"), "Typ": labels.get("kind"), "Tokens": int(value)}
+            for labels, value in counters.get("openai_tokens_total", [])
+        ]
+        if tokens:
+            st.markdown("**Tokens (OpenAI usage)**")
+            st.dataframe(tokens, use_container_width=True)
+
+        cache_rows = {}
+        for labels, value in counters.get("cache_requests_total", []):
+            row = cache_rows.setdefault(labels["cache"], {"Cache": labels["cache"], "hit": 0, "miss": 0, "semantic_hit": 0})
+            row[labels["result"]] = int(value)
+        for row in cache_rows.values():
+            lookups = row["hit"] + row["semantic_hit"] + row["miss"]
+            row["Träffgrad"] = f"{(row['hit'] + row['semantic_hit']) / lookups:.0%}" if lookups else "-"
+        if cache_rows:
+            st.markdown("**Cacher**")
+            st.dataframe(list(cache_rows.values()), use_container_width=True)
+
+        retries = sum(value for _, value in counters.get("openai_retries_total", []))
+        statuses = ", ".join(
+            f"{labels['status']}: {int(value)}"
+            for labels, value in sorted(counters.get("openai_http_responses_total", []), key=lambda item: item[0]["status"])
+        )
+        st.caption(f"OpenAI-svar per status: {statuses or '-'} · omförsök: {int(retries)}")
+
+        recent = snapshot["recent_spans"][-20:]
+        if recent:
+            st.markdown("**Senaste spannen**")
+            st.dataframe(
+                [{**{k: v for k, v in item.items() if k != "at"}, "seconds": round(item["seconds"], 3)} for item in reversed(recent)],
+                use_container_width=True
+            )
+
+@st.cache_data(ttl=3600, show_spinner="🌐 Hämtar rapporten...")
+def load_html_report(url: str) -> str:
+    # Sidan revalideras mot webbservern (ETag/Last-Modified) först när posten har gått ut
+    return fetch_html_text(url)
+
+# Debugpanelen visas med ?debug=1 i adressen eller APP_DEBUG_PANEL=1
+DEBUG_PANEL = os.getenv("APP_DEBUG_PANEL") == "1"
+
+# Modell som används för frågebaserade svar (ingår i svarscachens nyckel)
+RAG_MODEL = "gpt-4o"
+
 # --- Skapa nödvändiga datamappar ---
 # Ser till att kataloger för lagring av embeddings, output-filer och uppladdade filer existerar.
 # exist_ok=True förhindrar fel om mapparna redan finns.
@@ -42,19 +199,15 @@ st.set_page_config(page_title="🤖 AI Rapportanalys", layout="wide")
 # Skapar kolumner för att centrera Lottie-animationen
 col1_lottie, col2_lottie, col3_lottie = st.columns([3, 4, 3])
 with col2_lottie:
-    # URL till Lottie-animationen
-    lottie_url = "https://raw.githubusercontent.com/siffror/ai-rapportanalys/main/1GRWuk0lXN.json"
     try:
-        # Försöker hämta Lottie-animationen från URL:en med en timeout
-        r = requests.get(lottie_url, timeout=10)
-        r.raise_for_status() # Genererar ett undantag om HTTP-anropet misslyckades (t.ex. 404, 500)
-        lottie_json = r.json() # Tolkar svaret som JSON
+        # Läser Lottie-animationen från disk (cachad mellan omkörningar)
+        lottie_json = load_lottie_animation(LOTTIE_PATH)
         # Visar Lottie-animationen i Streamlit-appen
         st_lottie(lottie_json, speed=1, width=240, height=240, loop=True, quality="high", key="ai_logo")
-    except requests.exceptions.RequestException as e_req:
-        # Visar en varning om animationen inte kunde laddas p.g.a. nätverksfel
-        st.warning(f"Kunde inte ladda AI-animationen (nätverksfel): {e_req}")
-    except requests.exceptions.JSONDecodeError as e_json_lottie:
+    except OSError as e_file:
+        # Visar en varning om animationsfilen saknas eller inte kan läsas
+        st.warning(f"Kunde inte ladda AI-animationen: {e_file}")
+    except json.JSONDecodeError as e_json_lottie:
         # Visar en varning om animationen inte kunde tolkas som JSON
         st.warning(f"Kunde inte tolka AI-animationen (JSON-fel): {e_json_lottie}")
 
@@ -74,35 +227,73 @@ with input_col1:
     html_link = st.text_input("🌐 Klistra in HTML-länk till rapport (valfritt):", key="html_link_input")
     # Filuppladdare för olika filtyper
     uploaded_file = st.file_uploader("📎 Eller ladda upp rapportfil:",
-                                     type=["pdf", "txt", "html", "docx", "md", "png", "jpg", "jpeg"], key="file_uploader_input")
+                                     type=["pdf", "txt", "html", "htm", "docx", "md", "xlsx", "xlsm", "xls", "png", "jpg", "jpeg"], key="file_uploader_input")
 with input_col2:
     # Textområde för manuell inmatning av text
     manual_text_input = st.text_area("✏️ Eller klistra in text manuellt här (valfritt):", height=205, key="manual_text_input_area")
 
 # Initierar variabler för text som ska analyseras
 preview_text, ocr_extracted_text = "", ""
+# En uppladdad PDF som ännu inte extraherats: (bytes, filnamn, innehållshash). Den strömmas
+# sida för sida direkt in i indexeringen när en fråga ställs, i stället för att läsas i förväg.
+pending_upload = None
+upload_digest = None
 
 # Logik för att hantera den uppladdade filen
 if uploaded_file:
     # Kontrollerar om filen är en bild (för OCR)
     if uploaded_file.name.endswith((".png", ".jpg", ".jpeg")):
-        # Extraherar text från bilden med OCR
-        ocr_extracted_text, _ = extract_text_from_image_or_pdf(uploaded_file)
+        # Extraherar text från bilden med OCR, direkt från bytes i minnet
+        with st.spinner("🖼️ Läser bilden med OCR..."), span("ocr", kind="image"):
+            ocr_extracted_text = ocr_image(uploaded_file.getvalue())
         if ocr_extracted_text:
             # Visar en förhandsgranskning av den OCR-extraherade texten (max 2000 tecken)
             st.expander("🖼️ OCR-utläst text (förhandsvisning)").text(ocr_extracted_text[:2000])
         else:
             st.warning("Kunde inte extrahera text med OCR från bilden.")
     else:
-        # Extraherar text från andra filtyper (PDF, TXT, DOCX etc.)
-        preview_text = extract_text_from_file(uploaded_file)
+        # Texten sparas per uppladdning, så att filen bara extraheras en gång
+        upload_digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+        upload_texts = st.session_state.setdefault("upload_texts", {})
+        preview_text = upload_texts.get(upload_digest, "")
+        if not preview_text and uploaded_file.name.lower().endswith(".pdf"):
+            pending_upload = (uploaded_file.getvalue(), uploaded_file.name, upload_digest)
+            st.info("📄 PDF:en läses sida för sida när den analyseras eller indexeras.")
+        elif not preview_text:
+            # Extraherar text från andra filtyper (TXT, HTML, Excel etc.)
+            preview_text = extract_text_from_file(uploaded_file)
+            upload_texts[upload_digest] = preview_text
 elif html_link:
-    # Hämtar textinnehåll från den angivna HTML-länken
-    preview_text = fetch_html_text(html_link)
+    # Hämtar textinnehåll från den angivna HTML-länken (en gång per länk, inte vid varje omkörning)
+    try:
+        preview_text = load_html_report(html_link)
+    except Exception as e_html:
+        st.error(f"Kunde inte hämta länken: {e_html}")
 
 # Bestämmer vilken text som ska användas för analysen baserat på användarens input
 # Prioriteringsordning: manuell inmatning, sedan text från uppladdad fil/HTML-länk (inklusive OCR)
 text_to_analyze = manual_text_input or preview_text or ocr_extracted_text
+if manual_text_input:
+    pending_upload = None
+
+def report_scanned_pages(count: int, ocr: bool):
+    """
+    Visar förloppet för inskannade sidor medan en PDF extraheras (se core.file_processing.iter_pdf_text).
+    """
+    if ocr:
+        st.toast(f"🖼️ Kör OCR på {count} inskannade sidor...")
+    else:
+        st.warning(f"⚠️ {count} sidor saknar textlager men PyMuPDF saknas för OCR.")
+
+def extract_pending_upload() -> str:
+    """
+    Extraherar hela den väntande PDF:en (för den fullständiga analysen) och sparar texten.
+    """
+    data, name, digest = pending_upload
+    with st.spinner("📄 Läser PDF:en..."):
+        text = "".join(iter_document_text(data, name, report_scanned_pages))
+    st.session_state["upload_texts"][digest] = text
+    return text
 
 # Visar en förhandsgranskning av texten som kommer att analyseras
 if text_to_analyze:
@@ -120,17 +311,21 @@ tab_full_analysis, tab_rag_analysis = st.tabs(["🔍 Fullständig Rapportanalys"
 with tab_full_analysis:
     # Knapp för att starta den fullständiga analysen
     if st.button("Starta fullständig analys", use_container_width=True, key="btn_full_analysis_tab_main"):
+        if pending_upload:
+            text_to_analyze = extract_pending_upload()
         # Kontrollerar om det finns tillräckligt med text för analys
         if text_to_analyze and len(text_to_analyze.strip()) > 20:
             # Visar en spinner medan GPT analyserar rapporten
+            # Långa rapporter analyseras automatiskt i map-reduce-läge (avsnitt sammanfattas parallellt)
             with st.spinner("📊 GPT analyserar hela rapporten..."):
-                # Anropar funktionen för fullständig rapportanalys
-                ai_report_content = full_rapportanalys(text_to_analyze)
-                # Sparar resultatet i session state för att kunna återanvändas (t.ex. för nedladdning)
-                st.session_state['ai_report_content'] = ai_report_content
-                # Visar rubrik och den genererade AI-analysen
+                # Visar rubrik och strömmar AI-analysen allteftersom den genereras
                 st.markdown("### 🧾 Fullständig AI-analys:")
-                st.markdown(st.session_state['ai_report_content'])
+                timings = {}
+                ai_report_content = st.write_stream(timed_stream(stream_full_rapportanalys(text_to_analyze), timings))
+                # Sparar hela texten i session state för att kunna återanvändas (t.ex. för nedladdning)
+                st.session_state['ai_report_content'] = ai_report_content
+                if "ttft" in timings:
+                    st.caption(f"⏱️ Första token efter {timings['ttft']:.1f} s, klart efter {timings['total']:.1f} s")
         else:
             # Visar ett felmeddelande om ingen text finns eller om texten är för kort
             st.error("Ingen text tillgänglig för fullständig analys, eller texten är för kort.")
@@ -152,61 +347,109 @@ with tab_rag_analysis:
         st.session_state.user_question_rag_tab = "Vilken utdelning per aktie föreslås för nästa år?"
     # Textinmatningsfält för användarens specifika fråga
     st.text_input("Din specifika fråga om rapporten:", key="user_question_rag_tab")
+    # Låter användaren tvinga fram ett nytt svar i stället för ett cachat
+    bypass_answer_cache = st.checkbox("Generera nytt svar (hoppa över svarscachen)", value=False, key="bypass_answer_cache")
 
     # Knapp för att starta den frågebaserade analysen
     if st.button("Starta frågebaserad analys", key="btn_rag_analysis_tab_main", use_container_width=True):
-        # Kontrollerar om det finns tillräckligt med text för analys
-        if text_to_analyze and len(text_to_analyze.strip()) > 20:
+        # Kontrollerar om det finns tillräckligt med text för analys (en väntande PDF kontrolleras vid indexeringen)
+        if pending_upload or (text_to_analyze and len(text_to_analyze.strip()) > 20):
             # Visar en spinner medan GPT söker och analyserar
             with st.spinner("🤖 GPT söker och analyserar baserat på din fråga..."):
                 # Skapar en unik identifierare för källan (används för cachning av embeddings)
-                source_id = (html_link or (uploaded_file.name if uploaded_file else text_to_analyze[:50])) + "_embeddings_v5"
-                # Hämtar namnet på cache-filen för embeddings
-                cache_file = get_embedding_cache_name(source_id)
-                # Försöker ladda förberäknade embeddings från cache
-                embedded_chunks = load_embeddings_if_exists(cache_file)
+                # En uppladdad fil känns igen på sitt innehåll, även innan en PDF hunnit extraheras
+                source_id = (html_link or (uploaded_file.name if uploaded_file else text_to_analyze[:50])) + (
+                    f":{upload_digest}" if upload_digest else ""
+                ) + "_embeddings_v5"
+                # Hämtar katalogen för dokumentets embedding-cache
+                cache_dir = get_document_cache_dir(source_id)
+                # Försöker öppna förberäknade embeddings från cache (memmap, vektorerna läses inte in);
+                # en cache från en annan chunker räknas som saknad och indexeras om inkrementellt nedan
+                cached_doc = open_document_cache(cache_dir, CHUNKER_PARAMS)
+                if cached_doc is None and not os.path.exists(cache_dir):
+                    # Migrerar en eventuell gammal pickle-cache till det binära formatet
+                    cached_doc = migrate_pickle_cache(get_embedding_cache_name(source_id), cache_dir)
+                # Innehållsbaserat id för dokumentet (nyckel i svarscachen och kontroll av cachen)
+                doc_fingerprint = get_document_fingerprint(text_to_analyze) if not pending_upload else None
+                if cached_doc is not None and doc_fingerprint and cached_doc.header.get("fingerprint") not in (None, doc_fingerprint):
+                    # Samma källa men ny text (t.ex. en rättad rapport): indexeras om inkrementellt nedan
+                    cached_doc = None
 
                 # Om inga cachade embeddings hittades
-                if not embedded_chunks:
+                if cached_doc is None:
                     st.info("Skapar och cachar text-embeddings (kan ta en stund för stora dokument)...")
-                    # Delar upp texten i mindre "chunks"
-                    chunks = chunk_text(text_to_analyze)
-                    embedded_chunks = [] # Lista för att lagra textdelar och deras embeddings
-                    if chunks:
-                        # Visar en progress bar för bearbetningen av textblock
-                        progress_bar = st.progress(0, text="Bearbetar textblock...")
-                        for i, chunk_content in enumerate(chunks, 1):
-                            try:
-                                # Skapar embedding för varje textblock
-                                embedding = get_embedding(chunk_content)
-                                embedded_chunks.append({"text": chunk_content, "embedding": embedding})
-                                # Uppdaterar progress bar
-                                progress_bar.progress(i / len(chunks), text=f"Bearbetar textblock {i}/{len(chunks)}")
-                            except Exception as e_emb:
-                                # Hanterar fel som kan uppstå vid skapande av embeddings
-                                st.error(f"❌ Fel vid embedding av chunk {i}: {e_emb}")
-                                st.stop() # Avbryter körningen vid fel
-                        # Sparar de nyskapade embeddings till cache-filen
-                        save_embeddings(cache_file, embedded_chunks)
-                        progress_bar.empty() # Tar bort progress bar
-                        st.success("Embeddings skapade och cachade!")
-                    else:
+                    # Visar en progress bar för bearbetningen av textblock
+                    progress_bar = st.progress(0, text="Bearbetar textblock...")
+
+                    def update_progress(done, total):
+                        # Uppdaterar progress bar när en batch är klar
+                        progress_bar.progress(done / total, text=f"Bearbetar textblock {done}/{total}")
+
+                    try:
+                        # Chunkar med innehållsstyrda gränser och embeddar bara chunks som inte redan
+                        # finns i en tidigare version av dokumentet eller i embedding-cachen
+                        # En väntande PDF strömmas: sidorna chunkas och embeddas medan resten extraheras
+                        extracted_pages = []
+
+                        def collect_pages():
+                            for page_text in iter_document_text(*pending_upload[:2], report_scanned_pages):
+                                extracted_pages.append(page_text)
+                                yield page_text
+
+                        cached_doc, indexing_stats = ingest_document(
+                            collect_pages() if pending_upload else text_to_analyze,
+                            cache_dir, progress_callback=update_progress
+                        )
+                        if pending_upload:
+                            # Texten sparas för förhandsvisningen och den fullständiga analysen
+                            st.session_state["upload_texts"][pending_upload[2]] = "".join(extracted_pages)
+                    except EmptyDocumentError:
                         # Varnar om inga textblock kunde skapas
+                        progress_bar.empty()
                         st.warning("Kunde inte skapa några textblock (chunks) från den angivna texten.")
                         st.stop() # Avbryter körningen
+                    except Exception as e_emb:
+                        # Hanterar fel som kan uppstå vid skapande av embeddings
+                        st.error(f"❌ Fel vid embedding av textblock: {e_emb}")
+                        st.stop() # Avbryter körningen vid fel
+                    progress_bar.empty() # Tar bort progress bar
+                    # Ett tidigare sökindex för samma cachekatalog gäller inte längre
+                    st.session_state.pop("doc_index_key", None)
+                    st.success(
+                        f"Embeddings skapade och cachade! {indexing_stats.chunks} textblock: "
+                        f"{indexing_stats.reused + indexing_stats.cached} återanvända, {indexing_stats.embedded} nya."
+                    )
+
+                # För en strömmad PDF är textens fingeravtryck känt först efter indexeringen
+                doc_fingerprint = doc_fingerprint or cached_doc.header.get("fingerprint")
 
                 # Om inga embeddings finns (antingen från cache eller nyskapade)
-                if not embedded_chunks:
+                if not len(cached_doc):
                     st.error("Inga embeddings tillgängliga för analys.")
                     st.stop() # Avbryter körningen
 
+                # Bygger dokumentets sökindex direkt på den memmappade matrisen och återanvänder det
+                if st.session_state.get("doc_index_key") != cache_dir:
+                    st.session_state["doc_index"] = DocumentIndex.from_cached_document(cached_doc)
+                    st.session_state["doc_index_key"] = cache_dir
+
                 # Söker efter de mest relevanta textblocken baserat på användarens fråga och de skapade embeddings
-                retrieved_context, top_chunks_details = search_relevant_chunks(
-                    st.session_state.user_question_rag_tab, embedded_chunks
+                # Överlappande träffar slås ihop och kontexten hålls inom tokenbudgeten
+                assembled_context = search_context(
+                    st.session_state.user_question_rag_tab, st.session_state["doc_index"]
                 )
+                retrieved_context, top_chunks_details = assembled_context.text, assembled_context.sources
+
+                # Visar nyckeltal som frågan nämner direkt ur faktaindexet (utan GPT-anrop)
+                matching_facts = st.session_state["doc_index"].facts.lookup(st.session_state.user_question_rag_tab)
+                if matching_facts:
+                    st.expander("📌 Nyckeltal ur rapporten", expanded=True).markdown(format_facts(matching_facts))
 
                 # Visar den relevanta kontexten som kommer att skickas till GPT (max 2000 tecken)
-                st.expander("Relevant kontext som skickas till GPT").code(retrieved_context[:2000], language="text")
+                st.expander(
+                    f"Relevant kontext som skickas till GPT ({assembled_context.tokens} tokens, "
+                    f"{assembled_context.tokens_saved} sparade)"
+                ).code(retrieved_context[:2000], language="text")
 
                 # Den slutgiltiga frågan som skickas till GPT är användarens fråga.
                 # Ingen ytterligare prompt-modifiering sker här i denna version.
@@ -215,38 +458,66 @@ with tab_rag_analysis:
                 # Kommentar: Denna expander kan användas för att visa den exakta frågan som skickas till GPT.
                 # st.expander("Slutgiltig fråga som skickas till GPT").caption(final_question_for_rag)
 
-                # Genererar ett svar från GPT baserat på frågan och den hämtade kontexten
-                rag_answer_content = generate_gpt_answer(final_question_for_rag, retrieved_context)
-                # Sparar RAG-svaret i session state
-                st.session_state['rag_answer_content'] = rag_answer_content
+                # Slår upp frågan i svarscachen: exakt samma fråga och kontext, eller en
+                # tillräckligt lik tidigare fråga mot samma dokument (frågans embedding är redan cachad)
+                answer_cache = get_answer_cache()
+                query_embedding = get_embedding(final_question_for_rag)
+                question_language = detect_language(final_question_for_rag)
+                cached_answer = None
+                if not bypass_answer_cache:
+                    cached_answer = answer_cache.lookup(
+                        doc_fingerprint, final_question_for_rag, retrieved_context, RAG_MODEL,
+                        ANSWER_PROMPT_VERSION, query_embedding, question_language
+                    )
 
-                # Visar GPT:s svar
-                st.markdown(f"### 🤖 GPT-svar:\n{rag_answer_content}")
+                st.markdown("### 🤖 GPT-svar:")
+                if cached_answer:
+                    # Visar det cachade svaret direkt
+                    rag_answer_content = cached_answer.answer
+                    st.markdown(rag_answer_content)
+                    if cached_answer.match == "exact":
+                        st.caption("♻️ Svar från cache (samma fråga och kontext).")
+                    else:
+                        st.caption(f"♻️ Svar från cache för liknande fråga \"{cached_answer.question}\" (likhet {cached_answer.similarity:.2f}).")
+                    answer_key = cached_answer.key
+                else:
+                    # Strömmar ett svar från GPT baserat på frågan och den hämtade kontexten
+                    timings = {}
+                    try:
+                        rag_answer_content = st.write_stream(
+                            timed_stream(stream_gpt_answer(final_question_for_rag, retrieved_context, model=RAG_MODEL), timings)
+                        )
+                    except RuntimeError as e_gen:
+                        st.error(str(e_gen))
+                        st.stop() # Avbryter körningen
+                    if "ttft" in timings:
+                        st.caption(f"⏱️ Första token efter {timings['ttft']:.1f} s, klart efter {timings['total']:.1f} s")
+                    answer_key = answer_cache.put(
+                        doc_fingerprint, final_question_for_rag, retrieved_context, RAG_MODEL,
+                        ANSWER_PROMPT_VERSION, rag_answer_content, query_embedding, question_language
+                    ) if rag_answer_content else None
+                # Sparar hela RAG-svaret i session state (för export och RAGAS)
+                st.session_state['rag_answer_content'] = rag_answer_content
+                cache_stats = answer_cache.stats()
+                st.caption(
+                    f"Svarscache: {cache_stats['exact_hits']} exakta och {cache_stats['semantic_hits']} semantiska träffar, "
+                    f"{cache_stats['misses']} missar (träffgrad {cache_stats['hit_rate']:.0%})."
+                )
 
                 # Om ett RAG-svar har genererats
                 if rag_answer_content:
                     st.markdown("--- \n ### Automatisk AI-evaluering (RAGAS):") # Rubrik för RAGAS-utvärdering
-                    # Utvärderar kvaliteten på RAG-svaret med RAGAS
-                    ragas_result = ragas_evaluate(
-                        st.session_state.user_question_rag_tab, # Användarens fråga
-                        rag_answer_content,                     # GPT:s svar
-                        [chunk_text_content for _, chunk_text_content in top_chunks_details] # Textinnehållet från de relevanta chunks
-                    )
-                    # Hanterar resultatet från RAGAS-utvärderingen
-                    if ragas_result and "error" in ragas_result:
-                        st.info(f"(RAGAS) Kunde inte utvärdera svaret: {ragas_result['error']}")
-                    elif ragas_result:
-                        # Hämtar RAGAS-metrics: Faithfulness och Answer Relevancy
-                        faith_score = ragas_result.get('faithfulness')
-                        ans_rel_score = ragas_result.get('answer_relevancy')
-                        # Visar RAGAS-metrics i två kolumner
-                        col_ragas1, col_ragas2 = st.columns(2)
-                        with col_ragas1:
-                            st.metric("Faithfulness", f"{faith_score:.2f}" if faith_score is not None else "N/A",
-                                      help="Mäter hur väl AI:ns svar grundar sig på den information som hämtats från rapporten (0-1). Högre är bättre.")
-                        with col_ragas2:
-                            st.metric("Answer Relevancy", f"{ans_rel_score:.2f}" if ans_rel_score is not None else "N/A",
-                                      help="Mäter hur relevant AI:ns svar är på den ställda frågan (0-1). Högre är bättre.")
+                    # Återanvänder en sparad utvärdering för cachade svar, annars köas svaret
+                    # för utvärdering i bakgrunden och resultatet visas när det är klart
+                    if cached_answer and cached_answer.evaluation:
+                        render_ragas_result(cached_answer.evaluation)
+                    else:
+                        evaluation_key = get_evaluation_queue().submit(
+                            st.session_state.user_question_rag_tab, # Användarens fråga
+                            rag_answer_content,                     # GPT:s svar
+                            [chunk_text_content for _, chunk_text_content in top_chunks_details] # Textinnehållet från de relevanta chunks
+                        )
+                        show_ragas_result_when_ready(evaluation_key, answer_key)
         else:
             # Visar ett felmeddelande om ingen text finns eller om texten är för kort för RAG-analys
             st.error("Ingen text tillgänglig för frågebaserad analys, eller så är texten för kort.")
@@ -275,3 +546,7 @@ with tab_rag_analysis:
                 key="dl_gpt_pdf_rag_tab_main",
                 use_container_width=True
             )
+
+# Visar debugpanelen sist, så att mätvärdena från den här körningen kommer med
+if DEBUG_PANEL or st.query_params.get("debug") == "1":
+    render_debug_panel()
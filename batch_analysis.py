@@ -0,0 +1,341 @@
+# batch_analysis.py
+"""
+Batchanalys utan gränssnitt: många rapporter × en fast frågelista, med svaren som JSONL.
+
+    python batch_analysis.py rapporter/ fragor.txt --output svar.jsonl
+    python batch_analysis.py manifest.jsonl fragor.txt --output svar.jsonl --workers 4 --max-concurrency 8
+
+Rapporterna anges som en katalog (alla pdf-, html-, Excel- och textfiler, rekursivt) eller
+som ett manifest: en textfil med en sökväg eller URL per rad, eller JSONL med {"path": ...}
+eller {"url": ...} per rad. Frågorna läses ur en textfil (en fråga per rad, # för
+kommentarer) eller en JSON-lista.
+
+Samma pipeline som appen används: strömmande extraktion (iter_document_text), inkrementell
+chunkning och embedding (core.ingestion, med embedding-cachen), search_context, svarscachen och
+generate_gpt_answer. 'workers' dokument extraheras och indexeras samtidigt medan tidigare
+dokuments frågor besvaras; alla anrop mot OpenAI delar på högst 'max-concurrency' platser
+och går med prioriteten "background" i den gemensamma schemaläggaren, så att appen och
+servern på samma maskin får företräde inom rate limits.
+
+Varje besvarad (rapport, fråga) skrivs direkt till utfilen. Körs skriptet igen med samma
+utfil hoppas redan besvarade par över, så att en avbruten körning kan återupptas; par med
+fel försöks igen, och felraderna som ett senare svar (eller fel) ersätter tas bort ur utfilen.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from core.embedding_utils import get_embedding
+from core.file_processing import extract_text_from_file, iter_document_text
+from core.gpt_logic import ANSWER_PROMPT_VERSION, detect_language, generate_gpt_answer, search_context
+from core.ingestion import CHUNKER_PARAMS, ingest_document
+from core.key_figures import format_facts
+from core.retrieval import DocumentIndex
+from services.html_downloader import fetch_html_text
+from services.openai_scheduler import request_priority
+from utils.answer_cache import get_answer_cache
+from utils.cache_utils import get_document_cache_dir, get_document_fingerprint, open_document_cache
+
+logger = logging.getLogger("batch_analysis")
+
+REPORT_EXTENSIONS = (".pdf", ".html", ".htm", ".xlsx", ".xlsm", ".xls", ".txt", ".md")
+ANSWER_MODEL = "gpt-4o"
+
+
+def iter_reports(source: str) -> Iterator[str]:
+    """
+    Rapporternas sökvägar eller URL:er ur en katalog eller ett manifest, i stabil ordning.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(REPORT_EXTENSIONS):
+                    yield os.path.join(root, name)
+        return
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                line = entry.get("url") or entry["path"]
+            if line.startswith(("http://", "https://")):
+                yield line
+            else:
+                # Relativa sökvägar i manifestet gäller från manifestets katalog
+                yield os.path.normpath(os.path.join(base, line))
+
+
+def load_questions(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        if path.lower().endswith(".json"):
+            questions = [str(question) for question in json.load(f)]
+        else:
+            questions = [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    # Dubbletter besvaras bara en gång
+    return list(dict.fromkeys(questions))
+
+
+def load_answered(path: str) -> Set[Tuple[str, str]]:
+    """
+    (rapport, fråga)-par som redan har ett svar i utfilen. En avbruten sista rad
+    (krasch mitt i en skrivning) och rader med fel räknas inte som besvarade.
+    """
+    answered = set()
+    if not os.path.exists(path):
+        return answered
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("answer") is not None:
+                answered.add((record["source"], record["question"]))
+    return answered
+
+
+def prune_superseded_errors(path: str) -> int:
+    """
+    Skriver om utfilen utan felrader som har ersatts: fel för par som senare fick ett svar,
+    äldre fel för samma par och avbrutna rader. Returnerar antalet borttagna rader.
+    """
+    if not os.path.exists(path):
+        return 0
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    for line in lines:
+        try:
+            records.append((line, json.loads(line)))
+        except ValueError:
+            continue
+    answered = {(r["source"], r["question"]) for _, r in records if r.get("answer") is not None}
+    # Det sista felet för ett obesvarat par behålls
+    last_error = {(r["source"], r["question"]): i for i, (_, r) in enumerate(records) if "error" in r}
+    kept = [
+        line for i, (line, record) in enumerate(records)
+        if "error" not in record
+        or ((record["source"], record["question"]) not in answered
+            and last_error[(record["source"], record["question"])] == i)
+    ]
+    removed = len(lines) - len(kept)
+    if removed:
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(line if line.endswith("\n") else line + "\n" for line in kept)
+        os.replace(tmp_path, path)
+    return removed
+
+
+def extract_report_text(source: str) -> str:
+    if source.startswith(("http://", "https://")):
+        return fetch_html_text(source)
+    if source.lower().endswith((".txt", ".md")):
+        with open(source, "r", encoding="utf-8", errors="replace") as f:
+            return f.read()
+    with open(source, "rb") as f:
+        return extract_text_from_file(f)
+
+
+class ResultWriter:
+    """
+    Skriver en JSON-rad per resultat (trådsäkert) och tömmer bufferten efter varje rad.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        # En rad som avbröts av en krasch avslutas, så att nästa post hamnar på en egen rad
+        if self._file.tell() and not self._ends_with_newline(path):
+            self._file.write("\n")
+        self._lock = threading.Lock()
+        self.counts = {"answered": 0, "errors": 0}
+
+    @staticmethod
+    def _ends_with_newline(path: str) -> bool:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.counts["errors" if "error" in record else "answered"] += 1
+
+    def close(self):
+        self._file.close()
+
+
+class BatchRunner:
+    """
+    Kör pipelinen för alla rapporter: extraktion och indexering i 'workers' trådar,
+    frågorna i en gemensam pool, och högst 'max_concurrency' samtidiga OpenAI-anrop.
+    """
+
+    def __init__(
+        self,
+        questions: List[str],
+        writer: ResultWriter,
+        answered: Set[Tuple[str, str]],
+        workers: int = 4,
+        max_concurrency: int = 8,
+        top_k: int = 7,
+        model: str = ANSWER_MODEL,
+        use_answer_cache: bool = True
+    ):
+        self.questions = questions
+        self.writer = writer
+        self.answered = answered
+        self.workers = max(1, workers)
+        self.top_k = top_k
+        self.model = model
+        self.use_answer_cache = use_answer_cache
+        # Gemensam gräns för alla anrop mot OpenAI (embedding av dokument och svar)
+        self.api_slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self.answer_pool = ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="answer")
+
+    def run(self, reports: List[str]):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="document") as pool:
+            for future in as_completed([pool.submit(self.process_report, source) for source in reports]):
+                future.result()
+        self.answer_pool.shutdown()
+
+    def process_report(self, source: str):
+        with request_priority("background"):
+            self._process_report(source)
+
+    def _process_report(self, source: str):
+        pending = [question for question in self.questions if (source, question) not in self.answered]
+        if not pending:
+            return
+        started = time.perf_counter()
+        try:
+            index, doc_id = self.index_report(source)
+        except Exception as e:
+            logger.warning("%s: %s", source, e)
+            for question in pending:
+                self.writer.write({"source": source, "question": question, "error": f"{type(e).__name__}: {e}"})
+            return
+        # Dokumentets frågor besvaras i den gemensamma poolen; nästa dokument extraheras
+        # först när de är klara, så att högst 'workers' index hålls i minnet samtidigt
+        futures = [self.answer_pool.submit(self.answer, source, doc_id, index, question) for question in pending]
+        for future in futures:
+            future.result()
+        logger.info("%s: %d frågor på %.1f s", source, len(pending), time.perf_counter() - started)
+
+    def index_report(self, source: str) -> Tuple[DocumentIndex, str]:
+        if source.startswith(("http://", "https://")) or source.lower().endswith((".txt", ".md")):
+            text = extract_report_text(source)
+            if len(text.strip()) <= 20:
+                raise ValueError("Ingen text kunde extraheras ur rapporten.")
+            # Innehållsbaserat id, så att samma rapport delar cache med appen, servern och andra körningar
+            doc_id = get_document_fingerprint(text)
+            cached_doc = open_document_cache(get_document_cache_dir(doc_id), CHUNKER_PARAMS)
+            if cached_doc is not None:
+                return DocumentIndex.from_cached_document(cached_doc), doc_id
+            pieces = [text]
+        else:
+            # Filer strömmas: sidorna chunkas och embeddas medan resten av PDF:en extraheras.
+            # Id:t (textens fingeravtryck) är känt först efteråt; en redan cachad rapport
+            # känns igen på sina chunkhashar och embeddas inte om.
+            with open(source, "rb") as f:
+                pieces = iter_document_text(f.read(), source)
+        with self.api_slots:
+            cached_doc, stats = ingest_document(pieces, max_workers=1)
+        logger.info("%s: %d chunks (%d återanvända, %d embeddade)",
+                    source, stats.chunks, stats.reused + stats.cached, stats.embedded)
+        return DocumentIndex.from_cached_document(cached_doc), cached_doc.header["fingerprint"]
+
+    def answer(self, source: str, doc_id: str, index: DocumentIndex, question: str):
+        with request_priority("background"):
+            self._answer_question(source, doc_id, index, question)
+
+    def _answer_question(self, source: str, doc_id: str, index: DocumentIndex, question: str):
+        started = time.perf_counter()
+        record: Dict[str, Any] = {"source": source, "doc_id": doc_id, "question": question}
+        try:
+            with self.api_slots:
+                assembled = search_context(question, index, self.top_k)
+                answer, cached = self._answer(doc_id, question, assembled.text)
+            record.update({
+                "answer": answer,
+                "cached": cached,
+                "model": self.model,
+                "context_chunks": len(assembled.spans),
+                "context_tokens": assembled.tokens,
+                "context_tokens_saved": assembled.tokens_saved,
+                "facts": format_facts(index.facts.lookup(question)) or None,
+            })
+        except Exception as e:
+            logger.warning("%s: %s: %s", source, question, e)
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["seconds"] = round(time.perf_counter() - started, 3)
+        self.writer.write(record)
+
+    def _answer(self, doc_id: str, question: str, context: str) -> Tuple[str, Optional[str]]:
+        if not self.use_answer_cache:
+            return generate_gpt_answer(question, context, model=self.model), None
+        cache = get_answer_cache()
+        query_embedding = get_embedding(question)  # redan cachad av sökningen
+        language = detect_language(question)
+        hit = cache.lookup(doc_id, question, context, self.model, ANSWER_PROMPT_VERSION, query_embedding, language)
+        if hit:
+            return hit.answer, hit.match
+        answer = generate_gpt_answer(question, context, model=self.model)
+        cache.put(doc_id, question, context, self.model, ANSWER_PROMPT_VERSION, answer, query_embedding, language)
+        return answer, None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("reports", help="Katalog med rapporter eller ett manifest (txt/jsonl).")
+    parser.add_argument("questions", help="Frågefil (en fråga per rad, eller en JSON-lista).")
+    parser.add_argument("--output", "-o", default="batch_results.jsonl", help="JSONL-fil som svaren läggs till i.")
+    parser.add_argument("--workers", type=int, default=4, help="Antal rapporter som extraheras och indexeras samtidigt.")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="Max antal samtidiga anrop mot OpenAI.")
+    parser.add_argument("--top-k", type=int, default=7)
+    parser.add_argument("--model", default=ANSWER_MODEL)
+    parser.add_argument("--no-answer-cache", action="store_true", help="Generera nya svar i stället för cachade.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    reports = list(dict.fromkeys(iter_reports(args.reports)))
+    questions = load_questions(args.questions)
+    answered = load_answered(args.output)
+    remaining = sum((source, question) not in answered for source in reports for question in questions)
+    logger.info("%d rapporter × %d frågor, %d redan besvarade, %d kvar",
+                len(reports), len(questions), len(reports) * len(questions) - remaining, remaining)
+
+    started = time.perf_counter()
+    prune_superseded_errors(args.output)
+    writer = ResultWriter(args.output)
+    try:
+        BatchRunner(
+            questions, writer, answered, args.workers, args.max_concurrency,
+            args.top_k, args.model, not args.no_answer_cache
+        ).run(reports)
+    finally:
+        writer.close()
+        # Felrader från tidigare körningar som nu har besvarats tas bort
+        prune_superseded_errors(args.output)
+    logger.info("Klart på %.1f s: %d svar, %d fel (%s)",
+                time.perf_counter() - started, writer.counts["answered"], writer.counts["errors"], args.output)
+    return 1 if writer.counts["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+# gör denna mapp till ett Python-paket
@@ -0,0 +1,66 @@
+# benchmarks/bench_chunking.py
+"""
+Jämför teckenbaserade chunk_text med token- och strukturmedvetna iter_token_chunks:
+antal chunks, tokenförbrukning, tid och träffsäkerhet vid sökning (offline).
+
+    python -m benchmarks.bench_chunking --sections 200
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.fake_openai_server import fake_embedding
+from benchmarks.synthetic_report import synthetic_report
+from core.chunking import chunk_text, iter_token_chunks
+from core.retrieval import DocumentIndex, top_k_indices
+from utils.token_utils import count_tokens
+
+
+def evaluate(chunks, facts, top_k: int, dimensions: int) -> dict:
+    token_counts = [count_tokens(chunk) for chunk in chunks]
+    index = DocumentIndex(chunks, np.array([fake_embedding(chunk, dimensions) for chunk in chunks]))
+    hits = hits_at_1 = 0
+    for question, answer in facts:
+        best = top_k_indices(index.cosine_scores(fake_embedding(question, dimensions)), top_k).tolist()
+        hits += any(answer in chunks[i] for i in best)
+        hits_at_1 += answer in chunks[best[0]]
+    return {
+        "chunks": len(chunks),
+        "embedding_tokens": int(sum(token_counts)),
+        "max_chunk_tokens": int(max(token_counts)),
+        "context_tokens_top_k_max": int(sum(sorted(token_counts)[-top_k:])),
+        "hit_rate_at_1": round(hits_at_1 / max(len(facts), 1), 3),
+        "hit_rate_at_k": round(hits / max(len(facts), 1), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sections", type=int, default=200)
+    parser.add_argument("--max-tokens", type=int, default=400)
+    parser.add_argument("--top-k", type=int, default=7)
+    parser.add_argument("--dimensions", type=int, default=512)
+    args = parser.parse_args()
+
+    text, facts = synthetic_report(args.sections)
+
+    start = time.perf_counter()
+    char_chunks = chunk_text(text)
+    char_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    token_chunks = [text[span.start:span.end] for span in iter_token_chunks(text, max_tokens=args.max_tokens)]
+    token_seconds = time.perf_counter() - start
+
+    results = {
+        "characters": len(text),
+        "facts": len(facts),
+        "chunk_text": dict(evaluate(char_chunks, facts, args.top_k, args.dimensions), seconds=round(char_seconds, 3)),
+        "iter_token_chunks": dict(evaluate(token_chunks, facts, args.top_k, args.dimensions), seconds=round(token_seconds, 3)),
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# benchmarks/bench_context.py
+"""
+Mäter kontextbygget (core.context_assembly): tokens per fråga när träffarna skarvas
+ihop rakt av jämfört med sammanslagna, dubblettrensade och budgeterade avsnitt, och
+hur ofta svarsfrasen finns kvar i kontexten (mot en lokal fake-server för embeddings).
+
+    python -m benchmarks.bench_context --sections 200 --questions 50 --budget 1500
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+
+from benchmarks.fake_openai_server import start_fake_server
+from benchmarks.synthetic_report import synthetic_report
+
+
+def chunkings(text: str) -> dict:
+    from core.chunking import chunk_text, iter_content_defined_chunks, iter_token_chunks
+
+    token_spans = [(span.start, span.end) for span in iter_token_chunks(text, overlap_tokens=60)]
+    cdc_spans = [(span.start, span.end) for span in iter_content_defined_chunks(text)]
+    return {
+        # chunk_text: 200 teckens överlapp och inga offsets (äldre cacher)
+        "chunk_text": (chunk_text(text), None),
+        "token_chunks_overlap_60": ([text[s:e] for s, e in token_spans], np.asarray(token_spans)),
+        "content_defined": ([text[s:e] for s, e in cdc_spans], np.asarray(cdc_spans)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sections", type=int, default=200)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=7)
+    parser.add_argument("--budget", type=int, default=1500, help="Tokenbudget att jämföra med obegränsad kontext.")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server()
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    os.environ.setdefault("OPENAI_SCHEDULER", "0")
+
+    from core.context_assembly import CONTEXT_SEPARATOR, assemble_context
+    from core.embedding_utils import get_embedding, get_embeddings_batch
+    from core.retrieval import DocumentIndex, rank_chunk_indices
+
+    text, facts = synthetic_report(args.sections)
+    facts = facts[:args.questions]
+    results = {"questions": len(facts), "top_k": args.top_k}
+    for name, (chunks, spans) in chunkings(text).items():
+        index = DocumentIndex(chunks, np.asarray(get_embeddings_batch(chunks), dtype=np.float32), spans=spans)
+        rows = {"raw": [], "unlimited": [], f"budget_{args.budget}": []}
+        found = {key: 0 for key in rows}
+        for question, fact in facts:
+            order, scores = rank_chunk_indices(index, get_embedding(question), question, args.top_k)
+            hits = list(zip(order.tolist(), scores.tolist()))
+            for key, budget in (("unlimited", 0), (f"budget_{args.budget}", args.budget)):
+                assembled = assemble_context(chunks, hits, spans, budget)
+                rows[key].append(assembled.tokens)
+                found[key] += fact in assembled.text
+            rows["raw"].append(assembled.raw_tokens)
+            found["raw"] += fact in CONTEXT_SEPARATOR.join(chunks[i] for i, _ in hits)
+        results[name] = {
+            key: {"mean_tokens": round(float(np.mean(tokens)), 1), "fact_in_context": round(found[key] / len(facts), 3)}
+            for key, tokens in rows.items()
+        }
+        results[name]["tokens_saved_unlimited"] = round(1 - np.mean(rows["unlimited"]) / np.mean(rows["raw"]), 3)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# benchmarks/bench_corpus_index.py
+"""
+Mäter recall@k och svarstid för IVF-korpusindexet mot exakt sökning, för olika nprobe.
+
+    python -m benchmarks.bench_corpus_index --vectors 100000 --dim 256
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from core.corpus_index import CorpusIndex
+from core.retrieval import normalize_rows, top_k_indices
+
+
+def clustered_vectors(n: int, dim: int, n_topics: int, rng) -> np.ndarray:
+    # Syntetiska "ämnen" så att datat liknar riktiga embeddings mer än ren brus
+    topics = normalize_rows(rng.normal(size=(n_topics, dim)))
+    assign = rng.integers(0, n_topics, size=n)
+    return normalize_rows(topics[assign] + 1.5 * rng.normal(size=(n, dim)) / np.sqrt(dim))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--lists", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = clustered_vectors(args.vectors, args.dim, 500, rng)
+    index = CorpusIndex(path="", n_lists=args.lists)
+    per_doc = args.vectors // args.docs
+    start = time.perf_counter()
+    for d in range(args.docs):
+        part = slice(d * per_doc, (d + 1) * per_doc)
+        index.add_document(f"doc{d}", [f"chunk {i}" for i in range(part.start, part.stop)], vectors[part],
+                           {"company": f"Bolag{d % 20}", "year": 2015 + d % 10})
+    build_seconds = time.perf_counter() - start
+
+    queries = normalize_rows(vectors[rng.choice(len(index), args.queries, replace=False)]
+                             + 0.3 * rng.normal(size=(args.queries, args.dim)) / np.sqrt(args.dim))
+    corpus = index.vectors
+    start = time.perf_counter()
+    exact = [set(top_k_indices(corpus @ q, args.k).tolist()) for q in queries]
+    exact_ms = (time.perf_counter() - start) / args.queries * 1000
+
+    results = {"vectors": len(index), "dim": args.dim, "lists": args.lists,
+               "build_seconds": round(build_seconds, 2), "exact_ms_per_query": round(exact_ms, 3), "ivf": []}
+    for nprobe in (1, 4, 8, 16, 32, 64):
+        start = time.perf_counter()
+        hits = [index.search(q, top_k=args.k, nprobe=nprobe) for q in queries]
+        ms = (time.perf_counter() - start) / args.queries * 1000
+        recall = np.mean([
+            len({int(text.split()[1]) for _, text, _ in hit} & truth) / args.k
+            for hit, truth in zip(hits, exact)
+        ])
+        results["ivf"].append({"nprobe": nprobe, "recall_at_k": round(float(recall), 3), "ms_per_query": round(ms, 3)})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
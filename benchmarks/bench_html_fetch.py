@@ -0,0 +1,127 @@
+# benchmarks/bench_html_fetch.py
+"""
+Mäter och kontrollerar HTML-hämtningen mot en lokal HTTP-server (ingen extern trafik):
+kall hämtning, villkorlig hämtning (304 via ETag/Last-Modified), samtidig bulkhämtning
+och tolkning med lxml jämfört med html.parser.
+
+    python -m benchmarks.bench_html_fetch --pages 40 --latency 0.05 --concurrency 8
+"""
+import argparse
+import hashlib
+import json
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.run_suite import synthetic_html
+from benchmarks.synthetic_report import synthetic_report
+
+
+class _ReportHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+        page = server.pages.get(self.path)
+        if page is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body, etag = page
+        time.sleep(server.latency)
+        if self.headers.get("If-None-Match") == etag or self.headers.get("If-Modified-Since") == server.last_modified:
+            with server.lock:
+                server.stats["not_modified"] += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", server.last_modified)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_report_server(n_pages: int, sections: int = 30, latency: float = 0.0):
+    """
+    Startar en lokal server med 'n_pages' rapportsidor på /report/<i>. Returnerar (server, bas-URL).
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ReportHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.latency = latency
+    server.stats = {"requests": 0, "not_modified": 0}
+    server.last_modified = formatdate(time.time(), usegmt=True)
+    server.pages = {}
+    for i in range(n_pages):
+        body = synthetic_html(synthetic_report(sections, seed=i)[0])
+        server.pages[f"/report/{i}"] = (body, '"' + hashlib.sha256(body).hexdigest()[:16] + '"')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--sections", type=int, default=30, help="Storlek per sida (syntetisk rapport).")
+    parser.add_argument("--latency", type=float, default=0.05, help="Serverns svarstid per anrop (s).")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    from services.html_downloader import fetch_html, fetch_html_texts, html_to_text
+    import services.html_downloader as html_downloader
+
+    server, base_url = start_report_server(args.pages, args.sections, args.latency)
+    cache_dir = tempfile.TemporaryDirectory()
+    html_downloader.HTML_CACHE_DIR = cache_dir.name
+    urls = [f"{base_url}/report/{i}" for i in range(args.pages)]
+    results = {"pages": args.pages, "latency_s": args.latency}
+
+    # Tolkning: samma sida med båda parsrarna (och samma text)
+    body = server.pages["/report/0"][0]
+    for name in ("html.parser", "lxml"):
+        start = time.perf_counter()
+        text = html_to_text(body, parser=name)
+        results[f"parse_{name}_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        results[f"parse_{name}_lines"] = len([line for line in text.splitlines() if line.strip()])
+
+    start = time.perf_counter()
+    cold = [fetch_html(url) for url in urls]
+    results["sequential_cold_s"] = round(time.perf_counter() - start, 3)
+    start = time.perf_counter()
+    warm = [fetch_html(url) for url in urls]
+    results["sequential_conditional_s"] = round(time.perf_counter() - start, 3)
+    results["conditional_304"] = sum(result.status == 304 for result in warm)
+    assert all(a.text == b.text for a, b in zip(cold, warm)), "304-svaret gav en annan text än den kalla hämtningen"
+
+    start = time.perf_counter()
+    bulk = fetch_html_texts(urls, max_concurrency=args.concurrency, use_cache=False)
+    results["bulk_cold_s"] = round(time.perf_counter() - start, 3)
+    results["bulk_errors"] = sum(result.error is not None for result in bulk)
+    assert [r.text for r in bulk] == [r.text for r in cold], "bulkhämtningen gav andra texter"
+    start = time.perf_counter()
+    bulk_warm = fetch_html_texts(urls, max_concurrency=args.concurrency)
+    results["bulk_conditional_s"] = round(time.perf_counter() - start, 3)
+    results["bulk_conditional_304"] = sum(result.status == 304 for result in bulk_warm)
+    missing = fetch_html_texts([f"{base_url}/saknas"])[0]
+    results["missing_page_error"] = missing.status
+    results["server"] = dict(server.stats)
+
+    print(json.dumps(results, indent=2))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# benchmarks/bench_ingest.py
+"""
+Mäter genomströmningen vid embedding av chunks: seriella get_embedding-anrop
+jämfört med get_embeddings_batch, mot den lokala fejk-servern.
+
+    python -m benchmarks.bench_ingest --chunks 500 --latency 0.05
+"""
+import argparse
+import json
+import os
+import time
+import tempfile
+
+from benchmarks.fake_openai_server import start_fake_server
+
+
+def synthetic_chunks(n: int, words_per_chunk: int = 250, prefix: str = "ord"):
+    return [
+        " ".join(f"{prefix}{(i * 31 + j) % 5000} rörelseresultat{i}" for j in range(words_per_chunk // 2))
+        for i in range(n)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="Fejkad API-latens per anrop (s).")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=2048, help="Max antal chunks per anrop.")
+    parser.add_argument("--serial-limit", type=int, default=100,
+                        help="Antal chunks som mäts seriellt (extrapoleras).")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(latency=args.latency)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    # Tom embedding-cache så att mätningen inte påverkas av tidigare körningar
+    store_dir = tempfile.TemporaryDirectory()
+    os.environ["EMBEDDING_STORE_PATH"] = os.path.join(store_dir.name, "store.sqlite3")
+
+    from core.embedding_utils import get_embedding, get_embeddings_batch
+
+    chunks = synthetic_chunks(args.chunks)
+    serial_chunks = synthetic_chunks(min(args.serial_limit, len(chunks)), prefix="seriell")
+    serial_n = len(serial_chunks)
+
+    start = time.perf_counter()
+    for chunk in serial_chunks:
+        get_embedding(chunk)
+    serial_rate = serial_n / (time.perf_counter() - start)
+
+    requests_before = server.stats["requests"]
+    start = time.perf_counter()
+    embeddings = get_embeddings_batch(chunks, max_inputs=args.batch_size, max_workers=args.workers)
+    batch_seconds = time.perf_counter() - start
+    assert len(embeddings) == len(chunks)
+
+    # Andra körningen besvaras helt från den persistenta cachen
+    requests_before_warm = server.stats["requests"]
+    start = time.perf_counter()
+    get_embeddings_batch(chunks, max_inputs=args.batch_size, max_workers=args.workers)
+    warm_seconds = time.perf_counter() - start
+
+    result = {
+        "chunks": len(chunks),
+        "latency_s": args.latency,
+        "serial_chunks_per_s": round(serial_rate, 1),
+        "batch_chunks_per_s": round(len(chunks) / batch_seconds, 1),
+        "batch_seconds": round(batch_seconds, 3),
+        "batch_size": args.batch_size,
+        "batch_requests": requests_before_warm - requests_before,
+        "warm_cache_seconds": round(warm_seconds, 3),
+        "warm_cache_requests": server.stats["requests"] - requests_before_warm,
+    }
+    print(json.dumps(result, indent=2))
+    server.shutdown()
+    store_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
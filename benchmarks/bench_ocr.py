@@ -0,0 +1,71 @@
+# benchmarks/bench_ocr.py
+"""
+Mäter OCR-genomströmning per sida på CPU för inskannade PDF:er: modell-laddning,
+rasterisering och OCR med olika antal arbetsprocesser. Kräver easyocr och PyMuPDF.
+
+    python -m benchmarks.bench_ocr --pages 12 --workers 1 2 4
+"""
+import argparse
+import json
+import time
+
+from benchmarks.bench_pdf_extraction import synthetic_pdf
+
+
+def scanned_pdf(pages: int, dpi: int = 150) -> bytes:
+    """
+    Gör om en text-PDF till en "inskannad" PDF där varje sida bara är en bild.
+    """
+    import fitz
+    with fitz.open(stream=synthetic_pdf(pages), filetype="pdf") as source, fitz.open() as scanned:
+        for page in source:
+            pixmap = page.get_pixmap(dpi=dpi)
+            new_page = scanned.new_page(width=page.rect.width, height=page.rect.height)
+            new_page.insert_image(new_page.rect, stream=pixmap.tobytes("png"))
+        return scanned.tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=12)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--dpi", type=int, default=200)
+    args = parser.parse_args()
+
+    from core.file_processing import iter_pdf_pages, MIN_TEXT_LAYER_CHARS
+    from utils.ocr_utils import get_ocr_reader, ocr_pdf_pages, render_pdf_pages
+
+    pdf_bytes = scanned_pdf(args.pages)
+    results = {"pages": args.pages, "dpi": args.dpi}
+
+    start = time.perf_counter()
+    without_text = [page for page, text in iter_pdf_pages(pdf_bytes) if len(text.strip()) < MIN_TEXT_LAYER_CHARS]
+    results["text_layer_check_s"] = round(time.perf_counter() - start, 3)
+    results["pages_without_text_layer"] = len(without_text)
+
+    start = time.perf_counter()
+    for _ in render_pdf_pages(pdf_bytes, range(args.pages), args.dpi):
+        pass
+    results["render_pages_per_s"] = round(args.pages / (time.perf_counter() - start), 1)
+
+    start = time.perf_counter()
+    get_ocr_reader()
+    results["reader_load_s"] = round(time.perf_counter() - start, 2)
+
+    for workers in args.workers:
+        # Första körningen värmer upp poolen (varje arbetsprocess laddar modellen en gång)
+        for _ in ocr_pdf_pages(pdf_bytes, range(min(workers, args.pages)), args.dpi, max_workers=workers):
+            pass
+        start = time.perf_counter()
+        n_chars = sum(len(text) for _, text in ocr_pdf_pages(pdf_bytes, range(args.pages), args.dpi, max_workers=workers))
+        seconds = time.perf_counter() - start
+        results[f"ocr_workers_{workers}"] = {
+            "seconds": round(seconds, 2),
+            "pages_per_s": round(args.pages / seconds, 2),
+            "chars": n_chars,
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
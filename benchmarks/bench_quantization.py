@@ -0,0 +1,115 @@
+# benchmarks/bench_quantization.py
+"""
+Jämför exakt sökning i float32 med kompakta vektorer (Matryoshka-trunkering och/eller
+int8/float16) med och utan exakt omrankning: recall@k, minne och svarstid per fråga.
+
+    python -m benchmarks.bench_quantization --vectors 100000
+    python -m benchmarks.bench_quantization --from-cache data/embeddings
+
+Syntetiska vektorer får avtagande varians över dimensionerna (--decay), som
+text-embedding-3:s Matryoshka-träning ger; med --from-cache används riktiga embeddings
+ur dokumentcachen och frågorna är brusiga kopior av slumpvis valda chunks.
+"""
+import os
+import glob
+import json
+import time
+import argparse
+
+import numpy as np
+
+from benchmarks.bench_corpus_index import clustered_vectors
+from core.corpus_index import CorpusIndex
+from core.quantization import CompressedVectors, compressed_search
+from core.retrieval import normalize_rows, top_k_indices
+
+CONFIGURATIONS = [
+    # (namn, dims, dtype)
+    ("float16", None, "float16"),
+    ("int8", None, "int8"),
+    ("float32_512", 512, "float32"),
+    ("int8_512", 512, "int8"),
+    ("float32_256", 256, "float32"),
+    ("int8_256", 256, "int8"),
+]
+
+
+def matryoshka_vectors(n: int, dim: int, decay: float, rng) -> np.ndarray:
+    vectors = clustered_vectors(n, dim, 500, rng)
+    return normalize_rows(vectors * (1.0 + np.arange(dim) / 128.0) ** -decay)
+
+
+def cached_vectors(cache_root: str) -> np.ndarray:
+    blocks = [np.load(path).astype(np.float32) for path in sorted(glob.glob(os.path.join(cache_root, "doc_*", "vectors.npy")))]
+    if not blocks:
+        raise SystemExit(f"Hittade inga vectors.npy under {cache_root}")
+    return normalize_rows(np.concatenate(blocks))
+
+
+def _ms_per_query(fn, queries) -> float:
+    start = time.perf_counter()
+    results = [fn(q) for q in queries]
+    return results, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def _recall(found, truth, k: int) -> float:
+    return round(float(np.mean([len(set(f.tolist()) & t) / k for f, t in zip(found, truth)])), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--decay", type=float, default=0.75, help="Hur snabbt variansen avtar över dimensionerna.")
+    parser.add_argument("--from-cache", default=None, help="Katalog med dokumentcacher (doc_*/vectors.npy).")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank-factor", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.from_cache:
+        vectors = cached_vectors(args.from_cache)
+    else:
+        vectors = matryoshka_vectors(args.vectors, args.dim, args.decay, rng)
+    n, dim = vectors.shape
+    queries = normalize_rows(vectors[rng.choice(n, args.queries, replace=False)]
+                             + 0.3 * rng.normal(size=(args.queries, dim)) / np.sqrt(dim))
+
+    truth_rows, exact_ms = _ms_per_query(lambda q: top_k_indices(vectors @ q, args.k), queries)
+    truth = [set(rows.tolist()) for rows in truth_rows]
+    results = {
+        "vectors": n, "dim": dim, "k": args.k, "rerank_factor": args.rerank_factor,
+        "exact_float32": {"bytes_per_vector": dim * 4, "memory_mb": round(vectors.nbytes / 2**20, 1),
+                          "ms_per_query": round(exact_ms, 3), "recall_at_k": 1.0},
+    }
+    for name, dims, dtype in CONFIGURATIONS:
+        if dims is not None and dims >= dim:
+            continue
+        compressed = CompressedVectors.fit(vectors, dims, dtype)
+        approximate, approximate_ms = _ms_per_query(lambda q: top_k_indices(compressed.scores(q), args.k), queries)
+        reranked, rerank_ms = _ms_per_query(
+            lambda q: compressed_search(compressed, vectors, q, args.k, rerank_factor=args.rerank_factor)[0], queries
+        )
+        results[name] = {
+            "bytes_per_vector": int(compressed.codes.itemsize * compressed.dims),
+            "memory_mb": round(compressed.nbytes / 2**20, 1),
+            "ms_per_query": round(approximate_ms, 3),
+            "recall_at_k": _recall(approximate, truth, args.k),
+            "reranked_ms_per_query": round(rerank_ms, 3),
+            "reranked_recall_at_k": _recall(reranked, truth, args.k),
+        }
+
+    # Hela vägen genom korpusindexet: IVF + int8_256 + omrankning mot en memmap på disk
+    index = CorpusIndex(path="", n_lists=256, dims=min(256, dim), quantization="int8", rerank_factor=args.rerank_factor)
+    index.add_document("korpus", [f"chunk {i}" for i in range(n)], vectors)
+    hits, ivf_ms = _ms_per_query(lambda q: index.search(q, top_k=args.k, nprobe=32), queries)
+    found = [np.array([int(text.split()[1]) for _, text, _ in hit]) for hit in hits]
+    results["corpus_index_ivf_int8_256"] = {
+        "nprobe": 32, "ms_per_query": round(ivf_ms, 3), "recall_at_k": _recall(found, truth, args.k),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# benchmarks/bench_rate_limits.py
+"""
+Mäter schemaläggaren för OpenAI-anrop (services.openai_scheduler) mot en lokal fake-server
+med en gräns för antal anrop per minut: antal 429-svar och svarstider för interaktiva
+frågor (frågeembedding) medan en bakgrundsindexering embeddar så fort den får.
+
+    python -m benchmarks.bench_rate_limits --rpm 120 --background 150
+
+Körs med schemaläggaren avstängd (bara klientens omförsök efter Retry-After) och påslagen
+(token buckets, prioritet "background" för indexeringen och gemensam paus efter 429).
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+
+import numpy as np
+
+from benchmarks.fake_openai_server import start_fake_server
+
+MODEL = "text-embedding-3-small"
+
+
+def run_scenario(server, workdir: str, name: str, enabled: bool, args) -> dict:
+    import services.openai_scheduler as openai_scheduler
+    import services.openai_service as openai_service
+    import utils.embedding_store as embedding_store
+    from core.embedding_utils import get_embedding, get_embeddings_batch
+
+    # Nya klienter, en ny schemaläggare och en tom embedding-cache per scenario
+    os.environ["OPENAI_SCHEDULER"] = "1" if enabled else "0"
+    os.environ["OPENAI_SCHEDULER_PATH"] = os.path.join(workdir, f"{name}.sqlite3")
+    os.environ["OPENAI_RATE_LIMITS"] = f"{MODEL}={args.rpm}/0"
+    os.environ["EMBEDDING_STORE_PATH"] = os.path.join(workdir, f"{name}_store.sqlite3")
+    openai_service._client = None
+    openai_scheduler._scheduler = None
+    embedding_store._store = None
+    # Fake-serverns fönster på 60 s ska vara tomt när scenariot börjar
+    with server.stats_lock:
+        server.request_times.clear()
+        rate_limited_before = server.stats["rate_limited"]
+
+    texts = [f"{name} bakgrundschunk {i} om rörelseresultat och kassaflöde" for i in range(args.background)]
+    background = threading.Thread(
+        target=get_embeddings_batch, args=(texts,), kwargs={"max_inputs": 1, "max_workers": args.workers}
+    )
+    started = time.perf_counter()
+    background.start()
+    latencies = []
+    i = 0
+    while background.is_alive() or i < 5:
+        question_started = time.perf_counter()
+        get_embedding(f"{name} interaktiv fråga {i}: hur stor var omsättningen?")
+        latencies.append(time.perf_counter() - question_started)
+        i += 1
+        time.sleep(args.interval)
+    background.join()
+    with server.stats_lock:
+        rate_limited = server.stats["rate_limited"] - rate_limited_before
+    return {
+        "seconds": round(time.perf_counter() - started, 2),
+        "responses_429": rate_limited,
+        "interactive_queries": len(latencies),
+        "interactive_p50_s": round(float(np.percentile(latencies, 50)), 3),
+        "interactive_p95_s": round(float(np.percentile(latencies, 95)), 3),
+        "interactive_max_s": round(max(latencies), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rpm", type=int, default=120, help="Fake-serverns gräns för anrop per minut.")
+    parser.add_argument("--background", type=int, default=150, help="Antal embeddings-anrop i bakgrunden.")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--interval", type=float, default=0.5, help="Sekunder mellan interaktiva frågor.")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(latency=0.02, rpm=args.rpm)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    workdir = tempfile.TemporaryDirectory()
+    results = {"rpm": args.rpm, "background_requests": args.background}
+    for name, enabled in (("without_scheduler", False), ("with_scheduler", True)):
+        results[name] = run_scenario(server, workdir.name, name, enabled, args)
+    print(json.dumps(results, indent=2))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
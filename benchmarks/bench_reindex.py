@@ -0,0 +1,102 @@
+# benchmarks/bench_reindex.py
+"""
+Mäter inkrementell omindexering av en reviderad rapport: hur stor andel av chunkarna
+som är oförändrade med teckenbaserade, tokenpackade och innehållsstyrda gränser, och
+hur många chunks ingest_document återanvänder respektive embeddar (mot en lokal fake-server).
+
+    python -m benchmarks.bench_reindex --sections 200 --edits 10
+"""
+import os
+import json
+import random
+import argparse
+import tempfile
+import time
+
+from benchmarks.fake_openai_server import start_fake_server
+from benchmarks.synthetic_report import FILLER, synthetic_report
+from core.chunking import chunk_hash, chunk_text, iter_content_defined_chunks, iter_token_chunks
+
+
+def revise(text: str, edits: int, seed: int = 0) -> str:
+    """
+    En "rättad" version av texten: nya stycken, ändrade belopp och strukna meningar på slumpvisa ställen.
+    """
+    rng = random.Random(seed)
+    for _ in range(edits):
+        position = text.find("\n\n", rng.randrange(len(text)))
+        if position < 0:
+            continue
+        kind = rng.choice(("insert", "amend", "delete"))
+        if kind == "insert":
+            paragraph = " ".join(rng.choice(FILLER) for _ in range(rng.randint(2, 6)))
+            text = text[:position] + "\n\n" + paragraph + text[position:]
+        elif kind == "amend":
+            text = text[:position] + f" Beloppet har justerats till {rng.randint(10, 999)} MSEK." + text[position:]
+        else:
+            end = text.find(". ", position + 2)
+            if end > 0:
+                text = text[:position + 2] + text[end + 2:]
+    return text
+
+
+def unchanged_share(chunker, original: str, revised: str) -> dict:
+    before = {chunk_hash(chunk) for chunk in chunker(original)}
+    after = [chunk_hash(chunk) for chunk in chunker(revised)]
+    unchanged = sum(value in before for value in after)
+    return {"chunks": len(after), "unchanged": unchanged, "unchanged_share": round(unchanged / max(len(after), 1), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sections", type=int, default=200)
+    parser.add_argument("--edits", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    text, _ = synthetic_report(args.sections, seed=args.seed)
+    revised = revise(text, args.edits, args.seed)
+    chunkers = {
+        "chunk_text": chunk_text,
+        "iter_token_chunks": lambda t: [t[s.start:s.end] for s in iter_token_chunks(t)],
+        "iter_content_defined_chunks": lambda t: [t[s.start:s.end] for s in iter_content_defined_chunks(t)],
+    }
+    results = {"characters": len(text), "edits": args.edits}
+    results.update({name: unchanged_share(chunker, text, revised) for name, chunker in chunkers.items()})
+
+    server, base_url = start_fake_server()
+    workdir = tempfile.TemporaryDirectory()
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    os.environ["EMBEDDING_STORE_PATH"] = os.path.join(workdir.name, "store.sqlite3")
+
+    import utils.embedding_store as embedding_store
+    from core.embedding_utils import DEFAULT_EMBEDDING_MODEL
+    from core.ingestion import ingest_document
+    from utils.cache_utils import find_previous_version
+
+    original_dir = os.path.join(workdir.name, "doc_original")
+    start = time.perf_counter()
+    _, first = ingest_document(text, original_dir, find_previous=False)
+    results["ingest_original_s"] = round(time.perf_counter() - start, 3)
+
+    # Ny, tom embedding-cache: allt som återanvänds måste komma från föregående version
+    os.environ["EMBEDDING_STORE_PATH"] = os.path.join(workdir.name, "store_revised.sqlite3")
+    embedding_store._store = None
+    revised_dir = os.path.join(workdir.name, "doc_revised")
+    revised_hashes = [chunk_hash(revised[s.start:s.end]) for s in iter_content_defined_chunks(revised)]
+    previous = find_previous_version(revised_hashes, DEFAULT_EMBEDDING_MODEL, cache_root=workdir.name)
+    start = time.perf_counter()
+    _, second = ingest_document(revised, revised_dir, previous=previous)
+    results["ingest_revised_s"] = round(time.perf_counter() - start, 3)
+    results["previous_found"] = previous is not None
+    results["reindex"] = second._asdict()
+    results["reindex"].pop("previous")
+    results["embedded_first"] = first.embedded
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
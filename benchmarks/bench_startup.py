@@ -0,0 +1,123 @@
+# benchmarks/bench_startup.py
+"""
+Mäter kallstart: importtid för alla moduler som app.py importerar, i nya
+Python-processer med -X importtime, och kontrollerar att tunga bibliotek inte laddas
+vid start. Avslutas med felkod om en gräns överskrids, så att den kan köras i CI.
+
+    python -m benchmarks.bench_startup --runs 5 --max-ms 1500
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Bibliotek som bara får laddas när respektive funktion används första gången
+HEAVY_MODULES = [
+    "ragas", "datasets", "langchain_openai", "easyocr", "torch",
+    "sklearn", "pandas", "pdfplumber", "fpdf", "bs4", "requests",
+]
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def app_imports(path: str = os.path.join(REPO_ROOT, "app.py")) -> list:
+    """
+    Modulerna som app.py importerar på toppnivå (läses ur källkoden, så listan följer appen).
+    """
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def available(modules: list) -> tuple:
+    """
+    Delar upp modulerna i de som går att importera här och de som saknas.
+    """
+    code = (
+        "import importlib.util, json, sys\n"
+        "ok = []\n"
+        "for m in sys.argv[1:]:\n"
+        "    try:\n"
+        "        ok.append(m) if importlib.util.find_spec(m) else None\n"
+        "    except ImportError:\n"
+        "        pass\n"
+        "print(json.dumps(ok))"
+    )
+    out = subprocess.run([sys.executable, "-c", code, *modules], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    found = json.loads(out.stdout)
+    return found, [m for m in modules if m not in found]
+
+
+def measure(modules: list) -> dict:
+    """
+    Importerar modulerna i en ny process och returnerar total tid, toppnivåmodulernas
+    kumulativa tid och vilka tunga bibliotek som laddades.
+    """
+    code = (
+        "import importlib, json, sys\n"
+        f"for m in {modules!r}: importlib.import_module(m)\n"
+        f"print(json.dumps(sorted(h for h in {HEAVY_MODULES!r} if h in sys.modules)))"
+    )
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_ROOT, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(f"Importen misslyckades: {out.stderr.strip().splitlines()[-1]}")
+    top_level = {}
+    for line in out.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        # Toppnivåimporter har ingen indentering i -X importtime-utskriften
+        if match and len(match.group(3)) == 1:
+            top_level[match.group(4)] = int(match.group(2)) / 1000
+    return {
+        "total_ms": sum(top_level.values()),
+        "top_level_ms": top_level,
+        "heavy_loaded": json.loads(out.stdout.strip().splitlines()[-1]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=None, help="Gräns för median av total importtid.")
+    parser.add_argument("--top", type=int, default=10, help="Antal dyraste toppnivåimporter att visa.")
+    args = parser.parse_args()
+
+    modules, missing = available(app_imports())
+    runs = [measure(modules) for _ in range(args.runs)]
+    slowest = sorted(runs[-1]["top_level_ms"].items(), key=lambda item: item[1], reverse=True)[:args.top]
+    heavy_loaded = sorted({module for run in runs for module in run["heavy_loaded"]})
+    median_ms = statistics.median(run["total_ms"] for run in runs)
+    results = {
+        "modules": modules,
+        "not_installed": missing,
+        "runs": args.runs,
+        "import_ms_median": round(median_ms, 1),
+        "import_ms_min": round(min(run["total_ms"] for run in runs), 1),
+        "slowest_top_level_ms": {name: round(ms, 1) for name, ms in slowest},
+        "heavy_modules_loaded": heavy_loaded,
+    }
+    print(json.dumps(results, indent=2))
+
+    failures = []
+    if heavy_loaded:
+        failures.append(f"tunga moduler laddas vid start: {', '.join(heavy_loaded)}")
+    if args.max_ms is not None and median_ms > args.max_ms:
+        failures.append(f"importtid {median_ms:.0f} ms > {args.max_ms:.0f} ms")
+    if failures:
+        print("FEL: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
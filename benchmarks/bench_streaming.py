@@ -0,0 +1,69 @@
+# benchmarks/bench_streaming.py
+"""
+Mäter upplevd latens (tid till första token, TTFT) för strömmade jämfört med
+icke-strömmade svar, mot den lokala fejk-OpenAI-servern.
+
+    python -m benchmarks.bench_streaming --token-latency 0.02 --latency 0.3
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+from benchmarks.fake_openai_server import start_fake_server
+
+
+def time_blocking(fn, runs: int) -> dict:
+    totals = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        totals.append(time.perf_counter() - start)
+    # Utan strömning är första token synlig först när hela svaret är klart
+    return {"ttft_s": round(statistics.median(totals), 3), "total_s": round(statistics.median(totals), 3)}
+
+
+def time_stream(fn, runs: int) -> dict:
+    ttfts, totals = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        first = None
+        for _ in fn():
+            if first is None:
+                first = time.perf_counter() - start
+        ttfts.append(first or 0.0)
+        totals.append(time.perf_counter() - start)
+    return {"ttft_s": round(statistics.median(ttfts), 3), "total_s": round(statistics.median(totals), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.3, help="Fejkad latens per anrop (s).")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="Fejkad latens per genererat ord (s).")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(latency=args.latency, token_latency=args.token_latency)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    from core.gpt_logic import generate_gpt_answer, stream_gpt_answer, full_rapportanalys, stream_full_rapportanalys
+
+    question = "Vilken utdelning föreslås?"
+    context = "Styrelsen föreslår en utdelning om 4,50 kr per aktie. " * 20
+    report = "Koncernens nettoomsättning ökade till 12 345 MSEK. " * 200
+
+    results = {
+        "latency_s": args.latency,
+        "token_latency_s": args.token_latency,
+        "answer_blocking": time_blocking(lambda: generate_gpt_answer(question, context), args.runs),
+        "answer_stream": time_stream(lambda: stream_gpt_answer(question, context), args.runs),
+        "full_analysis_blocking": time_blocking(lambda: full_rapportanalys(report, mode="single"), args.runs),
+        "full_analysis_stream": time_stream(lambda: stream_full_rapportanalys(report, mode="single"), args.runs),
+    }
+    print(json.dumps(results, indent=2))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+# benchmarks/fake_openai_server.py
+"""
+Lokal ersättare för OpenAI:s embeddings- och chat-endpoints, för att mäta prestanda helt offline.
+
+Servern kan simulera latens per anrop och per genererat ord samt en gräns för
+antal anrop per minut (svarar då 429 med Retry-After, som OpenAI).
+
+Vektorerna är deterministiska: varje ord hashas till ett par dimensioner (med tecken),
+så liknande texter får liknande vektorer och sökresultat går att jämföra mellan körningar.
+
+Kör fristående:
+    python -m benchmarks.fake_openai_server --port 8765 --latency 0.05
+och peka klienten mot den:
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=test
+"""
+import argparse
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+HASHES_PER_WORD = 4
+
+
+def fake_embedding(text: str, dimensions: int = 1536) -> List[float]:
+    """
+    Deterministisk "bag of words"-embedding (normaliserad till längd 1).
+    Varje unikt ord räknas en gång, så att upprepade fyllnadsord inte dränker sällsynta termer.
+    """
+    vector = [0.0] * dimensions
+    for word in set(WORD_PATTERN.findall(text.lower())):
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        for j in range(HASHES_PER_WORD):
+            value = int.from_bytes(digest[j * 4:(j + 1) * 4], "little")
+            sign = 1.0 if value & 1 else -1.0
+            vector[(value >> 1) % dimensions] += sign
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Tyst server; benchmarks skriver sina egna resultat
+        pass
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rate_limited(self) -> float:
+        """
+        Glidande 60-sekundersfönster; returnerar sekunder att vänta om gränsen är nådd, annars 0.
+        """
+        rpm = self.server.config["rpm"]
+        if not rpm:
+            return 0.0
+        now = time.monotonic()
+        with self.server.stats_lock:
+            window = self.server.request_times
+            while window and now - window[0] >= 60:
+                window.popleft()
+            if len(window) >= rpm:
+                self.server.stats["rate_limited"] += 1
+                return 60 - (now - window[0])
+            window.append(now)
+        return 0.0
+
+    def do_POST(self):
+        config = self.server.config
+        payload = self._read_json()
+        retry_after = self._rate_limited()
+        if retry_after:
+            body = json.dumps({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}).encode("utf-8")
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Retry-After", f"{retry_after:.2f}")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        with self.server.stats_lock:
+            self.server.stats["requests"] += 1
+        if config["latency"]:
+            time.sleep(config["latency"])
+        if self.path.rstrip("/").endswith("/embeddings"):
+            self._handle_embeddings(payload)
+        elif self.path.rstrip("/").endswith("/chat/completions"):
+            self._handle_chat(payload)
+        else:
+            self._send_json({"error": {"message": f"Okänd endpoint: {self.path}"}}, status=404)
+
+    def _handle_embeddings(self, payload: dict):
+        inputs = payload.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        dimensions = payload.get("dimensions") or self.server.config["dimensions"]
+        with self.server.stats_lock:
+            self.server.stats["inputs"] += len(inputs)
+        data = [
+            {"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+            for i, text in enumerate(inputs)
+        ]
+        n_tokens = sum(len(text.split()) for text in inputs)
+        self._send_json({
+            "object": "list",
+            "data": data,
+            "model": payload.get("model", "text-embedding-3-small"),
+            "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+        })
+
+    def _handle_chat(self, payload: dict):
+        messages = payload.get("messages") or []
+        prompt = "\n".join(str(message.get("content", "")) for message in messages)
+        answer = fake_answer(prompt, payload.get("max_tokens") or 200)
+        if payload.get("stream"):
+            self._stream_chat(payload, answer)
+            return
+        if self.server.config["token_latency"]:
+            # Ett icke-strömmat svar kommer först när alla tokens är genererade
+            time.sleep(self.server.config["token_latency"] * len(answer.split(" ")))
+        prompt_tokens = len(prompt.split())
+        completion_tokens = len(answer.split())
+        self._send_json({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    def _write_chunk(self, data: bytes):
+        # HTTP/1.1 chunked transfer encoding
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_chat(self, payload: dict, answer: str):
+        """
+        Strömmar svaret ord för ord som Server-Sent Events, med 'token_latency' sekunder per ord.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        model = payload.get("model", "gpt-4o")
+        words = answer.split(" ")
+        for i, word in enumerate(words):
+            if self.server.config["token_latency"]:
+                time.sleep(self.server.config["token_latency"])
+            delta = {"role": "assistant", "content": word if i == 0 else " " + word}
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        final = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        self._write_chunk(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            # Som OpenAI: en sista bit utan choices med förbrukningen för hela svaret
+            prompt_tokens = sum(len(m.get("content", "").split()) for m in payload.get("messages", []))
+            usage_chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                          "total_tokens": prompt_tokens + len(words)},
+            }
+            self._write_chunk(f"data: {json.dumps(usage_chunk)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+def fake_answer(prompt: str, max_words: int = 200) -> str:
+    """
+    Deterministiskt "svar": de sista orden i prompten (där frågan står), högst 80 ord.
+    """
+    n_words = max(1, min(max_words, 80))
+    return "Sammanfattning: " + " ".join(prompt.split()[-n_words:])
+
+
+def start_fake_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    latency: float = 0.0,
+    dimensions: int = 1536,
+    token_latency: float = 0.0,
+    rpm: int = 0
+) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Startar servern i en bakgrundstråd och returnerar (server, base_url).
+    port=0 väljer en ledig port automatiskt. Stoppa med server.shutdown().
+    'latency' läggs på varje anrop och 'token_latency' per genererat ord i chat-svar.
+    'rpm' > 0 begränsar antalet anrop per minut (överskjutande anrop får 429).
+    """
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.config = {"latency": latency, "dimensions": dimensions, "token_latency": token_latency, "rpm": rpm}
+    server.stats = {"requests": 0, "inputs": 0, "rate_limited": 0}
+    server.request_times = deque()
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokal fejk-server för OpenAI embeddings och chat.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Fördröjning per anrop i sekunder.")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Fördröjning per genererat ord i sekunder.")
+    parser.add_argument("--rpm", type=int, default=0, help="Max antal anrop per minut (0 = obegränsat).")
+    args = parser.parse_args()
+    server, base_url = start_fake_server(args.host, args.port, args.latency, args.dimensions, args.token_latency, args.rpm)
+    print(f"Fejk-OpenAI lyssnar på {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
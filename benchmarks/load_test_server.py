@@ -0,0 +1,97 @@
+# benchmarks/load_test_server.py
+"""
+Lasttest av gpt_server mot den lokala fejk-OpenAI-servern: ett dokument laddas upp
+via /ingest och sedan skickas många samtidiga /ask-anrop.
+
+    python -m benchmarks.load_test_server --requests 500 --concurrency 100 --latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+from benchmarks.fake_openai_server import start_fake_server
+from benchmarks.synthetic_report import synthetic_report
+
+
+def start_gpt_server(port: int):
+    import uvicorn
+    from gpt_server import app
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def run_load(base_url: str, n_requests: int, concurrency: int, questions):
+    import httpx
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        text, _ = synthetic_report(60)
+        response = await client.post("/ingest", json={"text": text})
+        response.raise_for_status()
+        doc_id = response.json()["doc_id"]
+
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies, errors = [], 0
+
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                reply = await client.post("/ask", params={"doc_id": doc_id}, json={"question": questions[i % len(questions)]})
+                if reply.status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n_requests)))
+        return time.perf_counter() - start, sorted(latencies), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="Fejkad OpenAI-latens per anrop (s).")
+    parser.add_argument("--port", type=int, default=8799)
+    args = parser.parse_args()
+
+    fake, fake_url = start_fake_server(latency=args.latency)
+    os.environ["OPENAI_BASE_URL"] = fake_url
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    workdir = tempfile.TemporaryDirectory()
+    os.environ["EMBEDDING_STORE_PATH"] = os.path.join(workdir.name, "store.sqlite3")
+    os.chdir(workdir.name)
+
+    server = start_gpt_server(args.port)
+    # Unika frågor, så att varje anrop ger ett riktigt embedding- och chat-anrop
+    questions = [f"Vad var rörelseresultatet för segment {i}?" for i in range(args.requests)]
+    seconds, latencies, errors = asyncio.run(
+        run_load(f"http://127.0.0.1:{args.port}", args.requests, args.concurrency, questions)
+    )
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if latencies else 0.0
+
+    print(json.dumps({
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "fake_latency_s": args.latency,
+        "seconds": round(seconds, 2),
+        "requests_per_s": round(args.requests / seconds, 1),
+        "p50_s": percentile(0.5),
+        "p95_s": percentile(0.95),
+        "errors": errors,
+    }, indent=2))
+    server.should_exit = True
+    fake.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+# benchmarks/run_suite.py
+"""
+Samlad, helt offline benchmark-svit mot den lokala fejk-OpenAI-servern:
+extraktion (PDF/HTML/XLSX), chunking, embedding-ingest, cache-laddning,
+söklatens mot korpusstorlek och fråga-till-svar från början till slut.
+Resultatet skrivs som JSON så att körningar kan jämföras.
+
+    python -m benchmarks.run_suite --output results/baseline.json
+    python -m benchmarks.run_suite --quick --output results/ny.json --compare results/baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks.fake_openai_server import start_fake_server
+from benchmarks.synthetic_report import synthetic_report
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class NamedBytesIO(io.BytesIO):
+    """
+    Filobjekt i minnet med .name, som Streamlits UploadedFile.
+    """
+
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+
+
+def _timed(fn, repeat: int = 1):
+    """
+    Kör fn 'repeat' gånger och returnerar (median i sekunder, senaste resultat).
+    """
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def _percentiles(samples) -> dict:
+    ordered = sorted(samples)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+    return {"p50_ms": round(pick(0.5) * 1000, 3), "p95_ms": round(pick(0.95) * 1000, 3)}
+
+
+def synthetic_html(text: str) -> bytes:
+    body = []
+    for block in text.split("\n\n"):
+        lines = block.strip().splitlines()
+        if lines:
+            body.append(f"<h2>{lines[0]}</h2>" + "".join(f"<p>{line}</p>" for line in lines[1:]))
+    html = "<html><head><style>p {}</style><script>var x = 1;</script></head><body><nav>Meny</nav>"
+    return (html + "".join(body) + "<footer>Sidfot</footer></body></html>").encode("utf-8")
+
+
+def synthetic_xlsx(rows: int, sheets: int = 3) -> bytes:
+    from openpyxl import Workbook
+    workbook = Workbook()
+    for s in range(sheets):
+        sheet = workbook.active if s == 0 else workbook.create_sheet()
+        sheet.title = f"Flik {s + 1}"
+        sheet.append(["Post", "2024", "2023", "Förändring %"])
+        for r in range(rows):
+            sheet.append([f"Nyckeltal {r}", r * 13 % 9973, r * 7 % 9973, round((r % 17 - 8) / 3, 2)])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def bench_extraction(args) -> dict:
+    from benchmarks.bench_pdf_extraction import synthetic_pdf
+    from core.file_processing import extract_text_from_file
+
+    text, _ = synthetic_report(args.sections)
+    results = {}
+    inputs = {
+        "pdf": (synthetic_pdf(args.pdf_pages), "rapport.pdf", {"pages": args.pdf_pages}),
+        "html": (synthetic_html(text), "rapport.html", {}),
+        "xlsx": (synthetic_xlsx(args.xlsx_rows), "rapport.xlsx", {"rows": 3 * args.xlsx_rows}),
+    }
+    for kind, (data, name, extra) in inputs.items():
+        seconds, extracted = _timed(lambda: extract_text_from_file(NamedBytesIO(data, name)), args.repeat)
+        results[kind] = dict(extra, input_bytes=len(data), characters=len(extracted), seconds=round(seconds, 4))
+    return results
+
+
+def bench_chunking(text: str, args) -> dict:
+    from core.chunking import chunk_text, iter_token_chunks
+
+    char_seconds, char_chunks = _timed(lambda: chunk_text(text), args.repeat)
+    token_seconds, spans = _timed(lambda: list(iter_token_chunks(text)), args.repeat)
+    return {
+        "characters": len(text),
+        "chunk_text": {"chunks": len(char_chunks), "seconds": round(char_seconds, 4)},
+        "iter_token_chunks": {"chunks": len(spans), "seconds": round(token_seconds, 4)},
+    }
+
+
+def bench_key_figures(text: str, args) -> dict:
+    from core.key_figures import FactIndex
+
+    seconds, index = _timed(lambda: FactIndex.from_text(text), args.repeat)
+    questions = ["Vad var rörelseresultatet 2024?", "Vad blev utdelningen per aktie?", "Hur stor var nettoomsättningen?"]
+    samples = []
+    for i in range(args.queries):
+        start = time.perf_counter()
+        index.lookup(questions[i % len(questions)])
+        samples.append(time.perf_counter() - start)
+    return {
+        "characters": len(text),
+        "facts": len(index),
+        "extract_seconds": round(seconds, 4),
+        "lookup": _percentiles(samples),
+    }
+
+
+def bench_ingest(chunks, server, args) -> dict:
+    from core.embedding_utils import get_embeddings_batch
+
+    requests_before = server.stats["requests"]
+    cold_seconds, embeddings = _timed(lambda: get_embeddings_batch(chunks))
+    cold_requests = server.stats["requests"] - requests_before
+    requests_before = server.stats["requests"]
+    warm_seconds, _ = _timed(lambda: get_embeddings_batch(chunks))
+    return {
+        "chunks": len(chunks),
+        "cold_seconds": round(cold_seconds, 3),
+        "cold_chunks_per_s": round(len(chunks) / cold_seconds, 1),
+        "cold_requests": cold_requests,
+        "warm_seconds": round(warm_seconds, 4),
+        "warm_requests": server.stats["requests"] - requests_before,
+    }, embeddings
+
+
+def bench_cache_load(chunks, embeddings, workdir: str, args) -> dict:
+    from core.retrieval import DocumentIndex
+    from utils.cache_utils import load_embeddings_if_exists, open_document_cache, save_document_cache, save_embeddings
+
+    cache_dir = os.path.join(workdir, "doc_cache")
+    save_seconds, _ = _timed(lambda: save_document_cache(cache_dir, chunks, embeddings, model="fake"))
+    open_seconds, _ = _timed(lambda: DocumentIndex.from_cached_document(open_document_cache(cache_dir)), args.repeat)
+    # Det gamla pickle-formatet som jämförelse
+    pickle_path = os.path.join(workdir, "legacy.pkl")
+    save_embeddings(pickle_path, [{"text": chunk, "embedding": embedding} for chunk, embedding in zip(chunks, embeddings)])
+
+    def load_pickle():
+        return DocumentIndex.from_embedded_chunks(load_embeddings_if_exists(pickle_path))
+
+    pickle_seconds, _ = _timed(load_pickle, args.repeat)
+    return {
+        "chunks": len(chunks),
+        "save_seconds": round(save_seconds, 4),
+        "open_binary_seconds": round(open_seconds, 4),
+        "load_pickle_seconds": round(pickle_seconds, 4),
+    }
+
+
+def bench_retrieval(args) -> dict:
+    from core.retrieval import DocumentIndex, rank_chunks
+
+    rng = np.random.default_rng(0)
+    results = {}
+    for size in args.corpus_sizes:
+        vectors = rng.standard_normal((size, args.dimensions), dtype=np.float32)
+        texts = [f"chunk {i} rörelseresultat utdelning" for i in range(size)]
+        index = DocumentIndex(texts, vectors)
+        index.ensure_lexical()
+        queries = rng.standard_normal((args.queries, args.dimensions), dtype=np.float32)
+        results[str(size)] = {}
+        for mode in ("vector", "hybrid"):
+            samples = []
+            for query in queries:
+                start = time.perf_counter()
+                rank_chunks(index, query, "utdelning per aktie", top_k=7, mode=mode)
+                samples.append(time.perf_counter() - start)
+            results[str(size)][mode] = _percentiles(samples)
+    return results
+
+
+def bench_end_to_end(text: str, facts, args) -> dict:
+    from core.chunking import iter_token_chunks
+    from core.embedding_utils import get_embeddings_batch
+    from core.gpt_logic import generate_gpt_answer, search_relevant_chunks, stream_gpt_answer
+    from core.retrieval import DocumentIndex
+
+    chunks = [text[span.start:span.end] for span in iter_token_chunks(text)]
+    index = DocumentIndex(chunks, np.asarray(get_embeddings_batch(chunks), dtype=np.float32))
+    questions = [question for question, _ in facts][:args.questions]
+    # Träffgrad per sökläge (utan GPT-anrop)
+    hit_rates = {}
+    for mode in ("vector", "lexical", "hybrid"):
+        found = sum(fact in search_relevant_chunks(question, index, mode=mode)[0] for question, fact in facts[:args.questions])
+        hit_rates[mode] = round(found / max(len(questions), 1), 3)
+    blocking, ttft, hits = [], [], 0
+    for i, question in enumerate(questions):
+        start = time.perf_counter()
+        context, _ = search_relevant_chunks(question, index)
+        if i % 2 == 0:
+            generate_gpt_answer(question, context)
+            blocking.append(time.perf_counter() - start)
+        else:
+            for n, _ in enumerate(stream_gpt_answer(question, context)):
+                if n == 0:
+                    ttft.append(time.perf_counter() - start)
+        hits += facts[i][1] in context
+    return {
+        "questions": len(questions),
+        "ask_blocking": _percentiles(blocking) if blocking else None,
+        "ask_stream_ttft": _percentiles(ttft) if ttft else None,
+        "retrieval_hit_rate": round(hits / max(len(questions), 1), 3),
+        "retrieval_hit_rate_by_mode": hit_rates,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _flatten(data, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in (data or {}).items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(previous: dict, current: dict) -> dict:
+    """
+    Jämför tidsmått (…seconds, …_s, …_ms) mellan två körningar: kvot nu/tidigare (<1 är snabbare).
+    """
+    old, new = _flatten(previous.get("results")), _flatten(current.get("results"))
+    ratios = {}
+    for name, value in new.items():
+        is_time = name.endswith(("seconds", "_s", "_ms"))
+        if is_time and old.get(name):
+            ratios[name] = round(value / old[name], 3)
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Mindre storlekar för en snabb kontroll.")
+    parser.add_argument("--sections", type=int, default=300, help="Storlek på den syntetiska rapporten.")
+    parser.add_argument("--pdf-pages", type=int, default=100)
+    parser.add_argument("--xlsx-rows", type=int, default=2000, help="Rader per flik (tre flikar).")
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[1_000, 10_000, 50_000])
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05, help="Fejkad latens per API-anrop (s).")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="Fejkad latens per genererat ord (s).")
+    parser.add_argument("--rpm", type=int, default=0, help="Fejkad gräns för anrop per minut (0 = ingen).")
+    parser.add_argument("--only", nargs="+", default=None,
+                        choices=["extraction", "chunking", "key_figures", "ingest", "cache_load", "retrieval", "end_to_end"])
+    parser.add_argument("--output", default=None, help="Skriv resultatet som JSON till denna fil.")
+    parser.add_argument("--compare", default=None, help="Tidigare resultatfil att jämföra med.")
+    args = parser.parse_args()
+    if args.quick:
+        args.sections, args.pdf_pages, args.xlsx_rows = 60, 20, 300
+        args.corpus_sizes, args.queries, args.questions, args.repeat = [1_000, 10_000], 20, 6, 1
+
+    workdir = tempfile.TemporaryDirectory()
+    server, base_url = start_fake_server(latency=args.latency, token_latency=args.token_latency, rpm=args.rpm)
+    # Allt går mot fejk-servern och tomma cacher i en temporär katalog
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    os.environ["EMBEDDING_STORE_PATH"] = os.path.join(workdir.name, "store.sqlite3")
+    os.environ["ANSWER_CACHE_PATH"] = os.path.join(workdir.name, "answers.sqlite3")
+
+    selected = set(args.only or ["extraction", "chunking", "key_figures", "ingest", "cache_load", "retrieval", "end_to_end"])
+    text, facts = synthetic_report(args.sections)
+    results = {}
+    if "extraction" in selected:
+        results["extraction"] = bench_extraction(args)
+    if "chunking" in selected:
+        results["chunking"] = bench_chunking(text, args)
+    if "key_figures" in selected:
+        results["key_figures"] = bench_key_figures(text, args)
+    if selected & {"ingest", "cache_load"}:
+        from core.chunking import iter_token_chunks
+        chunks = [text[span.start:span.end] for span in iter_token_chunks(text)]
+        results["ingest"], embeddings = bench_ingest(chunks, server, args)
+        if "cache_load" in selected:
+            results["cache_load"] = bench_cache_load(chunks, embeddings, workdir.name, args)
+    if "retrieval" in selected:
+        results["retrieval"] = bench_retrieval(args)
+    if "end_to_end" in selected:
+        results["end_to_end"] = bench_end_to_end(text, facts, args)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+            "fake_server": dict(server.stats),
+        },
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            report["compare_ratio"] = compare(json.load(f), report)
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    server.shutdown()
+    workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# benchmarks/synthetic_report.py
+"""
+Syntetiska, rapportliknande dokument för benchmarks: rubriker, stycken och
+nyckeltalstabeller, med inplanterade fakta som frågor kan ställas om.
+"""
+import random
+from typing import List, Tuple
+
+SECTIONS = [
+    "Förvaltningsberättelse", "Väsentliga händelser", "Risker och osäkerhetsfaktorer",
+    "Hållbarhetsrapport", "Bolagsstyrning", "Finansiell ställning", "Kassaflöde",
+    "Medarbetare", "Marknadsutveckling", "Framtidsutsikter",
+]
+FILLER = [
+    "Koncernen fortsatte att utvecklas i linje med den långsiktiga strategin.",
+    "Efterfrågan var stabil på de flesta marknader under perioden.",
+    "Investeringarna i digitalisering och effektivisering fortsatte.",
+    "Styrelsen bedömer att den finansiella ställningen är god.",
+    "Valutaeffekter påverkade jämförelsen med föregående år.",
+    "Arbetet med att minska koldioxidutsläppen i värdekedjan intensifierades.",
+    "Personalomsättningen var fortsatt låg och medarbetarnöjdheten hög.",
+    "Råvarupriserna var volatila, vilket påverkade bruttomarginalen.",
+]
+
+
+def _pseudo_word(rng: random.Random) -> str:
+    consonants, vowels = "bdfghjklmnprstv", "aeiouyåäö"
+    return "".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(rng.randint(2, 4)))
+
+
+def synthetic_report(n_sections: int = 120, seed: int = 0) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Returnerar (text, [(fråga, svarsfras), ...]). Varje svarsfras förekommer exakt en gång i texten.
+    """
+    rng = random.Random(seed)
+    parts, facts = [], []
+    for s in range(n_sections):
+        title = f"{s + 1}. {SECTIONS[s % len(SECTIONS)]}"
+        parts.append(title + "\n")
+        for _ in range(rng.randint(2, 5)):
+            sentences = [rng.choice(FILLER) for _ in range(rng.randint(3, 8))]
+            if rng.random() < 0.3:
+                # Tre unika påhittade ord gör att frågan och faktan delar en tydlig signal
+                segment = " ".join(_pseudo_word(rng) for _ in range(3)).title()
+                value = rng.randint(100, 9999)
+                sentences.insert(rng.randint(0, len(sentences)), f"Rörelseresultatet för {segment} uppgick till {value} MSEK.")
+                facts.append((f"Vad var rörelseresultatet för {segment}?", f"{segment} uppgick till {value} MSEK"))
+            parts.append(" ".join(sentences) + "\n\n")
+        if s % 4 == 0:
+            parts.append("NYCKELTAL\n")
+            for metric in ("Nettoomsättning", "Rörelseresultat", "Resultat per aktie", "Utdelning per aktie"):
+                parts.append(f"{metric}    {rng.randint(10, 99999):,}    {rng.randint(10, 99999):,}\n".replace(",", " "))
+            parts.append("\n")
+    return "".join(parts), facts
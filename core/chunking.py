@@ -1,5 +1,46 @@
 # core/chunking.py
 
+import re
+import zlib
+import hashlib
+from typing import Iterable, Iterator, List, NamedTuple, Tuple
+
+from utils.embedding_store import normalize_chunk_text
+from utils.token_utils import count_tokens
+
+DEFAULT_MAX_TOKENS = 400
+# Innehållsstyrda gränser (iter_content_defined_chunks): minsta och genomsnittliga chunkstorlek
+DEFAULT_MIN_TOKENS = 100
+DEFAULT_AVG_TOKENS = 260
+# Antal tecken före en möjlig gräns som avgör om den blir en gräns
+CDC_WINDOW = 64
+
+_LINE_PATTERN = re.compile(r"[^\n]*\n|[^\n]+$")
+_SENTENCE_PATTERN = re.compile(r"[^.!?\n]*(?:[.!?]+|\n|$)\s*")
+_WORD_PATTERN = re.compile(r"\S+\s*")
+_NUMBERED_HEADING = re.compile(r"^(\d+(\.\d+)*\.?|[IVX]+\.)\s+\w")
+_NUMBER = re.compile(r"-?\d[\d\s]*(?:[.,]\d+)?")
+_COLUMN_GAP = re.compile(r"\t| {2,}")
+# Radgruppsrubriker från core.spreadsheet: "## Resultat (rad 1–20)"
+_ROW_GROUP_HEADING = re.compile(r"^## .+ \(rad \d+–\d+\)\s*$")
+
+
+class ChunkSpan(NamedTuple):
+    """
+    En chunk som offset i källtexten: text[start:end], med antal tokens.
+    """
+    start: int
+    end: int
+    n_tokens: int
+
+
+class _Unit(NamedTuple):
+    start: int
+    end: int
+    kind: str
+    n_tokens: int
+
+
 def chunk_text(text: str, max_length: int = 1500, overlap: int = 200) -> list:
     """
     Delar upp en lång text i mindre delar (chunks) med överlappning.
@@ -20,3 +61,331 @@ def chunk_text(text: str, max_length: int = 1500, overlap: int = 200) -> list:
         chunks.append(chunk)
         start += max_length - overlap
     return chunks
+
+
+def _classify_line(line: str) -> str:
+    stripped = line.strip()
+    if not stripped:
+        return "blank"
+    if stripped.startswith("#"):
+        return "heading"
+    if len(stripped) < 80 and not stripped.endswith((".", ",", ";", ":")):
+        letters = [c for c in stripped if c.isalpha()]
+        if _NUMBERED_HEADING.match(stripped) and len(_NUMBER.findall(stripped)) <= 1:
+            return "heading"
+        if len(letters) >= 3 and all(c.isupper() for c in letters):
+            return "heading"
+    if _COLUMN_GAP.search(stripped) or (len(stripped) < 200 and len(_NUMBER.findall(stripped)) >= 2):
+        return "row"
+    return "text"
+
+
+def _iter_units(text: str, model: str, continuation: bool = False) -> Iterator[_Unit]:
+    """
+    Delar texten i strukturella enheter: rubriker, stycken och tabellrader.
+    Tomrader räknas till föregående enhet, så att enheterna täcker texten utan
+    luckor och summan av deras tokens motsvarar chunkens. Varje enhet tokeniseras
+    exakt en gång. Med 'continuation' är texten fortsättningen på ett stycke och
+    första raden räknas som brödtext.
+    """
+    open_unit = None  # [start, end, kind, stängd]
+
+    def flush():
+        start, end, kind, _ = open_unit
+        return _Unit(start, end, kind, count_tokens(text[start:end], model))
+
+    for match in _LINE_PATTERN.finditer(text):
+        kind = _classify_line(match.group())
+        if continuation:
+            kind = "text" if kind != "blank" else kind
+            continuation = False
+        if kind == "blank":
+            if open_unit is not None:
+                open_unit[1] = match.end()
+                open_unit[3] = True
+            continue
+        if kind == "text" and open_unit is not None and open_unit[2] == "paragraph" and not open_unit[3]:
+            open_unit[1] = match.end()
+            continue
+        if open_unit is not None:
+            yield flush()
+        unit_kind = "paragraph" if kind == "text" else kind
+        # Rubriker och tabellrader är alltid egna enheter
+        open_unit = [match.start(), match.end(), unit_kind, unit_kind != "paragraph"]
+    if open_unit is not None:
+        yield flush()
+
+
+def _iter_blocks(text: str, model: str, continuation: bool = False) -> Iterator[_Unit]:
+    """
+    Som _iter_units, men en radgrupp ur ett kalkylblad (rubrik, kolumnrubriker och rader
+    fram till nästa rubrik) blir en enda enhet av typen "table", så att rubrik och
+    kolumnnamn aldrig skiljs från siffrorna. core.spreadsheet håller grupperna inom chunkbudgeten.
+    """
+    group = None  # [start, end, n_tokens]
+    for unit in _iter_units(text, model, continuation):
+        if group is not None:
+            if unit.kind != "heading":
+                group[1] = unit.end
+                group[2] += unit.n_tokens
+                continue
+            yield _Unit(group[0], group[1], "table", group[2])
+            group = None
+        if unit.kind == "heading" and _ROW_GROUP_HEADING.match(text[unit.start:unit.end]):
+            group = [unit.start, unit.end, unit.n_tokens]
+        else:
+            yield unit
+    if group is not None:
+        yield _Unit(group[0], group[1], "table", group[2])
+
+
+def _split_unit(text: str, unit: _Unit, max_tokens: int, model: str) -> Iterator[_Unit]:
+    """
+    Delar en för stor enhet i meningar, och meningar som ändå är för stora i ord.
+    """
+    for sentence in _SENTENCE_PATTERN.finditer(text, unit.start, unit.end):
+        if sentence.start() == sentence.end():
+            continue
+        n_tokens = count_tokens(sentence.group(), model)
+        if n_tokens <= max_tokens:
+            yield _Unit(sentence.start(), sentence.end(), "sentence", n_tokens)
+            continue
+        for word in _WORD_PATTERN.finditer(text, sentence.start(), sentence.end()):
+            yield _Unit(word.start(), word.end(), "word", count_tokens(word.group(), model))
+
+
+def iter_token_chunks(
+    text: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    overlap_tokens: int = 0,
+    model: str = "text-embedding-3-small",
+    split_on_headings: bool = True
+) -> Iterator[ChunkSpan]:
+    """
+    Token- och strukturmedveten chunking som generator, i linjär tid över dokumentet.
+
+    Texten delas i rubriker, stycken och tabellrader som packas girigt upp till
+    'max_tokens'. En rubrik startar alltid en ny chunk (om den nuvarande har
+    annat innehåll än rubriker), så att avsnitt hålls ihop och inte blandas. Enheter som är större än budgeten
+    delas i meningar och vid behov i ord. Inga strängar kopieras; chunkarna
+    returneras som offsets i källtexten.
+
+    Args:
+        text (str): Källtexten.
+        max_tokens (int): Max antal tokens per chunk.
+        overlap_tokens (int): Upp till så många tokens från slutet av föregående
+            chunk (hela enheter) upprepas i början av nästa.
+        model (str): Modell vars tokenizer används.
+        split_on_headings (bool): False packar över rubriker (t.ex. för stora
+            analysavsnitt), men delar fortfarande bara vid enhetsgränser.
+
+    Yields:
+        ChunkSpan: (start, end, n_tokens) för varje chunk.
+    """
+    current: List[_Unit] = []
+    current_tokens = 0
+
+    def units():
+        for unit in _iter_units(text, model):
+            if unit.n_tokens > max_tokens:
+                yield from _split_unit(text, unit, max_tokens, model)
+            else:
+                yield unit
+
+    def emit():
+        start, end = current[0].start, current[-1].end
+        return ChunkSpan(start, end, count_tokens(text[start:end], model))
+
+    for unit in units():
+        starts_section = split_on_headings and unit.kind == "heading" and any(u.kind != "heading" for u in current)
+        if current and (current_tokens + unit.n_tokens > max_tokens or starts_section):
+            yield emit()
+            # Behåll avslutande enheter som överlapp, men aldrig en rubrik som nästa avsnitt inte hör till
+            carried: List[_Unit] = []
+            carried_tokens = 0
+            if not starts_section:
+                for previous in reversed(current):
+                    if carried_tokens + previous.n_tokens > overlap_tokens or \
+                            carried_tokens + previous.n_tokens + unit.n_tokens > max_tokens:
+                        break
+                    carried.insert(0, previous)
+                    carried_tokens += previous.n_tokens
+            current, current_tokens = carried, carried_tokens
+        current.append(unit)
+        current_tokens += unit.n_tokens
+    if current:
+        yield emit()
+
+
+def chunk_text_tokens(
+    text: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    overlap_tokens: int = 0,
+    model: str = "text-embedding-3-small"
+) -> List[str]:
+    """
+    Som iter_token_chunks, men returnerar chunkarnas texter (samma format som chunk_text).
+    """
+    return [text[span.start:span.end] for span in iter_token_chunks(text, max_tokens, overlap_tokens, model)]
+
+
+def chunk_hash(text: str) -> str:
+    """
+    Innehållshash för en chunk (blake2b av texten med normaliserat blanksteg).
+    Samma text ger samma hash oavsett dokument, filnamn eller position.
+    """
+    return hashlib.blake2b(normalize_chunk_text(text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _is_cut_point(text: str, unit: _Unit, divisor: int) -> bool:
+    # Hashen över fönstret före gränsen beror bara på den lokala texten, inte på var i
+    # dokumentet den står. Sannolikheten för en gräns växer med enhetens storlek, så att
+    # chunkarna i snitt blir ungefär min_tokens + divisor tokens.
+    window = normalize_chunk_text(text[max(unit.start, unit.end - CDC_WINDOW):unit.end])
+    return zlib.crc32(window.encode("utf-8")) % divisor < unit.n_tokens
+
+
+class _CdcChunk(NamedTuple):
+    span: ChunkSpan
+    hold_from: int  # som sista chunk: senare chunks än de som slutar före denna offset kan ändras
+    resume: str     # "unit" (slutar vid en enhetsgräns), "sentence" (vid en mening i ett delat stycke) eller ""
+
+
+# Ett växande stycke räknas som säkert delat först en bit över max_tokens, eftersom
+# tokenantalet för text som läggs till efter en radbrytning inte är exakt additivt
+_SPLIT_MARGIN_TOKENS = 16
+
+
+def _iter_cdc(
+    text: str,
+    max_tokens: int,
+    min_tokens: int,
+    avg_tokens: int,
+    model: str,
+    continuation: bool = False
+) -> Iterator[_CdcChunk]:
+    """
+    Kärnan i iter_content_defined_chunks. Med 'continuation' börjar texten mitt i ett
+    stycke som delats i meningar (se iter_streaming_chunks) och det delas även här.
+    """
+    divisor = max(1, avg_tokens - min_tokens)
+    current: List[Tuple[_Unit, int, str]] = []
+    current_tokens = 0
+
+    def emit():
+        start, end = current[0][0].start, current[-1][0].end
+        _, hold_from, resume = current[-1]
+        return _CdcChunk(ChunkSpan(start, end, count_tokens(text[start:end], model)), hold_from, resume)
+
+    for unit in _iter_blocks(text, model, continuation):
+        forced = continuation and unit.kind == "paragraph"
+        continuation = False
+        # Radgrupper delas aldrig (se _iter_blocks)
+        split = forced or (unit.n_tokens > max_tokens and unit.kind != "table")
+        parts = list(_split_unit(text, unit, max_tokens, model)) if split else [unit]
+        # I ett stycke som säkert förblir delat beror gränserna bara på meningarna fram till gränsen
+        settled = split and (forced or unit.n_tokens > max_tokens + _SPLIT_MARGIN_TOKENS)
+        for i, part in enumerate(parts):
+            starts_section = part.kind in ("heading", "table") and any(u.kind != "heading" for u, _, _ in current)
+            if current and (current_tokens + part.n_tokens > max_tokens or starts_section):
+                yield emit()
+                current, current_tokens = [], 0
+            # Bara stycken kan fortsätta över flera rader; en delad rubrik eller tabellrad chunkas om i sin helhet
+            resume = "unit" if i == len(parts) - 1 else "sentence" if part.kind == "sentence" and unit.kind == "paragraph" else ""
+            current.append((part, part.start if settled else unit.start, resume))
+            current_tokens += part.n_tokens
+            if part.kind != "heading" and current_tokens >= min_tokens and _is_cut_point(text, part, divisor):
+                yield emit()
+                current, current_tokens = [], 0
+    if current:
+        yield emit()
+
+
+def iter_content_defined_chunks(
+    text: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    min_tokens: int = DEFAULT_MIN_TOKENS,
+    avg_tokens: int = DEFAULT_AVG_TOKENS,
+    model: str = "text-embedding-3-small"
+) -> Iterator[ChunkSpan]:
+    """
+    Chunking med innehållsstyrda gränser (content-defined chunking) över samma
+    strukturella enheter som iter_token_chunks. En radgrupp ur ett kalkylblad är en
+    odelbar enhet och börjar alltid en ny chunk.
+
+    Om en chunk ska sluta efter en enhet avgörs av en hash över texten närmast
+    före gränsen, inte av hur mycket text som packats sedan dokumentets början.
+    En ändring i en reviderad rapport (ett nytt stycke, ett rättat belopp) påverkar
+    därför bara chunkarna runt ändringen; efter nästa innehållsstyrda gräns eller
+    rubrik blir chunkarna identiska med föregående versions, och deras embeddings
+    kan återanvändas (se core.ingestion.ingest_document).
+
+    Args:
+        text (str): Källtexten.
+        max_tokens (int): Max antal tokens per chunk (gränsen tvingas fram här).
+        min_tokens (int): Ingen innehållsstyrd gräns före så många tokens.
+        avg_tokens (int): Ungefärlig genomsnittlig chunkstorlek.
+        model (str): Modell vars tokenizer används.
+
+    Yields:
+        ChunkSpan: (start, end, n_tokens) för varje chunk.
+    """
+    for chunk in _iter_cdc(text, max_tokens, min_tokens, avg_tokens, model):
+        yield chunk.span
+
+
+def iter_streaming_chunks(
+    pieces: Iterable[str],
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    min_tokens: int = DEFAULT_MIN_TOKENS,
+    avg_tokens: int = DEFAULT_AVG_TOKENS,
+    model: str = "text-embedding-3-small"
+) -> Iterator[Tuple[ChunkSpan, str]]:
+    """
+    Samma chunkar som iter_content_defined_chunks("".join(pieces)), men de ges allteftersom
+    texten kommer (t.ex. sida för sida från core.file_processing.iter_pdf_text), så att
+    embedding kan börja innan hela dokumentet är extraherat.
+
+    Bara hela rader chunkas, och chunkarna från den sista (ännu växande) enheten och
+    chunken före den hålls kvar tills mer text kommit: en gräns före en enhet beror på
+    enhetens storlek. I ett långt stycke utan tomrader (vanligt i PDF-text) är det i
+    stället bara den sista meningen som hålls kvar. Chunkningen fortsätter efter den
+    senaste utgivna chunk som slutar vid en enhets- eller meningsgräns, med vetskap om
+    att den börjar mitt i ett delat stycke, så att varje del av texten bara chunkas om
+    ett begränsat antal gånger.
+
+    Yields:
+        (ChunkSpan, text): offsets i den sammanfogade texten och chunkens text.
+    """
+    buffer = ""
+    base = 0  # buffertens offset i den sammanfogade texten
+    continuation = False  # bufferten börjar mitt i ett stycke som delats i meningar
+
+    def shifted(chunk: _CdcChunk) -> Tuple[ChunkSpan, str]:
+        span = chunk.span
+        return ChunkSpan(base + span.start, base + span.end, span.n_tokens), buffer[span.start:span.end]
+
+    for piece in pieces:
+        buffer += piece
+        complete = buffer.rfind("\n") + 1
+        if not complete:
+            continue
+        chunks = list(_iter_cdc(buffer[:complete], max_tokens, min_tokens, avg_tokens, model, continuation))
+        if not chunks:
+            continue
+        hold_from = chunks[-1].hold_from
+        ready, restart, resume = 0, 0, ""
+        for i, chunk in enumerate(chunks):
+            if chunk.span.end >= hold_from:
+                break
+            if chunk.resume:
+                ready, restart, resume = i + 1, chunk.span.end, chunk.resume
+        if not ready:
+            continue
+        for chunk in chunks[:ready]:
+            yield shifted(chunk)
+        buffer = buffer[restart:]
+        base += restart
+        continuation = resume == "sentence"
+    for chunk in _iter_cdc(buffer, max_tokens, min_tokens, avg_tokens, model, continuation):
+        yield shifted(chunk)
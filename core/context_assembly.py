@@ -0,0 +1,192 @@
+# core/context_assembly.py
+"""
+Bygger kontexten till GPT ur de rankade chunkarna, inom en tokenbudget.
+
+1. Träffar som överlappar eller ligger kant i kant i källtexten slås ihop till ett
+   sammanhängande textavsnitt: med chunkarnas offsets (spans.npy i dokumentcachen), och
+   annars för på varandra följande chunks vars text överlappar (chunk_text:s 200 tecken).
+2. Avsnitt som nästan helt upprepar ett bättre rankat avsnitt (samma tabell eller
+   standardtext på två ställen) tas bort.
+3. Avsnitten packas girigt i poängordning tills budgeten är fylld; ett avsnitt som inte
+   ryms hoppas över till förmån för mindre. Ryms inte ens det bästa kortas det.
+
+Resultatet redovisar hur många tokens som sparades mot att skarva ihop träffarna rakt av.
+"""
+import os
+import re
+from typing import List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from utils.metrics import inc
+from utils.token_utils import count_tokens, truncate_to_tokens
+
+CONTEXT_SEPARATOR = "\n---\n"
+# Tokenbudget för kontexten (0 = ingen gräns)
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Andel av ett avsnitts ordtripletter som får finnas i ett redan valt avsnitt
+NEAR_DUPLICATE_THRESHOLD = 0.9
+SHINGLE_SIZE = 3
+# Längsta textöverlapp som letas efter mellan på varandra följande chunks utan offsets
+MAX_TEXT_OVERLAP = 1000
+# Tokens räknas med svarsmodellens kodning
+CONTEXT_MODEL = "gpt-4o"
+
+_WORD = re.compile(r"\w+")
+
+
+class ContextSpan(NamedTuple):
+    score: float             # bästa poängen bland avsnittets chunks
+    text: str
+    chunks: Tuple[int, ...]  # chunkindex i dokumentordning
+
+
+class AssembledContext(NamedTuple):
+    text: str
+    spans: List[ContextSpan]   # i poängordning, som i kontexten
+    tokens: int                # kontextens tokens
+    raw_tokens: int            # tokens om träffarna skarvats ihop rakt av
+    hits: int                  # antal rankade chunks
+    merged: int                # chunks som slagits ihop med en granne
+    duplicates: int            # avsnitt borttagna som nästan-dubbletter
+    over_budget: int           # avsnitt som inte rymdes i budgeten
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.raw_tokens - self.tokens
+
+    @property
+    def sources(self) -> List[Tuple[float, str]]:
+        """
+        (poäng, text) per avsnitt, i samma format som rank_chunks.
+        """
+        return [(span.score, span.text) for span in self.spans]
+
+
+def _text_overlap(left: str, right: str, max_overlap: int = MAX_TEXT_OVERLAP) -> int:
+    """
+    Längden på det längsta slutet av 'left' som också är början på 'right'.
+    """
+    limit = min(len(left), len(right) - 1, max_overlap)
+    probe = right[:min(32, limit)]
+    if not probe:
+        return 0
+    start = len(left) - limit
+    while True:
+        position = left.find(probe, start)
+        if position < 0:
+            return 0
+        if right.startswith(left[position:]):
+            return len(left) - position
+        start = position + 1
+
+
+def merge_hits(
+    texts: Sequence[str],
+    hits: Sequence[Tuple[int, float]],
+    spans: Optional[np.ndarray] = None
+) -> List[ContextSpan]:
+    """
+    Slår ihop träffar (chunkindex, poäng) som överlappar eller gränsar till varandra i
+    källtexten. Returnerar avsnitten sorterade efter poäng, bästa först.
+    """
+    merged: List[ContextSpan] = []
+    current_end = None
+    for i, score in sorted(hits, key=lambda hit: (spans[hit[0]][0], hit[0]) if spans is not None else hit[0]):
+        text = texts[i]
+        previous = merged[-1] if merged else None
+        joined = None
+        if previous is not None and spans is not None:
+            start, end = (int(value) for value in spans[i])
+            # Chunkarna är exakta utdrag ur källtexten, så överlappet kan skäras bort via offsets
+            if start <= current_end and end - start == len(text):
+                joined = previous.text + text[current_end - start:] if end > current_end else previous.text
+                end = max(end, current_end)
+        elif previous is not None and previous.chunks[-1] == i - 1:
+            overlap = _text_overlap(previous.text, text)
+            if overlap:
+                joined = previous.text + text[overlap:]
+        if joined is not None:
+            merged[-1] = ContextSpan(max(previous.score, score), joined, previous.chunks + (i,))
+        else:
+            merged.append(ContextSpan(score, text, (i,)))
+        if spans is not None:
+            current_end = end if joined is not None else int(spans[i][1])
+    return sorted(merged, key=lambda span: -span.score)
+
+
+def _shingles(text: str) -> Set[Tuple[str, ...]]:
+    words = _WORD.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def drop_near_duplicates(spans: Sequence[ContextSpan], threshold: float = NEAR_DUPLICATE_THRESHOLD) -> List[ContextSpan]:
+    """
+    Behåller avsnitten i ordning men hoppar över dem vars ordtripletter till minst
+    'threshold' redan finns i ett tidigare (bättre rankat) avsnitt.
+    """
+    kept, kept_shingles = [], []
+    for span in spans:
+        shingles = _shingles(span.text)
+        if any(len(shingles & other) >= threshold * len(shingles) for other in kept_shingles):
+            continue
+        kept.append(span)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def assemble_context(
+    texts: Sequence[str],
+    hits: Sequence[Tuple[int, float]],
+    spans: Optional[np.ndarray] = None,
+    token_budget: Optional[int] = None,
+    model: str = CONTEXT_MODEL
+) -> AssembledContext:
+    """
+    Bygger kontexten ur rankade träffar (chunkindex, poäng), bästa först.
+
+    Args:
+        texts (Sequence[str]): Dokumentets chunktexter.
+        hits (Sequence[Tuple[int, float]]): Träffarna från rank_chunk_indices.
+        spans (np.ndarray): Chunkarnas (start, end) i källtexten, om de är kända.
+        token_budget (int): Max antal tokens i kontexten (standard: CONTEXT_TOKEN_BUDGET, 0 = ingen gräns).
+        model (str): Modellen vars kodning tokens räknas med.
+    """
+    budget = DEFAULT_CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    raw_tokens = count_tokens(CONTEXT_SEPARATOR.join(texts[i] for i, _ in hits), model) if hits else 0
+    merged = merge_hits(texts, hits, spans)
+    unique = drop_near_duplicates(merged)
+
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR, model)
+    packed: List[ContextSpan] = []
+    used = 0
+    for span in unique:
+        cost = count_tokens(span.text, model) + (separator_tokens if packed else 0)
+        if budget and used + cost > budget:
+            if packed:
+                continue
+            # Inte ens det bästa avsnittet ryms: det kortas hellre än att kontexten blir tom
+            span = span._replace(text=truncate_to_tokens(span.text, budget, model))
+            cost = budget
+        packed.append(span)
+        used += cost
+
+    text = CONTEXT_SEPARATOR.join(span.text for span in packed)
+    assembled = AssembledContext(
+        text=text,
+        spans=packed,
+        tokens=count_tokens(text, model) if packed else 0,
+        raw_tokens=raw_tokens,
+        hits=len(hits),
+        merged=len(hits) - len(merged),
+        duplicates=len(merged) - len(unique),
+        over_budget=len(unique) - len(packed),
+    )
+    inc("context_tokens_total", assembled.raw_tokens, kind="raw")
+    inc("context_tokens_total", assembled.tokens, kind="assembled")
+    for result in ("merged", "duplicates", "over_budget"):
+        if getattr(assembled, result):
+            inc("context_chunks_total", getattr(assembled, result), result=result)
+    return assembled
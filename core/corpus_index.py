@@ -0,0 +1,457 @@
+# core/corpus_index.py
+
+import os
+import json
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from core.quantization import RERANK_FACTOR, CompressedVectors, compressed_search
+from core.retrieval import normalize_rows, top_k_indices
+
+DEFAULT_CORPUS_DIR = os.path.join("data", "corpus_index")
+# Kompakta vektorer för nya korpusindex, t.ex. CORPUS_INDEX_DIMS=256 och CORPUS_INDEX_QUANTIZATION=int8
+DEFAULT_COMPACT_DIMS = int(os.getenv("CORPUS_INDEX_DIMS", "0")) or None
+DEFAULT_QUANTIZATION = os.getenv("CORPUS_INDEX_QUANTIZATION") or None
+METADATA_FIELDS = ("company", "year", "source")
+# Indexet kompakteras när så stor andel av raderna tillhör borttagna dokument
+COMPACT_DEAD_FRACTION = 0.25
+
+
+def _matches(metadata: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> bool:
+    """
+    Kontrollerar om ett dokuments metadata uppfyller filtren.
+    Ett filtervärde kan vara ett enskilt värde eller en lista med tillåtna värden.
+    """
+    if not filters:
+        return True
+    for field, wanted in filters.items():
+        if wanted is None:
+            continue
+        allowed = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+        if metadata.get(field) not in allowed:
+            return False
+    return True
+
+
+def spherical_kmeans(
+    vectors: np.ndarray,
+    n_clusters: int,
+    iterations: int = 15,
+    seed: int = 0
+) -> np.ndarray:
+    """
+    K-means på enhetssfären (cosinuslikhet). Returnerar normaliserade centroider.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=n_clusters)
+        # Tomma kluster får en ny slumpmässig startpunkt
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class CorpusIndex:
+    """
+    IVF-index (inverted file) över chunks från många rapporter, helt i NumPy.
+
+    Vektorerna grupperas kring 'n_lists' centroider. En fråga jämförs först mot
+    centroiderna och sedan bara mot vektorerna i de 'nprobe' närmaste listorna;
+    högre nprobe ger bättre recall men längre svarstid. Tills indexet har tränats
+    (se 'train_threshold') görs en exakt sökning över alla vektorer.
+
+    Med 'dims' (Matryoshka-trunkering, t.ex. 256) och/eller 'quantization' ("int8"
+    eller "float16") poängsätts kandidaterna först mot kompakta vektorer (core.quantization)
+    och de top_k * rerank_factor bästa rankas sedan om exakt. De fullständiga vektorerna
+    öppnas då som memmap när indexet laddas, så att bara de kompakta hålls i minnet.
+
+    Borttagna dokument markeras först bara som borttagna; när deras rader utgör minst
+    COMPACT_DEAD_FRACTION av indexet tas raderna bort på riktigt (se compact).
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CORPUS_DIR,
+        n_lists: int = 256,
+        nprobe: int = 16,
+        dims: Optional[int] = None,
+        quantization: Optional[str] = None,
+        rerank_factor: int = RERANK_FACTOR
+    ):
+        self.path = path
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.dims = dims
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self._compressed: Optional[CompressedVectors] = None
+        self.centroids: Optional[np.ndarray] = None
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self._doc_ids: List[str] = []
+        self._blocks: List[np.ndarray] = []
+        self._vectors: Optional[np.ndarray] = None
+        self._doc_of = np.empty(0, dtype=np.int32)
+        self._assign = np.empty(0, dtype=np.int32)
+        self._lists: Optional[List[np.ndarray]] = None
+        self._dead_rows = 0
+        self.texts: List[str] = []
+
+    @property
+    def train_threshold(self) -> int:
+        # Som i FAISS: ungefär 39 vektorer per lista behövs för en meningsfull träning
+        return self.n_lists * 39
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._blocks:
+            parts = ([self._vectors] if self._vectors is not None else []) + self._blocks
+            self._vectors = np.ascontiguousarray(np.concatenate(parts))
+            self._blocks = []
+        if self._vectors is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._vectors
+
+    @property
+    def compressed(self) -> Optional[CompressedVectors]:
+        """
+        De kompakta vektorerna, eller None om indexet söker direkt i full precision.
+        Skalorna skattas första gången (och om vid train); nya vektorer kodas med samma skalor.
+        """
+        if self.dims is None and self.quantization is None:
+            return None
+        if self._compressed is None:
+            self._compressed = CompressedVectors.fit(self.vectors, self.dims, self.quantization or "float32")
+        elif len(self._compressed) < len(self):
+            self._compressed.extend(self.vectors[len(self._compressed):])
+        return self._compressed
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def add_document(
+        self,
+        doc_id: str,
+        texts: Sequence[str],
+        embeddings: Any,
+        metadata: Optional[Dict[str, Any]] = None
+    ):
+        """
+        Lägger till ett dokuments chunks. Ett dokument med samma doc_id ersätts.
+
+        Args:
+            doc_id (str): Unik identifierare för dokumentet.
+            texts (Sequence[str]): Chunk-texterna.
+            embeddings: Matris (antal x dimension) med chunkens embeddings.
+            metadata (dict): T.ex. {"company": "Volvo", "year": 2024, "source": "årsredovisning.pdf"}.
+        """
+        if doc_id in self.documents:
+            self.remove_document(doc_id)
+        matrix = normalize_rows(embeddings)
+        if matrix.shape[0] != len(texts):
+            raise ValueError("Antalet texter och embeddings måste stämma överens.")
+        doc_index = len(self._doc_ids)
+        self._doc_ids.append(doc_id)
+        self.documents[doc_id] = {"metadata": dict(metadata or {}), "index": doc_index, "deleted": False}
+        self._blocks.append(matrix)
+        self.texts.extend(texts)
+        self._doc_of = np.concatenate([self._doc_of, np.full(len(texts), doc_index, dtype=np.int32)])
+        if self.centroids is not None:
+            self._assign = np.concatenate([self._assign, self._nearest_centroids(matrix)])
+            self._lists = None
+        elif len(self) >= self.train_threshold:
+            self.train()
+
+    def add_cached_document(self, doc_id: str, document, metadata: Optional[Dict[str, Any]] = None):
+        """
+        Lägger till ett dokument från den binära embedding-cachen (utils.cache_utils.CachedDocument).
+        """
+        self.add_document(doc_id, list(document.texts), document.embeddings, metadata)
+
+    def remove_document(self, doc_id: str):
+        """
+        Markerar ett dokument som borttaget; dess vektorer filtreras bort vid sökning.
+        Indexet kompakteras när de borttagna raderna blir för många.
+        """
+        info = self.documents.get(doc_id)
+        if info is None or info["deleted"]:
+            return
+        info["deleted"] = True
+        self._dead_rows += int(np.count_nonzero(self._doc_of == info["index"]))
+        if self._dead_rows >= COMPACT_DEAD_FRACTION * len(self):
+            self.compact()
+
+    def compact(self):
+        """
+        Tar bort raderna (vektorer, texter och listtilldelning) för borttagna dokument och
+        numrerar om de kvarvarande dokumenten. Centroiderna behålls.
+        """
+        # Ett ersatt dokument står kvar i _doc_ids under sin gamla position, som inte längre lever
+        live = self._live_docs()
+        if len(live) == len(self._doc_ids):
+            return
+        keep = np.flatnonzero(np.isin(self._doc_of, live))
+        renumber = np.full(len(self._doc_ids), -1, dtype=np.int32)
+        renumber[live] = np.arange(len(live), dtype=np.int32)
+        kept_ids = [self._doc_ids[i] for i in live.tolist()]
+
+        if self._compressed is not None:
+            compressed = self.compressed
+            self._compressed = CompressedVectors(compressed.codes[keep], compressed.dims, compressed.dtype, compressed.scales)
+        if len(self.vectors):
+            self._vectors = np.ascontiguousarray(self.vectors[keep])
+        self.texts = [self.texts[i] for i in keep.tolist()]
+        self._doc_of = renumber[self._doc_of[keep]]
+        if len(self._assign):
+            self._assign = self._assign[keep]
+        self._lists = None
+        self.documents = {
+            doc_id: dict(self.documents[doc_id], index=i) for i, doc_id in enumerate(kept_ids)
+        }
+        self._doc_ids = kept_ids
+        self._dead_rows = 0
+
+    def _live_docs(self) -> np.ndarray:
+        # Dokumentnumren som inte är borttagna, i stigande ordning
+        return np.array(sorted(
+            info["index"] for info in self.documents.values() if not info["deleted"]
+        ), dtype=np.int32)
+
+    def train(self, sample_size: Optional[int] = None, iterations: int = 15, seed: int = 0):
+        """
+        Tränar centroiderna med sfärisk k-means på ett urval och fördelar alla vektorer i listor.
+        Kan köras om när korpusen har vuxit mycket sedan förra träningen.
+        """
+        vectors = self.vectors
+        n_clusters = min(self.n_lists, len(vectors))
+        if n_clusters == 0:
+            return
+        sample_size = sample_size or self.n_lists * 64
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+        self.centroids = spherical_kmeans(sample, n_clusters, iterations, seed)
+        self._assign = self._nearest_centroids(vectors)
+        self._lists = None
+        # Kvantiseringsskalorna skattas om på den större korpusen
+        self._compressed = None
+
+    def _nearest_centroids(self, matrix: np.ndarray, block_size: int = 8192) -> np.ndarray:
+        assign = np.empty(matrix.shape[0], dtype=np.int32)
+        for start in range(0, matrix.shape[0], block_size):
+            assign[start:start + block_size] = np.argmax(matrix[start:start + block_size] @ self.centroids.T, axis=1)
+        return assign
+
+    def _inverted_lists(self) -> List[np.ndarray]:
+        # Byggs om lättviktigt (en sortering) efter nya inserts
+        if self._lists is None:
+            order = np.argsort(self._assign, kind="stable")
+            bounds = np.searchsorted(self._assign[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+        return self._lists
+
+    def _allowed_docs(self, filters: Optional[Dict[str, Any]]) -> np.ndarray:
+        allowed = [
+            info["index"] for info in self.documents.values()
+            if not info["deleted"] and _matches(info["metadata"], filters)
+        ]
+        return np.array(allowed, dtype=np.int32)
+
+    def search(
+        self,
+        query_embedding: Sequence[float],
+        top_k: int = 7,
+        filters: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None
+    ) -> List[Tuple[float, str, Dict[str, Any]]]:
+        """
+        Söker i korpusen och returnerar [(poäng, text, metadata), ...] sorterat fallande.
+
+        Args:
+            query_embedding: Frågans embedding.
+            top_k (int): Antal träffar.
+            filters (dict): Metadatafilter, t.ex. {"company": "Volvo", "year": [2023, 2024]}.
+            nprobe (int): Antal listor som genomsöks (standard: self.nprobe).
+        """
+        if len(self) == 0:
+            return []
+        query = normalize_rows(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+        vectors = self.vectors
+        if self.centroids is None:
+            candidates = np.arange(len(self))
+        else:
+            nprobe = min(nprobe or self.nprobe, len(self.centroids))
+            probe = top_k_indices(self.centroids @ query, nprobe)
+            lists = self._inverted_lists()
+            candidates = np.concatenate([lists[c] for c in probe.tolist()])
+        allowed = self._allowed_docs(filters)
+        candidates = candidates[np.isin(self._doc_of[candidates], allowed)]
+        if len(candidates) == 0:
+            return []
+        compressed = self.compressed
+        if compressed is not None:
+            rows = None if len(candidates) == len(self) else candidates
+            best_rows, best_scores = compressed_search(compressed, vectors, query, top_k, rows, self.rerank_factor)
+        else:
+            scores = vectors[candidates] @ query
+            best = top_k_indices(scores, top_k)
+            best_rows, best_scores = candidates[best], scores[best]
+        results = []
+        for i, score in zip(best_rows.tolist(), best_scores.tolist()):
+            doc_id = self._doc_ids[self._doc_of[i]]
+            metadata = dict(self.documents[doc_id]["metadata"], doc_id=doc_id)
+            results.append((float(score), self.texts[i], metadata))
+        return results
+
+    def save(self, path: Optional[str] = None):
+        """
+        Sparar indexet (vektorer, listtilldelning, centroider, texter och metadata) i en katalog.
+        """
+        path = path or self.path
+        os.makedirs(path, exist_ok=True)
+        # Vektorerna kan vara en memmap av samma fil; skriv en ny fil och byt plats
+        tmp_path = os.path.join(path, f"vectors.tmp-{os.getpid()}.npy")
+        np.save(tmp_path, self.vectors)
+        os.replace(tmp_path, os.path.join(path, "vectors.npy"))
+        if len(self) and self.compressed is not None:
+            self.compressed.save(path)
+        np.save(os.path.join(path, "doc_of.npy"), self._doc_of)
+        np.save(os.path.join(path, "assign.npy"), self._assign)
+        if self.centroids is not None:
+            np.save(os.path.join(path, "centroids.npy"), self.centroids)
+        with open(os.path.join(path, "texts.jsonl"), "w", encoding="utf-8") as f:
+            for text in self.texts:
+                f.write(json.dumps(text, ensure_ascii=False) + "\n")
+        with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "n_lists": self.n_lists,
+                "nprobe": self.nprobe,
+                "dims": self.dims,
+                "quantization": self.quantization,
+                "rerank_factor": self.rerank_factor,
+                "doc_ids": self._doc_ids,
+                "documents": self.documents,
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(
+        cls,
+        path: str = DEFAULT_CORPUS_DIR,
+        dims: Optional[int] = DEFAULT_COMPACT_DIMS,
+        quantization: Optional[str] = DEFAULT_QUANTIZATION
+    ) -> "CorpusIndex":
+        """
+        Laddar ett sparat index, eller returnerar ett tomt index om katalogen saknas.
+        'dims' och 'quantization' gäller bara nya index; ett sparat index behåller sina inställningar.
+        """
+        header_path = os.path.join(path, "index.json")
+        if not os.path.exists(header_path):
+            return cls(path, dims=dims, quantization=quantization)
+        with open(header_path, "r", encoding="utf-8") as f:
+            header = json.load(f)
+        index = cls(
+            path, n_lists=header["n_lists"], nprobe=header["nprobe"], dims=header.get("dims"),
+            quantization=header.get("quantization"), rerank_factor=header.get("rerank_factor", RERANK_FACTOR)
+        )
+        index._doc_ids = header["doc_ids"]
+        index.documents = header["documents"]
+        compact = index.dims is not None or index.quantization is not None
+        # Med kompakta vektorer läses de fullständiga bara för omrankningen, direkt från disk
+        index._vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if compact else None)
+        if compact:
+            index._compressed = CompressedVectors.load(path)
+        index._doc_of = np.load(os.path.join(path, "doc_of.npy"))
+        index._dead_rows = int(np.count_nonzero(~np.isin(index._doc_of, index._live_docs())))
+        index._assign = np.load(os.path.join(path, "assign.npy"))
+        centroids_path = os.path.join(path, "centroids.npy")
+        if os.path.exists(centroids_path):
+            index.centroids = np.load(centroids_path)
+        with open(os.path.join(path, "texts.jsonl"), "r", encoding="utf-8") as f:
+            index.texts = [json.loads(line) for line in f]
+        return index
+
+
+class ChromaCorpusIndex:
+    """
+    Valfri backend med samma gränssnitt som CorpusIndex, byggd på chromadb (HNSW).
+
+    'search_ef' styr avvägningen mellan recall och svarstid i HNSW-grafen.
+    """
+
+    def __init__(self, path: str = os.path.join("data", "chroma"), collection: str = "rapporter", search_ef: int = 64):
+        import chromadb
+        self.path = path
+        self._client = chromadb.PersistentClient(path=path)
+        self._collection = self._client.get_or_create_collection(
+            collection, metadata={"hnsw:space": "cosine", "hnsw:search_ef": search_ef}
+        )
+
+    def __len__(self) -> int:
+        return self._collection.count()
+
+    def add_document(self, doc_id: str, texts: Sequence[str], embeddings: Any, metadata: Optional[Dict[str, Any]] = None):
+        self.remove_document(doc_id)
+        matrix = normalize_rows(embeddings)
+        base = {key: value for key, value in (metadata or {}).items() if value is not None}
+        self._collection.add(
+            ids=[f"{doc_id}:{i}" for i in range(len(texts))],
+            embeddings=matrix.tolist(),
+            documents=list(texts),
+            metadatas=[dict(base, doc_id=doc_id) for _ in texts],
+        )
+
+    def add_cached_document(self, doc_id: str, document, metadata: Optional[Dict[str, Any]] = None):
+        self.add_document(doc_id, list(document.texts), document.embeddings, metadata)
+
+    def remove_document(self, doc_id: str):
+        self._collection.delete(where={"doc_id": doc_id})
+
+    def search(
+        self,
+        query_embedding: Sequence[float],
+        top_k: int = 7,
+        filters: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None
+    ) -> List[Tuple[float, str, Dict[str, Any]]]:
+        conditions = []
+        for field, wanted in (filters or {}).items():
+            if wanted is None:
+                continue
+            if isinstance(wanted, (list, tuple, set)):
+                conditions.append({field: {"$in": list(wanted)}})
+            else:
+                conditions.append({field: wanted})
+        where = None
+        if len(conditions) == 1:
+            where = conditions[0]
+        elif conditions:
+            where = {"$and": conditions}
+        result = self._collection.query(
+            query_embeddings=[list(map(float, query_embedding))],
+            n_results=top_k,
+            where=where,
+        )
+        # chromadb returnerar cosinusavstånd; 1 - avstånd ger likheten
+        return [
+            (1.0 - distance, text, metadata)
+            for distance, text, metadata in zip(result["distances"][0], result["documents"][0], result["metadatas"][0])
+        ]
+
+    def save(self, path: Optional[str] = None):
+        # PersistentClient skriver till disk löpande
+        pass
+
+
+def open_corpus_index(path: Optional[str] = None, backend: str = "numpy"):
+    """
+    Öppnar korpusindexet med vald backend ("numpy" eller "chroma").
+    """
+    if backend == "chroma":
+        return ChromaCorpusIndex(path or os.path.join("data", "chroma"))
+    if backend != "numpy":
+        raise ValueError(f"Okänd backend för korpusindex: {backend}")
+    return CorpusIndex.load(path or DEFAULT_CORPUS_DIR)
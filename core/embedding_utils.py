@@ -1,22 +1,26 @@
 # core/embedding_utils.py
 
-from openai import OpenAI, OpenAIError
-from functools import lru_cache
-from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
-import streamlit as st
-from typing import List
-
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-
-@retry(
-    retry=retry_if_exception_type(OpenAIError),
-    wait=wait_random_exponential(min=1, max=60),
-    stop=stop_after_attempt(6)
-)
-@lru_cache(maxsize=512)
-def get_embedding(text: str, model: str = "text-embedding-3-small") -> List[float]:
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional
+
+from services.openai_scheduler import request_priority
+from services.openai_service import get_openai_client
+from utils.token_utils import count_tokens
+from utils.embedding_store import get_embedding_store
+from utils.metrics import record_cache, record_usage, span
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+
+# OpenAI:s gränser för ett embeddings-anrop
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 300_000
+
+
+def get_embedding(text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> List[float]:
     """
     Genererar en embedding-vektor för en given text via OpenAI:s API.
+    Slår först upp texten i den persistenta embedding-cachen.
 
     Args:
         text (str): Texten som ska konverteras till embedding.
@@ -27,8 +31,138 @@ def get_embedding(text: str, model: str = "text-embedding-3-small") -> List[floa
     """
     if not text:
         raise ValueError("Text för embedding får inte vara tom.")
-    response = client.embeddings.create(
-        model=model,
-        input=text
-    )
-    return response.data[0].embedding
+    store = get_embedding_store()
+    cached = store.get(model, text)
+    record_cache("embeddings", hits=int(cached is not None), misses=int(cached is None))
+    if cached is not None:
+        return cached
+    with span("embedding", mode="single"):
+        embedding = _embed_batch([text], model)[0]
+    store.put(model, text, embedding)
+    return embedding
+
+
+async def aget_embedding(client, text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> List[float]:
+    """
+    Asynkron variant av get_embedding för en delad AsyncOpenAI-klient.
+    Cache-uppslagningen (SQLite) körs i en tråd så att event loopen inte blockeras.
+    """
+    if not text:
+        raise ValueError("Text för embedding får inte vara tom.")
+    store = get_embedding_store()
+    cached = await asyncio.to_thread(store.get, model, text)
+    record_cache("embeddings", hits=int(cached is not None), misses=int(cached is None))
+    if cached is not None:
+        return cached
+    with span("embedding", mode="single"):
+        response = await client.embeddings.create(model=model, input=text)
+    record_usage("embedding", model, response.usage)
+    embedding = response.data[0].embedding
+    await asyncio.to_thread(store.put, model, text, embedding)
+    return embedding
+
+
+def _embed_batch(texts: List[str], model: str, priority: Optional[str] = None) -> List[List[float]]:
+    """
+    Skickar flera texter i ett enda embeddings-anrop och returnerar vektorerna i indataordning.
+    Omförsök vid 429/5xx sköts av klienten och schemaläggaren (services.openai_scheduler);
+    'priority' anger prioritetsklassen, annars gäller anroparens.
+    """
+    if priority is None:
+        response = get_openai_client().embeddings.create(model=model, input=texts)
+    else:
+        with request_priority(priority):
+            response = get_openai_client().embeddings.create(model=model, input=texts)
+    record_usage("embedding", model, response.usage)
+    # API:et anger index per resultat; sortera för att garantera ordningen
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def build_batches(
+    texts: List[str],
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    max_inputs: int = MAX_BATCH_INPUTS,
+    max_tokens: int = MAX_BATCH_TOKENS
+) -> List[List[int]]:
+    """
+    Packar texter (som index) i batchar som håller sig under gränserna för
+    antal inputs och totalt antal tokens per anrop.
+    """
+    batches, current, current_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        n_tokens = count_tokens(text, model)
+        if current and (len(current) >= max_inputs or current_tokens + n_tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += n_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def get_embeddings_batch(
+    texts: List[str],
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    max_inputs: int = MAX_BATCH_INPUTS,
+    max_tokens: int = MAX_BATCH_TOKENS,
+    max_workers: int = 4,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    priority: str = "background"
+) -> List[List[float]]:
+    """
+    Genererar embeddings för många texter med få, samtidiga API-anrop.
+
+    Args:
+        texts (List[str]): Texterna (chunks) som ska konverteras.
+        model (str): Modellnamn för OpenAI embeddings.
+        max_inputs (int): Max antal texter per anrop.
+        max_tokens (int): Max antal tokens per anrop.
+        max_workers (int): Antal batchar som skickas parallellt.
+        progress_callback (Callable): Anropas som progress_callback(klara, totalt)
+            från den anropande tråden efter varje färdig batch.
+        priority (str): Prioritetsklass hos schemaläggaren; dokument-embedding får
+            som standard ge företräde åt interaktiva anrop.
+
+    Returns:
+        List[List[float]]: En embedding per text, i samma ordning som indata.
+    """
+    if any(not text for text in texts):
+        raise ValueError("Text för embedding får inte vara tom.")
+    with span("embedding", mode="batch"):
+        return _get_embeddings_batch(texts, model, max_inputs, max_tokens, max_workers, progress_callback, priority)
+
+
+def _get_embeddings_batch(texts, model, max_inputs, max_tokens, max_workers, progress_callback, priority):
+    store = get_embedding_store()
+    results: List[Optional[List[float]]] = store.get_many(model, texts)
+    record_cache("embeddings", hits=sum(r is not None for r in results), misses=sum(r is None for r in results))
+
+    # Bara unika texter som saknas i cachen skickas till API:et
+    missing: dict = {}
+    for i, (text, embedding) in enumerate(zip(texts, results)):
+        if embedding is None:
+            missing.setdefault(text, []).append(i)
+    missing_texts = list(missing)
+    done = len(texts) - sum(len(positions) for positions in missing.values())
+    if progress_callback and texts:
+        progress_callback(done, len(texts))
+
+    batches = build_batches(missing_texts, model, max_inputs, max_tokens)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(_embed_batch, [missing_texts[i] for i in batch], model, priority): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            batch_texts = [missing_texts[i] for i in batch]
+            batch_embeddings = future.result()
+            store.put_many(model, batch_texts, batch_embeddings)
+            for text, embedding in zip(batch_texts, batch_embeddings):
+                for position in missing[text]:
+                    results[position] = embedding
+                done += len(missing[text])
+            if progress_callback:
+                progress_callback(done, len(texts))
+    return results
@@ -1,30 +1,219 @@
-import pdfplumber
-from bs4 import BeautifulSoup
-import pandas as pd
+import os
+import io
+import logging
 import streamlit as st
-from utils.ocr_utils import extract_text_from_image_or_pdf
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from typing import Callable, Iterator, List, Optional, Tuple
+from core.spreadsheet import extract_spreadsheet_text
+from services.html_downloader import html_to_text
+from utils.ocr_utils import ocr_pdf_pages
+from utils.metrics import inc, span
+
+logger = logging.getLogger(__name__)
+
+# pdfplumber, openpyxl och HTML-tolken importeras först när respektive filtyp läses
+
+# "auto" använder PyMuPDF (snabbast för text-PDF:er) om det finns, annars pdfplumber
+PDF_ENGINE = os.getenv("PDF_ENGINE", "auto")
+PAGES_PER_TASK = 8
+# Sidor med mindre text än så här antas sakna textlager (inskannade) och OCR:as
+MIN_TEXT_LAYER_CHARS = 20
+
+# Varje arbetsprocess öppnar PDF:en en gång och återanvänder den för alla sina sidintervall
+_worker_pdf_bytes = None
+
+
+def _resolve_engine(engine: str) -> str:
+    if engine != "auto":
+        return engine
+    try:
+        import fitz  # noqa: F401
+        return "pymupdf"
+    except ImportError:
+        return "pdfplumber"
+
+
+def _init_pdf_worker(pdf_bytes: bytes):
+    global _worker_pdf_bytes
+    _worker_pdf_bytes = pdf_bytes
+
+
+def _extract_page_range(engine: str, start: int, stop: int, pdf_bytes: bytes = None) -> List[str]:
+    """
+    Extraherar texten för sidorna [start, stop) med vald motor.
+    """
+    pdf_bytes = pdf_bytes if pdf_bytes is not None else _worker_pdf_bytes
+    if engine == "pymupdf":
+        import fitz
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return [doc[i].get_text("text") or "" for i in range(start, stop)]
+    import pdfplumber
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return [pdf.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def get_pdf_page_count(pdf_bytes: bytes, engine: str = PDF_ENGINE) -> int:
+    if _resolve_engine(engine) == "pymupdf":
+        import fitz
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return doc.page_count
+    import pdfplumber
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return len(pdf.pages)
+
+
+def iter_pdf_pages(
+    pdf_bytes: bytes,
+    engine: str = PDF_ENGINE,
+    max_workers: int = None,
+    pages_per_task: int = PAGES_PER_TASK
+) -> Iterator[Tuple[int, str]]:
+    """
+    Generator som extraherar en PDF sida för sida i en processpool och ger (sidnummer, text) i ordning.
+
+    Sidintervall skickas till arbetsprocesserna i ett begränsat fönster, så att
+    efterföljande steg (chunking, embedding) kan börja medan senare sidor fortfarande
+    tolkas och minnesanvändningen hålls nere. Små PDF:er extraheras direkt i processen.
+
+    Args:
+        pdf_bytes (bytes): PDF-filens innehåll.
+        engine (str): "pymupdf", "pdfplumber" eller "auto".
+        max_workers (int): Antal processer (standard: antal CPU:er).
+        pages_per_task (int): Antal sidor per uppgift.
+    """
+    engine = _resolve_engine(engine)
+    page_count = get_pdf_page_count(pdf_bytes, engine)
+    ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+    max_workers = max_workers or os.cpu_count() or 1
+
+    if len(ranges) <= 1 or max_workers == 1:
+        for start, stop in ranges:
+            for offset, text in enumerate(_extract_page_range(engine, start, stop, pdf_bytes)):
+                yield start + offset, text
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_pdf_worker, initargs=(pdf_bytes,)) as executor:
+        pending = deque()
+        remaining = iter(ranges)
+        # Högst två uppgifter per process i luften håller minnet begränsat
+        for start, stop in remaining:
+            pending.append((start, executor.submit(_extract_page_range, engine, start, stop)))
+            if len(pending) >= 2 * max_workers:
+                break
+        while pending:
+            start, future = pending.popleft()
+            for offset, text in enumerate(future.result()):
+                yield start + offset, text
+            next_range = next(remaining, None)
+            if next_range is not None:
+                pending.append((next_range[0], executor.submit(_extract_page_range, engine, *next_range)))
+
+
+def iter_pdf_text(
+    pdf_bytes: bytes,
+    ocr_fallback: bool = True,
+    window: int = 2 * PAGES_PER_TASK,
+    on_scanned_pages: Optional[Callable[[int, bool], None]] = None
+) -> Iterator[str]:
+    """
+    Ger PDF:ens text sida för sida ("sidtext\n", tomma sidor hoppas över) medan
+    senare sidor fortfarande extraheras, t.ex. till core.ingestion.ingest_document.
+
+    Sidor utan textlager (inskannade) OCR:as om 'ocr_fallback' är satt och PyMuPDF finns;
+    de samlas per fönster om 'window' sidor så att OCR:en körs parallellt.
+    on_scanned_pages anropas som on_scanned_pages(antal sidor, OCR:as) för varje fönster
+    med inskannade sidor, så att anroparen kan visa förloppet (t.ex. i appen).
+    """
+    can_ocr = ocr_fallback and _resolve_engine("auto") == "pymupdf"
+    scanned_total = 0
+
+    def flush(pages: List[Tuple[int, str]]) -> Iterator[str]:
+        nonlocal scanned_total
+        texts = dict(pages)
+        scanned = [page for page, text in pages if len(text.strip()) < MIN_TEXT_LAYER_CHARS]
+        if scanned and on_scanned_pages:
+            on_scanned_pages(len(scanned), can_ocr)
+        if scanned and can_ocr:
+            logger.info("Kör OCR på %d inskannade sidor", len(scanned))
+            with span("ocr", kind="pdf"):
+                for page, text in ocr_pdf_pages(pdf_bytes, scanned):
+                    # Behåll ett kort textlager om OCR inte hittar mer
+                    if len(text.strip()) > len(texts[page].strip()):
+                        texts[page] = text
+            inc("pages_extracted_total", len(scanned), kind="ocr")
+        scanned_total += len(scanned)
+        for page, _ in pages:
+            if texts[page]:
+                yield texts[page] + "\n"
+
+    pages: List[Tuple[int, str]] = []
+    for page, text in iter_pdf_pages(pdf_bytes):
+        inc("pages_extracted_total", kind="pdf")
+        pages.append((page, text))
+        # Sidor med textlager släpps direkt så länge inga inskannade väntar på OCR i fönstret
+        if len(pages) >= window or (len(text.strip()) >= MIN_TEXT_LAYER_CHARS and len(pages) == 1):
+            yield from flush(pages)
+            pages = []
+    yield from flush(pages)
+    if scanned_total and not can_ocr:
+        inc("pages_without_text_total", scanned_total)
+        if ocr_fallback:
+            logger.warning("%d sidor saknar textlager men PyMuPDF saknas för OCR", scanned_total)
+
+
+def extract_pdf_text(pdf_bytes: bytes, ocr_fallback: bool = True) -> str:
+    """
+    Extraherar texten ur en PDF. Sidor utan textlager (inskannade) OCR:as om
+    'ocr_fallback' är satt och PyMuPDF finns; övriga sidor läses som vanligt.
+    """
+    with span("extraction", kind="pdf"):
+        return "".join(iter_pdf_text(pdf_bytes, ocr_fallback))
+
+
+def iter_document_text(
+    data: bytes,
+    filename: str,
+    on_scanned_pages: Optional[Callable[[int, bool], None]] = None
+) -> Iterator[str]:
+    """
+    Ger dokumentets text i delar: PDF:er sida för sida (iter_pdf_text), övriga filtyper
+    som en enda del. Samma text som extract_text_from_file, men utan Streamlit-filobjekt.
+    """
+    if filename.lower().endswith(".pdf"):
+        yield from iter_pdf_text(data, on_scanned_pages=on_scanned_pages)
+    else:
+        yield extract_text_from_file(_NamedBytesIO(data, filename))
+
+
+class _NamedBytesIO(io.BytesIO):
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+
 
 def extract_text_from_file(file):
     text_output = ""
-    if file.name.endswith(".pdf"):
+    # Filändelsen avgör formatet oavsett skiftläge (RAPPORT.PDF, rapport.htm)
+    name = file.name.lower()
+    if name.endswith(".pdf"):
         file.seek(0)
         try:
-            with pdfplumber.open(file) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text_output += page_text + "\n"
+            text_output = extract_pdf_text(file.read())
         except Exception as e:
             st.warning(f"⚠️ Kunde inte läsa PDF: {e}")
 
-    elif file.name.endswith(".html"):
-        soup = BeautifulSoup(file.read(), "html.parser")
-        for tag in soup(["script", "style", "nav", "footer", "header"]):
-            tag.decompose()
-        text_output = soup.get_text(separator="\n")
+    elif name.endswith((".html", ".htm")):
+        with span("extraction", kind="html"):
+            text_output = html_to_text(file.read())
 
-    elif file.name.endswith((".xlsx", ".xls")):
-        df = pd.read_excel(file)
-        text_output = df.to_string(index=False)
+    elif name.endswith((".xlsx", ".xlsm", ".xls")):
+        # Alla flikar strömmas som kompakta radposter i radgrupper (core.spreadsheet)
+        file.seek(0)
+        with span("extraction", kind="excel"):
+            try:
+                text_output = extract_spreadsheet_text(file.read(), file.name)
+            except Exception as e:
+                st.warning(f"⚠️ Kunde inte läsa kalkylbladet: {e}")
 
     return text_output
@@ -1,16 +1,27 @@
 
+import time
+import asyncio
 import logging
-from typing import List, Tuple, Dict, Any
-from sklearn.metrics.pairwise import cosine_similarity
-import streamlit as st
+from typing import List, Tuple, Dict, Any, Union, Iterator, AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAIError
 
 from core.embedding_utils import get_embedding
-from core.chunking import chunk_text
+from core.chunking import iter_token_chunks
+from core.context_assembly import AssembledContext, assemble_context
+from core.retrieval import DEFAULT_RETRIEVAL_MODE, DocumentIndex, as_document_index, rank_chunk_indices
+from services.openai_service import get_openai_client
+from utils.cache_utils import text_cache_key, load_cached_text, save_cached_text
+from utils.token_utils import count_tokens
+from utils.metrics import observe, record_cache, record_usage, span
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Ändra versionen när RAG-prompten ändras, så att cachade svar inte återanvänds
+ANSWER_PROMPT_VERSION = "1"
+
 # --- System prompts ---
 ADVANCED_ANALYSIS_SYSTEM_PROMPT_SV = (
     "Du är en avancerad AI-baserad finansanalytiker och fondförvaltare. "
@@ -54,25 +65,116 @@ def get_system_prompt(language: str) -> str:
     else:
         return ADVANCED_ANALYSIS_SYSTEM_PROMPT_EN
 
+def select_context(
+    question: str,
+    query_embedding: List[float],
+    index: DocumentIndex,
+    top_k: int = 7,
+    mode: str = None,
+    token_budget: int = None
+) -> AssembledContext:
+    """
+    Väljer de mest relevanta chunks för en fråga vars embedding redan är beräknad
+    (används av både Streamlit-flödet och den asynkrona servern) och bygger kontexten
+    med core.context_assembly: överlappande och angränsande träffar slås ihop,
+    nästan-dubbletter tas bort och kontexten hålls inom 'token_budget' tokens
+    (standard: CONTEXT_TOKEN_BUDGET). 'mode' är sökläget i core.retrieval (standard: RETRIEVAL_MODE, "hybrid").
+    """
+    with span("retrieval", mode=mode or DEFAULT_RETRIEVAL_MODE):
+        order, scores = rank_chunk_indices(index, query_embedding, question, top_k, mode)
+        assembled = assemble_context(index.texts, list(zip(order.tolist(), scores.tolist())), index.spans, token_budget)
+    logger.info(
+        f"Valde top {top_k} chunks för frågan: {len(assembled.spans)} avsnitt, {assembled.tokens} tokens "
+        f"({assembled.tokens_saved} sparade; {assembled.merged} ihopslagna, {assembled.duplicates} dubbletter, "
+        f"{assembled.over_budget} över budget)."
+    )
+    return assembled
+
+def select_relevant_chunks(
+    question: str,
+    query_embedding: List[float],
+    index: DocumentIndex,
+    top_k: int = 7,
+    mode: str = None,
+    token_budget: int = None
+) -> Tuple[str, List[Tuple[float, str]]]:
+    """
+    Som select_context, men returnerar (kontext, [(poäng, avsnitt), ...]).
+    """
+    assembled = select_context(question, query_embedding, index, top_k, mode, token_budget)
+    return assembled.text, assembled.sources
+
+def search_context(
+    question: str,
+    embedded_chunks: Union[DocumentIndex, List[Dict[str, Any]]],
+    top_k: int = 7,
+    mode: str = None,
+    token_budget: int = None
+) -> AssembledContext:
+    """
+    Hittar de mest relevanta chunks för en fråga och bygger kontexten (se select_context).
+
+    'embedded_chunks' kan vara en lista med {"text", "embedding"}-dicts eller ett
+    färdigbyggt DocumentIndex (snabbast, eftersom matrisen då byggs en gång per dokument).
+    """
+    index = as_document_index(embedded_chunks)
+    query_embed = get_embedding(question)
+    return select_context(question, query_embed, index, top_k, mode, token_budget)
+
 def search_relevant_chunks(
     question: str,
-    embedded_chunks: List[Dict[str, Any]],
-    top_k: int = 7
+    embedded_chunks: Union[DocumentIndex, List[Dict[str, Any]]],
+    top_k: int = 7,
+    mode: str = None,
+    token_budget: int = None
+) -> Tuple[str, List[Tuple[float, str]]]:
+    """
+    Som search_context, men returnerar (kontext, [(poäng, avsnitt), ...]).
+    """
+    assembled = search_context(question, embedded_chunks, top_k, mode, token_budget)
+    return assembled.text, assembled.sources
+
+def search_corpus_chunks(
+    question: str,
+    corpus_index,
+    top_k: int = 7,
+    filters: Dict[str, Any] = None,
+    nprobe: int = None
 ) -> Tuple[str, List[Tuple[float, str]]]:
+    """
+    Som search_relevant_chunks, men över hela rapportbiblioteket (core.corpus_index).
+    Varje textdel i kontexten märks med bolag och år så att GPT kan hålla isär källorna.
+
+    Args:
+        question (str): Användarens fråga.
+        corpus_index: Ett CorpusIndex eller ChromaCorpusIndex.
+        top_k (int): Antal chunks.
+        filters (dict): Metadatafilter, t.ex. {"company": "Volvo", "year": 2024}.
+        nprobe (int): Antal IVF-listor som genomsöks (högre = bättre recall, långsammare).
+    """
     query_embed = get_embedding(question)
-    question_words = set(question.lower().split())
-    similarities = []
-    for item in embedded_chunks:
-        text = item.get("text", "")
-        text_lower = text.lower()
-        score = cosine_similarity([query_embed], [item["embedding"]])[0][0]
-        fuzzy_bonus = sum(1 for word in question_words if word in text_lower) * 0.005
-        score += fuzzy_bonus
-        similarities.append((score, text))
-    top_chunks = sorted(similarities, key=lambda x: x[0], reverse=True)[:top_k]
-    context = "\n---\n".join([chunk for _, chunk in top_chunks])
-    logger.info(f"Valde top {top_k} chunks för frågan.")
-    return context, top_chunks
+    with span("retrieval", scope="corpus"):
+        hits = corpus_index.search(query_embed, top_k=top_k, filters=filters, nprobe=nprobe)
+    labelled = []
+    for _, text, metadata in hits:
+        label = " ".join(str(metadata[field]) for field in ("company", "year") if metadata.get(field))
+        labelled.append(f"[{label}]\n{text}" if label else text)
+    context = "\n---\n".join(labelled)
+    logger.info(f"Valde top {top_k} chunks ur korpusen för frågan.")
+    return context, [(score, text) for score, text, _ in hits]
+
+def build_answer_messages(question: str, context: str, language: str = None) -> List[Dict[str, str]]:
+    """
+    Bygger chat-meddelandena för ett RAG-svar (systemprompt på rätt språk + kontext och fråga).
+    """
+    if not context.strip():
+        raise ValueError("Kontext får inte vara tom vid generering.")
+    if language is None:
+        language = detect_language(question + " " + context)
+    return [
+        {"role": "system", "content": get_system_prompt(language)},
+        {"role": "user", "content": f"Kontext:\n{context}\n\nFråga: {question}"}
+    ]
 
 def generate_gpt_answer(
     question: str,
@@ -86,55 +188,341 @@ def generate_gpt_answer(
     Skapar ett GPT-svar på rätt språk och med avancerad prompt.
     Om 'language' är None, autodetekteras språk baserat på fråga + kontext.
     """
-    from openai import OpenAI, OpenAIError
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    messages = build_answer_messages(question, context, language)
+    try:
+        with span("generation", kind="answer"):
+            response = get_openai_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+        record_usage("answer", model, response.usage)
+        return response.choices[0].message.content
+    except OpenAIError as e:
+        logger.error(f"OpenAI API-fel: {e}")
+        raise RuntimeError(f"❌ Fel vid generering av svar: {e}")
 
-    if not context.strip():
-        raise ValueError("Kontext får inte vara tom vid generering.")
-    if language is None:
-        language = detect_language(question + " " + context)
-    system_prompt = get_system_prompt(language)
+async def agenerate_gpt_answer(
+    client,
+    question: str,
+    context: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.3,
+    max_tokens: int = 1000,
+    language: str = None
+) -> str:
+    """
+    Asynkron variant av generate_gpt_answer med en delad AsyncOpenAI-klient.
+    """
+    messages = build_answer_messages(question, context, language)
     try:
-        response = client.chat.completions.create(
+        with span("generation", kind="answer"):
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+        record_usage("answer", model, response.usage)
+        return response.choices[0].message.content
+    except OpenAIError as e:
+        logger.error(f"OpenAI API-fel: {e}")
+        raise RuntimeError(f"❌ Fel vid generering av svar: {e}")
+
+def _stream_chat(messages: List[Dict[str, str]], model: str, temperature: float, max_tokens: int, kind: str) -> Iterator[str]:
+    """
+    Strömmande chat-anrop som ger textbitarna och bokför tid, tid till första token och tokens.
+    """
+    with span("generation", kind=kind, mode="stream"):
+        start = time.perf_counter()
+        response = get_openai_client().chat.completions.create(
             model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Kontext:\n{context}\n\nFråga: {question}"}
-            ],
+            messages=messages,
             temperature=temperature,
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
         )
-        return response.choices[0].message.content
+        first = True
+        for chunk in response:
+            # Sista biten har tomma choices och innehåller usage
+            if chunk.usage:
+                record_usage(kind, model, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first:
+                    observe("generation_ttft_seconds", time.perf_counter() - start, kind=kind)
+                    first = False
+                yield chunk.choices[0].delta.content
+
+def stream_gpt_answer(
+    question: str,
+    context: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.3,
+    max_tokens: int = 1000,
+    language: str = None
+) -> Iterator[str]:
+    """
+    Som generate_gpt_answer, men ger svaret i textbitar allteftersom de genereras.
+    """
+    messages = build_answer_messages(question, context, language)
+    try:
+        yield from _stream_chat(messages, model, temperature, max_tokens, "answer")
     except OpenAIError as e:
         logger.error(f"OpenAI API-fel: {e}")
         raise RuntimeError(f"❌ Fel vid generering av svar: {e}")
 
-def full_rapportanalys(
-    text: str,
+async def _astream_deltas(
+    client, messages: List[Dict[str, str]], model: str, temperature: float, max_tokens: int, kind: str = "answer"
+) -> AsyncIterator[str]:
+    with span("generation", kind=kind, mode="stream"):
+        start = time.perf_counter()
+        response = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        first = True
+        async for chunk in response:
+            if chunk.usage:
+                record_usage(kind, model, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first:
+                    observe("generation_ttft_seconds", time.perf_counter() - start, kind=kind)
+                    first = False
+                yield chunk.choices[0].delta.content
+
+async def astream_gpt_answer(
+    client,
+    question: str,
+    context: str,
     model: str = "gpt-4o",
     temperature: float = 0.3,
-    max_tokens: int = 1500,
+    max_tokens: int = 1000,
     language: str = None
-) -> str:
+) -> AsyncIterator[str]:
     """
-    Gör en fullständig rapportanalys med avancerad prompt.
+    Asynkron, strömmande variant av generate_gpt_answer med en delad AsyncOpenAI-klient.
     """
-    from openai import OpenAI
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-    if language is None:
-        language = detect_language(text)
-    system_prompt = get_system_prompt(language)
+    messages = build_answer_messages(question, context, language)
     try:
-        response = client.chat.completions.create(
+        async for delta in _astream_deltas(client, messages, model, temperature, max_tokens):
+            yield delta
+    except OpenAIError as e:
+        logger.error(f"OpenAI API-fel: {e}")
+        raise RuntimeError(f"❌ Fel vid generering av svar: {e}")
+
+# --- Map-reduce för långa rapporter ---
+# Ändra versionen när map-prompterna ändras, så att cachade avsnittssammanfattningar görs om
+MAP_PROMPT_VERSION = "1"
+
+MAP_SYSTEM_PROMPT_SV = (
+    "Du är en finansanalytiker som sammanfattar ETT avsnitt av en längre årsrapport. "
+    "Använd endast information i avsnittet. Svara kortfattat med exakt dessa rubriker:\n"
+    "**Lönsamhet:** nyckeltal och utveckling (med siffror och period).\n"
+    "**Risker:** risker och osäkerhetsfaktorer som nämns.\n"
+    "**Nyckeltal:** punktlista med viktiga siffror (t.ex. omsättning, rörelseresultat, kassaflöde, utdelning).\n"
+    "Skriv 'Ingen information' under en rubrik om avsnittet saknar sådant innehåll. Citera gärna exakta formuleringar."
+)
+
+MAP_SYSTEM_PROMPT_EN = (
+    "You are a financial analyst summarizing ONE section of a longer annual report. "
+    "Use only information in the section. Answer concisely using exactly these headings:\n"
+    "**Profitability:** key metrics and their development (with figures and period).\n"
+    "**Risks:** risks and uncertainties mentioned.\n"
+    "**Key figures:** bullet list of important numbers (e.g. revenue, operating income, cash flow, dividend).\n"
+    "Write 'No information' under a heading if the section has no such content. Quote exact wording where useful."
+)
+
+# Över denna storlek (i tokens) används map-reduce i läget "auto"
+SINGLE_CALL_TOKEN_LIMIT = 24000
+
+
+def _chat_completion(
+    model: str, system_prompt: str, user_content: str, temperature: float, max_tokens: int, kind: str = "analysis"
+) -> str:
+    with span("generation", kind=kind):
+        response = get_openai_client().chat.completions.create(
             model=model,
             messages=[
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": text}
+                {"role": "user", "content": user_content}
             ],
             temperature=temperature,
             max_tokens=max_tokens
         )
-        return response.choices[0].message.content
+    record_usage(kind, model, response.usage)
+    return response.choices[0].message.content
+
+
+def summarize_section(
+    section: str,
+    language: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.2,
+    max_tokens: int = 600
+) -> str:
+    """
+    Map-steget: sammanfattar ett avsnitt i strukturen Lönsamhet/Risker/Nyckeltal.
+    Resultatet cachas per (modell, map-prompt, avsnittstext).
+    """
+    system_prompt = MAP_SYSTEM_PROMPT_SV if language == "sv" else MAP_SYSTEM_PROMPT_EN
+    key = text_cache_key(MAP_PROMPT_VERSION, model, str(temperature), str(max_tokens), system_prompt, section)
+    cached = load_cached_text("section_summaries", key)
+    record_cache("section_summaries", hits=int(cached is not None), misses=int(cached is None))
+    if cached is not None:
+        return cached
+    summary = _chat_completion(model, system_prompt, section, temperature, max_tokens, kind="map")
+    save_cached_text("section_summaries", key, summary)
+    return summary
+
+
+def _map_sections(
+    text: str,
+    model: str,
+    language: str,
+    section_tokens: int = 6000,
+    max_concurrency: int = 4
+) -> str:
+    """
+    Map-steget för hela rapporten: returnerar användarmeddelandet till reduce-anropet.
+    """
+    sections = [text[span.start:span.end] for span in iter_token_chunks(
+        text, max_tokens=section_tokens, model=model, split_on_headings=False
+    )]
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        summaries = list(executor.map(lambda section: summarize_section(section, language, model), sections))
+    logger.info(f"Map-steg klart: {len(sections)} avsnitt sammanfattade.")
+    heading = "Avsnitt" if language == "sv" else "Section"
+    intro = (
+        "Nedan följer sammanfattningar av rapportens avsnitt i ordning. Gör den fullständiga analysen utifrån dem."
+        if language == "sv" else
+        "Below are summaries of the report's sections, in order. Perform the full analysis based on them."
+    )
+    combined = "\n\n".join(f"### {heading} {i}\n{summary}" for i, summary in enumerate(summaries, 1))
+    return f"{intro}\n\n{combined}"
+
+
+def map_reduce_rapportanalys(
+    text: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.3,
+    max_tokens: int = 1500,
+    language: str = None,
+    section_tokens: int = 6000,
+    max_concurrency: int = 4
+) -> str:
+    """
+    Analyserar en lång rapport i två steg:
+    1. Map: rapporten delas i token-budgeterade avsnitt som sammanfattas parallellt
+       (högst 'max_concurrency' samtidiga anrop, cachade per avsnitt).
+    2. Reduce: sammanfattningarna analyseras med den vanliga systemprompten.
+
+    Om bara systemprompten ändras görs därmed bara reduce-steget om.
+    """
+    if language is None:
+        language = detect_language(text)
+    user_content = _map_sections(text, model, language, section_tokens, max_concurrency)
+    return _chat_completion(model, get_system_prompt(language), user_content, temperature, max_tokens)
+
+
+def prepare_full_analysis(
+    text: str,
+    model: str = "gpt-4o",
+    language: str = None,
+    mode: str = "auto",
+    max_concurrency: int = 4,
+    section_tokens: int = 6000
+) -> List[Dict[str, str]]:
+    """
+    Bygger chat-meddelandena för den fullständiga analysen. I map-reduce-läge körs
+    map-steget här, så att bara det slutliga (reduce-)anropet återstår.
+
+    mode: "single" skickar hela texten i ett anrop, "map_reduce" sammanfattar
+    avsnitten först och "auto" väljer map-reduce när texten är större än
+    SINGLE_CALL_TOKEN_LIMIT tokens. 'section_tokens' är avsnittens storlek i map-steget.
+    """
+    if language is None:
+        language = detect_language(text)
+    if mode == "auto":
+        mode = "map_reduce" if count_tokens(text, model) > SINGLE_CALL_TOKEN_LIMIT else "single"
+    if mode == "map_reduce":
+        user_content = _map_sections(text, model, language, section_tokens, max_concurrency)
+    else:
+        user_content = text
+    return [
+        {"role": "system", "content": get_system_prompt(language)},
+        {"role": "user", "content": user_content}
+    ]
+
+
+def full_rapportanalys(
+    text: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.3,
+    max_tokens: int = 1500,
+    language: str = None,
+    mode: str = "auto",
+    max_concurrency: int = 4,
+    section_tokens: int = 6000
+) -> str:
+    """
+    Gör en fullständig rapportanalys med avancerad prompt (se prepare_full_analysis för 'mode').
+    """
+    try:
+        messages = prepare_full_analysis(text, model, language, mode, max_concurrency, section_tokens)
+        return _chat_completion(model, messages[0]["content"], messages[1]["content"], temperature, max_tokens)
     except Exception as e:
         logger.error(f"OpenAI API-fel vid analys: {e}")
         return f"❌ Fel vid analys: {e}"
+
+
+def stream_full_rapportanalys(
+    text: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.3,
+    max_tokens: int = 1500,
+    language: str = None,
+    mode: str = "auto",
+    max_concurrency: int = 4,
+    section_tokens: int = 6000
+) -> Iterator[str]:
+    """
+    Som full_rapportanalys, men ger analysen i textbitar allteftersom de genereras.
+    I map-reduce-läge strömmas reduce-steget; map-steget körs innan första biten.
+    """
+    try:
+        messages = prepare_full_analysis(text, model, language, mode, max_concurrency, section_tokens)
+        yield from _stream_chat(messages, model, temperature, max_tokens, "analysis")
+    except Exception as e:
+        logger.error(f"OpenAI API-fel vid analys: {e}")
+        yield f"❌ Fel vid analys: {e}"
+
+
+async def astream_full_rapportanalys(
+    client,
+    text: str,
+    model: str = "gpt-4o",
+    temperature: float = 0.3,
+    max_tokens: int = 1500,
+    language: str = None,
+    mode: str = "auto",
+    max_concurrency: int = 4,
+    section_tokens: int = 6000
+) -> AsyncIterator[str]:
+    """
+    Asynkron variant av stream_full_rapportanalys; map-steget körs i en tråd.
+    """
+    try:
+        messages = await asyncio.to_thread(
+            prepare_full_analysis, text, model, language, mode, max_concurrency, section_tokens
+        )
+        async for delta in _astream_deltas(client, messages, model, temperature, max_tokens, "analysis"):
+            yield delta
+    except Exception as e:
+        logger.error(f"OpenAI API-fel vid analys: {e}")
+        yield f"❌ Fel vid analys: {e}"
@@ -0,0 +1,223 @@
+# core/ingestion.py
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from core.chunking import (
+    DEFAULT_AVG_TOKENS,
+    DEFAULT_MAX_TOKENS,
+    DEFAULT_MIN_TOKENS,
+    chunk_hash,
+    iter_streaming_chunks,
+)
+from core.embedding_utils import get_embeddings_batch, DEFAULT_EMBEDDING_MODEL
+from core.key_figures import FactIndex
+from utils.cache_utils import (
+    CachedDocument,
+    find_previous_version,
+    get_document_cache_dir,
+    get_document_fingerprint,
+    open_document_cache,
+    save_document_cache,
+)
+from utils.embedding_store import get_embedding_store
+from utils.metrics import inc, record_cache, span
+
+# Sparas i varje cache (header["chunker"]); en cache med andra parametrar räknas som
+# saknad av open_document_cache(..., CHUNKER_PARAMS). Höj "version" när chunkningen ändras.
+CHUNKER_PARAMS = {
+    "chunker": "iter_content_defined_chunks",
+    "version": 1,
+    "max_tokens": DEFAULT_MAX_TOKENS,
+    "min_tokens": DEFAULT_MIN_TOKENS,
+    "avg_tokens": DEFAULT_AVG_TOKENS,
+}
+# Antal chunks per embeddings-anrop när dokumentet indexeras strömmande
+EMBED_BATCH_SIZE = 64
+# Föregående version söks bland cachade dokument med hjälp av så många av de första chunkarna
+PREVIOUS_PROBE_CHUNKS = 64
+
+
+class EmptyDocumentError(ValueError):
+    """
+    Texten gav inga chunks (t.ex. en tom eller bildbaserad PDF utan OCR).
+    """
+
+
+class IndexingStats(NamedTuple):
+    """
+    Utfallet av en (om)indexering av ett dokument.
+    """
+    chunks: int
+    reused: int                     # vektorn kopierades från föregående version av dokumentet
+    cached: int                     # vektorn fanns i embedding-cachen (samma text i ett annat dokument)
+    embedded: int                   # chunken embeddades på nytt via API:et
+    previous: Optional[str] = None  # cachekatalogen för föregående version, om en hittades
+
+
+def _embed_missing(texts: List[str], model: str) -> Tuple[List[List[float]], int]:
+    """
+    Embeddar en batch: först ur embedding-cachen, resten via API:et. Returnerar (vektorer, antal cachade).
+    """
+    results = get_embedding_store().get_many(model, texts)
+    missing = [i for i, embedding in enumerate(results) if embedding is None]
+    # Missarna räknas av get_embeddings_batch, som slår upp dem en gång till
+    record_cache("embeddings", hits=len(texts) - len(missing))
+    if missing:
+        vectors = get_embeddings_batch([texts[i] for i in missing], model, max_workers=1)
+        for i, embedding in zip(missing, vectors):
+            results[i] = embedding
+    return results, len(texts) - len(missing)
+
+
+def ingest_document(
+    text: Union[str, Iterable[str]],
+    cache_dir: Optional[str] = None,
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    previous: Optional[CachedDocument] = None,
+    find_previous: bool = True,
+    max_workers: int = 4,
+    batch_size: int = EMBED_BATCH_SIZE,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> Tuple[CachedDocument, IndexingStats]:
+    """
+    Chunkar, embeddar och sparar ett dokument i den binära cachen, inkrementellt mot en
+    tidigare version om det finns en.
+
+    'text' är hela texten eller dess delar i ordning (t.ex. sida för sida från
+    core.file_processing.iter_pdf_text). Delarna chunkas allteftersom de kommer
+    (iter_streaming_chunks) och färdiga chunks embeddas i batchar om 'batch_size' i en
+    trådpool, medan senare sidor fortfarande extraheras. Resultatet blir detsamma som
+    för den sammanfogade texten.
+
+    Chunkarna får innehållsstyrda gränser (iter_content_defined_chunks), så att en
+    reviderad rapport till största delen ger samma chunks som originalet. Varje chunks
+    vektor tas i första hand från föregående version (samma innehållshash), sedan ur
+    embedding-cachen och sist från API:et. Föregående version är 'previous', annars (med
+    find_previous) den cache som redan ligger i 'cache_dir' (samma dokument-id, ändrad text)
+    eller det cachade dokument som har flest chunkhashar gemensamt med dokumentets första
+    PREVIOUS_PROBE_CHUNKS chunks (t.ex. samma rapport under ett nytt filnamn).
+
+    'cache_dir' är som standard katalogen för textens fingeravtryck (get_document_cache_dir).
+    progress_callback anropas som progress_callback(klara, hittills kända chunks).
+
+    Raises:
+        EmptyDocumentError: Om texten inte ger några chunks.
+    """
+    pieces = [text] if isinstance(text, str) else text
+    parts: List[str] = []
+    spans: List[Tuple[int, int]] = []
+    chunks: List[str] = []
+    hashes: List[str] = []
+    embeddings: List[Optional[np.ndarray]] = []
+    counts = {"reused": 0, "cached": 0, "embedded": 0}
+    waiting: List[int] = []
+    pending = deque()
+    rows: Optional[dict] = None
+    done = 0
+
+    def collect(piece_iter):
+        for piece in piece_iter:
+            parts.append(piece)
+            yield piece
+
+    def drain_oldest():
+        nonlocal done
+        batch, future = pending.popleft()
+        vectors, cached = future.result()
+        for i, embedding in zip(batch, vectors):
+            embeddings[i] = np.asarray(embedding, dtype=np.float32)
+        counts["cached"] += cached
+        counts["embedded"] += len(batch) - cached
+        done += len(batch)
+        if progress_callback:
+            progress_callback(done, len(chunks))
+
+    def submit(executor, force: bool = False):
+        while waiting and (force or len(waiting) >= batch_size):
+            batch = waiting[:batch_size]
+            del waiting[:batch_size]
+            pending.append((batch, executor.submit(_embed_missing, [chunks[i] for i in batch], model)))
+            # Högst två batchar per tråd i luften håller minnet begränsat
+            while len(pending) > 2 * max_workers:
+                drain_oldest()
+        while pending and pending[0][1].done():
+            drain_oldest()
+
+    def resolve(upto: int):
+        # Slår upp chunks som redan finns i föregående version; resten väntar på API:et
+        nonlocal done
+        for i in range(len(embeddings), upto):
+            row = rows.get(hashes[i]) if rows else None
+            if row is not None:
+                embeddings.append(np.asarray(previous.embeddings[row], dtype=np.float32))
+                counts["reused"] += 1
+                done += 1
+            else:
+                embeddings.append(None)
+                waiting.append(i)
+
+    # En föregående version som öppnas här stängs igen innan cachen sparas, även vid fel
+    opened_previous = previous is None
+    try:
+        if previous is None and find_previous and cache_dir is not None:
+            previous = open_document_cache(cache_dir)
+
+        def start_reuse():
+            # Föregående version bestäms en gång, innan några chunks skickas till API:et
+            nonlocal previous, rows
+            if previous is None and find_previous:
+                previous = find_previous_version(hashes, model, exclude=cache_dir)
+            rows = {value: row for row, value in enumerate(previous.hashes)} \
+                if previous is not None and previous.model == model else {}
+
+        with span("ingestion"), ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for chunk_span, chunk in iter_streaming_chunks(collect(pieces)):
+                spans.append((chunk_span.start, chunk_span.end))
+                chunks.append(chunk)
+                hashes.append(chunk_hash(chunk))
+                if rows is None and (previous is not None or not find_previous or len(chunks) >= PREVIOUS_PROBE_CHUNKS):
+                    start_reuse()
+                if rows is not None:
+                    resolve(len(chunks))
+                    submit(executor)
+            if not chunks:
+                raise EmptyDocumentError("Kunde inte skapa några textblock (chunks) från texten.")
+            if rows is None:
+                start_reuse()
+            resolve(len(chunks))
+            submit(executor, force=True)
+            while pending:
+                drain_oldest()
+        if progress_callback:
+            progress_callback(len(chunks), len(chunks))
+
+        full_text = "".join(parts)
+        fingerprint = get_document_fingerprint(full_text)
+        with span("key_figures"):
+            facts = FactIndex.from_text(full_text, spans)
+        for result, count in counts.items():
+            if count:
+                inc("chunks_indexed_total", count, result=result)
+        stats = IndexingStats(
+            len(chunks), counts["reused"], counts["cached"], counts["embedded"],
+            previous.path if previous is not None else None
+        )
+    finally:
+        if opened_previous and previous is not None:
+            previous.close()
+    if cache_dir is None:
+        # Strömmade källor (t.ex. en PDF) får sitt id först när texten är klar; finns
+        # samma text redan i cachen används den
+        cache_dir = get_document_cache_dir(fingerprint)
+        existing = open_document_cache(cache_dir, CHUNKER_PARAMS)
+        if existing is not None and existing.header.get("fingerprint") == fingerprint and existing.model == model:
+            return existing, stats
+    cached_doc = save_document_cache(
+        cache_dir, chunks, np.vstack(embeddings), model=model,
+        chunker_params=CHUNKER_PARAMS, spans=spans, facts=facts, hashes=hashes, fingerprint=fingerprint
+    )
+    return cached_doc, stats
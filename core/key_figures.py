@@ -0,0 +1,323 @@
+# core/key_figures.py
+"""
+Nyckeltal ur rapporttext: en förkompilerad skanner som i ett enda svep hittar
+nyckeltalsetiketter (svenska och engelska) och tabellrubriker med perioder, och
+bygger ett index av numeriska fakta (nyckeltal, värde, enhet, period, offset).
+
+Indexet byggs när dokumentet läses in och sparas i dokumentcachen. Numeriska frågor
+("Vad blev utdelningen per aktie 2024?") kan då besvaras eller förfiltreras utan
+att texten söks igenom igen, och sökningen kan lyfta chunks som innehåller nyckeltalet.
+"""
+import os
+import re
+import json
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+# Nyckeltal -> (visningsnamn, regex för etiketter). Ordningen spelar roll: mer specifika
+# etiketter står före mer generella ("EBITDA-marginal" före "EBITDA").
+METRICS = {
+    "dividend_per_share": ("Utdelning per aktie", r"utdelning\w*\s+per\s+aktie|dividends?\s+per\s+share|DPS"),
+    "eps": ("Resultat per aktie", r"(?:resultat|vinst)\w*\s+per\s+aktie|earnings\s+per\s+share|EPS"),
+    "ebitda_margin": ("EBITDA-marginal", r"EBITDA[-\s]?marginal\w*|EBITDA\s+margin"),
+    "ebitda": ("EBITDA", r"EBITDA"),
+    "operating_margin": ("Rörelsemarginal", r"rörelsemarginal\w*|EBIT[-\s]?marginal\w*|operating\s+margin|EBIT\s+margin"),
+    "operating_income": ("Rörelseresultat", r"rörelseresultat\w*|EBIT|operating\s+(?:income|profit)"),
+    "profit_before_tax": ("Resultat före skatt", r"resultat\w*\s+(?:efter\s+finansiella\s+poster|före\s+skatt)|profit\s+before\s+tax(?:es)?"),
+    "net_income": ("Periodens resultat", r"(?:periodens|årets|kvartalets)\s+resultat|nettoresultat\w*|net\s+(?:income|profit)|profit\s+for\s+the\s+(?:year|period)"),
+    "net_sales": ("Nettoomsättning", r"nettoomsättning\w*|omsättning\w*|intäkter\w*|net\s+sales|revenues?"),
+    "gross_margin": ("Bruttomarginal", r"bruttomarginal\w*|gross\s+margin"),
+    "operating_cash_flow": ("Kassaflöde från den löpande verksamheten", r"kassaflöde\w*\s+från\s+(?:den\s+)?löpande\s+verksamhet\w*|operating\s+cash\s+flow|cash\s+flow\s+from\s+operating\s+activities"),
+    "cash_flow": ("Kassaflöde", r"kassaflöde\w*|cash\s+flow"),
+    "return_on_equity": ("Avkastning på eget kapital", r"avkastning\w*\s+på\s+eget\s+kapital|return\s+on\s+equity|ROE"),
+    "equity_ratio": ("Soliditet", r"soliditet\w*|equity[/\s-]assets\s+ratio|equity\s+ratio"),
+    "equity": ("Eget kapital", r"eget\s+kapital|(?:total\s+)?shareholders'?\s+equity"),
+    "net_debt": ("Nettoskuld", r"nettoskuld\w*|net\s+debt"),
+    "dividend": ("Utdelning", r"utdelning\w*|dividends?"),
+}
+
+# Enheter -> normaliserad enhet
+_UNITS = {
+    "msek": "MSEK", "mkr": "MSEK", "mnkr": "MSEK", "miljoner kronor": "MSEK", "miljoner": "MSEK",
+    "mdsek": "MDSEK", "mdkr": "MDSEK", "miljarder kronor": "MDSEK", "miljarder": "MDSEK",
+    "tsek": "TSEK", "ksek": "TSEK", "tkr": "TSEK",
+    "sek": "SEK", "kronor": "SEK", "kr": "SEK",
+    "%": "%", "procent": "%", "percent": "%",
+    "musd": "MUSD", "usd": "USD", "$": "USD", "meur": "MEUR", "eur": "EUR", "€": "EUR",
+}
+_UNIT = r"miljoner\s+kronor|miljarder\s+kronor|miljoner|miljarder|MSEK|Mkr|Mnkr|MDSEK|mdkr|TSEK|KSEK|tkr|SEK|kronor|kr|procent|percent|MUSD|USD|MEUR|EUR|%|€|\$"
+UNIT_PATTERN = re.compile(rf"(?<!\w)(?:{_UNIT})(?!\w)", re.IGNORECASE)
+
+_PERIOD = r"(?:(?:Q|Kv|H)[1-4][^\S\n]*|(?:helår(?:et)?|räkenskapsåret|FY)[^\S\n]*)?(?:19|20)\d{2}(?:/\d{2,4})?"
+PERIOD_PATTERN = re.compile(rf"(?<![\d,.]){_PERIOD}(?![\d,.]\d)", re.IGNORECASE)
+
+# Tal: "12 345", "7,50", "(1 234)" (negativt), "−3,2"; följt av en valfri enhet
+VALUE_PATTERN = re.compile(
+    rf"(?<![\w,.])(?P<neg>[-−–]|\()?(?P<number>\d{{1,3}}(?:[  ]\d{{3}})+(?:[.,]\d+)?|\d+(?:[.,]\d+)?)\)?"
+    rf"(?:[^\S\n]*(?P<unit>{_UNIT})(?!\w))?",
+    re.IGNORECASE
+)
+
+# En skanner för hela texten: tabellrubriker (rader där alla tal är perioder) eller en nyckeltalsetikett
+_HEADER = rf"^(?P<header>[^\d\n]*{_PERIOD}(?:[^\d\n]+{_PERIOD})*[^\d\n]*)$"
+_LABELS = "|".join(rf"(?P<{key}>\b(?:{pattern})\b)" for key, (_, pattern) in METRICS.items())
+FACT_SCANNER = re.compile(rf"{_HEADER}|{_LABELS}", re.IGNORECASE | re.MULTILINE)
+_LABEL_SCANNER = re.compile(_LABELS, re.IGNORECASE)
+
+# "utdelning ... 3,25 kr per aktie" är utdelning per aktie
+_PER_SHARE = re.compile(r"[^\S\n]*(?:per\s+aktie|per\s+share)", re.IGNORECASE)
+_PER_SHARE_METRICS = {"dividend": "dividend_per_share"}
+# Närliggande nyckeltal som söks när frågans nyckeltal saknas i dokumentet: det generella
+# för det specifika och tvärtom ("Vilken utdelning föreslås?" ska hitta "4,50 kr per aktie")
+_FALLBACK_METRICS = {
+    "dividend_per_share": "dividend",
+    "dividend": "dividend_per_share",
+    "operating_cash_flow": "cash_flow",
+    "cash_flow": "operating_cash_flow",
+}
+
+# Belopp kan inte anges i procent: "Nettoomsättningen ökade med 10 procent" är en
+# förändring, inte nettoomsättningen. Marginaler, avkastning och soliditet får vara procent.
+ABSOLUTE_METRICS = frozenset({
+    "dividend_per_share", "eps", "ebitda", "operating_income", "profit_before_tax", "net_income",
+    "net_sales", "operating_cash_flow", "cash_flow", "equity", "net_debt", "dividend",
+})
+# Ett värde direkt efter "ökade med", "minskade med", "increased by" osv. är en förändring
+_CHANGE_BEFORE = re.compile(
+    r"(?:ökade|ökat|minskade|minskat|steg|stigit|sjönk|sjunkit|växte|vuxit|förbättrades|försämrades"
+    r"|increased|decreased|rose|fell|grew|improved|declined)[^\S\n]+(?:med|by)[^\S\n]*[-−–(]?$",
+    re.IGNORECASE
+)
+
+_CELL_PERIOD = re.compile(rf"({_PERIOD})[^\S\n]*:[^\S\n]*$", re.IGNORECASE)
+
+# Hur långt efter etiketten det första värdet får stå (tecken)
+MAX_LABEL_GAP = 80
+# Hur långt efter en tabellrubrik dess perioder och enhet gäller (tecken)
+HEADER_REACH = 4000
+
+
+class KeyFigure(NamedTuple):
+    metric: str                 # nyckel i METRICS, t.ex. "dividend_per_share"
+    label: str                  # etiketten som den står i texten
+    value: float
+    raw: str                    # värdet som det står i texten
+    unit: Optional[str]         # normaliserad enhet: MSEK, TSEK, SEK, %, ...
+    period: Optional[str]       # t.ex. "2024", "Q3 2024" eller "2023/24"
+    offset: int                 # teckenposition för värdet i källtexten
+    chunk: Optional[int] = None # chunken som innehåller värdet (sätts av FactIndex)
+
+    @property
+    def name(self) -> str:
+        return METRICS[self.metric][0]
+
+
+def parse_number(raw: str) -> float:
+    """
+    Tolkar ett tal med svenska eller engelska avgränsare: mellanslag är tusentalsavgränsare,
+    och finns både komma och punkt är det sista tecknet decimalavgränsaren.
+    """
+    number = raw.replace(" ", "").replace(" ", "")
+    if "," in number and "." in number:
+        decimal = "," if number.rfind(",") > number.rfind(".") else "."
+        number = number.replace("." if decimal == "," else ",", "").replace(decimal, ".")
+    else:
+        number = number.replace(",", ".")
+    return float(number)
+
+
+def normalize_unit(unit: Optional[str]) -> Optional[str]:
+    if not unit:
+        return None
+    return _UNITS.get(re.sub(r"\s+", " ", unit.lower()))
+
+
+def _is_year(match: re.Match) -> bool:
+    number = match.group("number")
+    return len(number) == 4 and number[:2] in ("19", "20") and not match.group("unit")
+
+
+def extract_key_figures(text: str) -> List[KeyFigure]:
+    """
+    Hittar nyckeltal i texten i ett svep med FACT_SCANNER.
+
+    - Löptext ("Rörelseresultatet uppgick till 512 MSEK 2024"): första värdet efter etiketten,
+      med perioden från samma mening.
+    - Tabellrader ("Rörelseresultat    512    480"): alla värden på raden, med perioderna
+      (kolumnerna) och enheten från närmast föregående rubrikrad ("MSEK   2024   2023").
+    - Förändringar ("ökade med 10 procent", "increased by 120 MSEK") och procenttal för
+      belopp (ABSOLUTE_METRICS) hoppas över.
+    """
+    facts: List[KeyFigure] = []
+    header_periods: List[str] = []
+    header_columns: List[Optional[str]] = []
+    header_unit: Optional[str] = None
+    header_end = -HEADER_REACH
+    matches = list(FACT_SCANNER.finditer(text))
+    for i, match in enumerate(matches):
+        if match.lastgroup == "header":
+            header_periods = [m.group(0) for m in PERIOD_PATTERN.finditer(match.group("header"))]
+            # "|"-avgränsade rubriker (kalkylblad): perioden per kolumn, även för tomma kolumner
+            header_columns = [
+                next((m.group(0) for m in PERIOD_PATTERN.finditer(cell)), None)
+                for cell in match.group("header").split("|")
+            ] if "|" in match.group("header") else []
+            header_unit = normalize_unit(next((m.group(0) for m in UNIT_PATTERN.finditer(match.group("header"))), None))
+            header_end = match.end()
+            continue
+
+        line_end = text.find("\n", match.end())
+        line_end = len(text) if line_end == -1 else line_end
+        # Värdena hör till etiketten fram till nästa etikett på samma rad
+        window_end = min(line_end, matches[i + 1].start() if i + 1 < len(matches) else line_end)
+        absolute = match.lastgroup in ABSOLUTE_METRICS
+        values = [
+            m for m in VALUE_PATTERN.finditer(text, match.end(), window_end)
+            if not _is_year(m)
+            and not _CHANGE_BEFORE.search(text, match.end(), m.start())
+            and not (absolute and normalize_unit(m.group("unit")) == "%")
+        ]
+        if not values or values[0].start() - match.end() > MAX_LABEL_GAP:
+            continue
+        gap = text[match.end():values[0].start()]
+        # Kolumner avgränsade med tabb, flera blanksteg eller "|" (radposter ur kalkylblad)
+        is_table_row = "\t" in gap or "  " in gap or "|" in gap
+        # Enhet i etiketten ("Utdelning per aktie, kr") gäller alla värden på raden
+        label_unit = normalize_unit(next((m.group(0) for m in UNIT_PATTERN.finditer(gap)), None))
+        in_table = is_table_row and match.start() - header_end <= HEADER_REACH
+        if not is_table_row:
+            values = values[:1]
+            sentence_start = max(text.rfind(". ", 0, match.start()), text.rfind("\n", 0, match.start())) + 1
+            sentence_end = text.find(". ", values[0].end(), line_end)
+            sentence_end = line_end if sentence_end == -1 else sentence_end
+            sentence_period = PERIOD_PATTERN.search(text, sentence_start, sentence_end)
+
+        previous_end = match.end()
+        for column, value in enumerate(values):
+            # "2024: 12 345" - perioden står i cellens kolumnrubrik
+            cell_period = _CELL_PERIOD.search(text, previous_end, value.start())
+            previous_end = value.end()
+            if cell_period:
+                period = cell_period.group(1)
+            elif header_columns and in_table and "|" in gap:
+                line_start = text.rfind("\n", 0, match.start()) + 1
+                cell = text.count("|", line_start, value.start())
+                period = header_columns[cell] if cell < len(header_columns) else None
+            elif is_table_row:
+                period = header_periods[column] if in_table and column < len(header_periods) else None
+            else:
+                period = sentence_period.group(0) if sentence_period else None
+            unit = normalize_unit(value.group("unit")) or label_unit or (header_unit if in_table else None)
+            if absolute and unit == "%":
+                # T.ex. en rad "Nettoomsättning, förändring %" i en tabell
+                continue
+            number = parse_number(value.group("number"))
+            if value.group("neg"):
+                number = -number
+            metric = match.lastgroup
+            if metric in _PER_SHARE_METRICS and _PER_SHARE.match(text, value.end()):
+                metric = _PER_SHARE_METRICS[metric]
+            facts.append(KeyFigure(
+                metric, match.group(0), number, value.group(0).strip(), unit,
+                re.sub(r"\s+", " ", period) if period else None, value.start()
+            ))
+    return facts
+
+
+def detect_metrics(question: str) -> List[str]:
+    """
+    Nyckeltalen som nämns i en fråga, i den ordning de förekommer.
+    """
+    return list(dict.fromkeys(m.lastgroup for m in _LABEL_SCANNER.finditer(question)))
+
+
+class FactIndex:
+    """
+    Dokumentets nyckeltal, uppslagbara per nyckeltal och (valfritt) period.
+    """
+
+    FILE = "facts.json"
+
+    def __init__(self, facts: Sequence[KeyFigure]):
+        self.facts = list(facts)
+        self.by_metric: Dict[str, List[KeyFigure]] = {}
+        for fact in self.facts:
+            self.by_metric.setdefault(fact.metric, []).append(fact)
+
+    @classmethod
+    def from_text(cls, text: str, spans: Optional[Sequence[Sequence[int]]] = None) -> "FactIndex":
+        """
+        Extraherar nyckeltalen ur hela källtexten och knyter dem till chunks via chunkarnas (start, end).
+        """
+        facts = extract_key_figures(text)
+        if spans is not None and len(spans):
+            spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+            positions = np.searchsorted(spans[:, 0], [fact.offset for fact in facts], side="right") - 1
+            facts = [
+                fact._replace(chunk=int(pos)) if pos >= 0 and fact.offset < spans[pos, 1] else fact
+                for fact, pos in zip(facts, positions.tolist())
+            ]
+        return cls(facts)
+
+    @classmethod
+    def from_chunks(cls, texts: Sequence[str]) -> "FactIndex":
+        """
+        För dokument utan källtext (t.ex. äldre cacher): chunk för chunk, offset räknas inom chunken.
+        """
+        facts = []
+        for i, text in enumerate(texts):
+            facts.extend(fact._replace(chunk=i) for fact in extract_key_figures(text))
+        return cls(facts)
+
+    def __len__(self) -> int:
+        return len(self.facts)
+
+    def lookup(self, question: str) -> List[KeyFigure]:
+        """
+        Fakta för nyckeltalen i frågan; nämner frågan en period (t.ex. 2024) filtreras på den.
+        """
+        periods = [re.sub(r"\s+", " ", m.group(0)).lower() for m in PERIOD_PATTERN.finditer(question)]
+        hits = []
+        for metric in detect_metrics(question):
+            found = self.by_metric.get(metric) or self.by_metric.get(_FALLBACK_METRICS.get(metric), [])
+            hits.extend(fact for fact in found if fact not in hits)
+        if periods:
+            dated = [fact for fact in hits if fact.period and any(p in fact.period.lower() for p in periods)]
+            if dated:
+                return dated
+        return hits
+
+    def chunk_ranking(self, question: str) -> np.ndarray:
+        """
+        Chunks som innehåller frågans nyckeltal, flest träffar först (för retrieval-boost).
+        """
+        counts: Dict[int, int] = {}
+        for fact in self.lookup(question):
+            if fact.chunk is not None:
+                counts[fact.chunk] = counts.get(fact.chunk, 0) + 1
+        return np.array(sorted(counts, key=lambda chunk: (-counts[chunk], chunk)), dtype=np.int64)
+
+    def save(self, path: str):
+        with open(os.path.join(path, self.FILE), "w", encoding="utf-8") as f:
+            json.dump([fact._asdict() for fact in self.facts], f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["FactIndex"]:
+        file_path = os.path.join(path, cls.FILE)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r", encoding="utf-8") as f:
+            return cls([KeyFigure(**item) for item in json.load(f)])
+
+
+def format_facts(facts: Sequence[KeyFigure], limit: int = 10) -> str:
+    """
+    Kort textlista över fakta, t.ex. för visning eller som extra kontext till GPT.
+    """
+    lines = []
+    for fact in facts[:limit]:
+        unit = f" {fact.unit}" if fact.unit else ""
+        period = f" ({fact.period})" if fact.period else ""
+        lines.append(f"- {fact.name}{period}: {fact.raw if not fact.unit or fact.unit in fact.raw else fact.raw + unit}")
+    return "\n".join(lines)
@@ -0,0 +1,176 @@
+# core/lexical.py
+"""
+Lexikal sökning: tokenisering för svenska och engelska och ett BM25-index per dokument.
+
+Indexet är ett inverterat index i CSR-form (posting-listor per term i sammanhängande
+NumPy-arrayer), byggs en gång när dokumentet läses in och sparas bredvid vektorerna i
+dokumentcachen. En fråga poängsätts genom att bara frågetermernas posting-listor läses.
+"""
+import os
+import re
+import json
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Tal med decimal- eller tusentalsavgränsare hålls ihop ("12,5", "1.234"); övrigt delas på icke-bokstäver
+TOKEN_PATTERN = re.compile(r"\d+(?:[.,]\d+)*|[^\W\d_]+")
+
+STOPWORDS = frozenset("""
+och i att det som en på är av för med till den har de inte om ett var vi men så
+från eller man vid under sig hade sin kan också efter detta dessa där när mot än
+samt skall ska bli blev per vara varit dess deras vår våra vad hur mellan
+the a an and or of to in on for by with at from as is are was were be been has have
+had it its this that these those which what how not but into than per our we
+""".split())
+
+# Svenska och engelska böjningsändelser, längsta först. Ändelser tas bort upprepat så länge
+# minst tre tecken blir kvar, så att alla böjningsformer får samma stam ("utdelning",
+# "utdelningen" och "utdelningarna" -> "utdeln"; "aktierna" -> "akti"; "dividends" -> "dividend")
+_SUFFIXES = (
+    "arnas", "ernas", "ornas", "heten", "heter", "arna", "erna", "orna",
+    "ande", "ende", "ing", "ens", "ets", "ies", "en", "et", "na", "ar", "er", "or", "es",
+    "a", "e", "s",
+)
+_MIN_STEM = 3
+
+# Sparas med indexet (se BM25Index.save); ett index från en annan version av tokeniseringen
+# läses inte in utan byggs om från chunkarna. Höj när tokenize eller stem ändras.
+TOKENIZER_VERSION = 2
+
+
+def stem(token: str) -> str:
+    if token[0].isdigit():
+        return token
+    stripped = True
+    while stripped:
+        stripped = False
+        for suffix in _SUFFIXES:
+            if token.endswith(suffix) and len(token) - len(suffix) >= _MIN_STEM:
+                token = token[:-len(suffix)]
+                stripped = True
+                break
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Delar texten i gemena, stammade termer utan stoppord (samma behandling för frågor och chunks).
+    """
+    return [stem(token) for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    Inverterat index med BM25-poäng (Okapi, k1/b) över ett dokuments chunks.
+
+    Posting-listan för term t ligger i doc_ids[indptr[t]:indptr[t + 1]] med
+    termfrekvenserna i samma intervall av term_freqs.
+    """
+
+    FILES = ("bm25_terms.json", "bm25_indptr.npy", "bm25_docs.npy", "bm25_tfs.npy", "bm25_lengths.npy")
+
+    def __init__(
+        self,
+        terms: Dict[str, int],
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        term_freqs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = BM25_K1,
+        b: float = BM25_B
+    ):
+        self.terms = terms
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        n_docs = len(doc_lengths)
+        average_length = float(np.mean(doc_lengths)) if n_docs else 0.0
+        # Längdnormaliseringen per chunk beräknas en gång i stället för per fråga
+        self._length_norm = (k1 * (1.0 - b + b * np.asarray(doc_lengths, dtype=np.float32) / (average_length or 1.0))).astype(np.float32)
+        df = np.diff(np.asarray(indptr))
+        self._idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts: Sequence[str], k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        terms: Dict[str, int] = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        freqs: List[int] = []
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(terms.setdefault(term, len(terms)))
+                doc_ids.append(doc_id)
+                freqs.append(tf)
+        term_ids_arr = np.asarray(term_ids, dtype=np.int32)
+        # Stabil sortering på term behåller chunk-ordningen inom varje posting-lista
+        order = np.argsort(term_ids_arr, kind="stable")
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(term_ids_arr, minlength=len(terms)))
+        return cls(
+            terms, indptr,
+            np.asarray(doc_ids, dtype=np.int32)[order],
+            np.asarray(freqs, dtype=np.float32)[order],
+            doc_lengths, k1, b
+        )
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        BM25-poäng för alla chunks (0 för chunks utan någon av frågans termer).
+        """
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.terms.get(term)
+            if term_id is None:
+                continue
+            start, end = int(self.indptr[term_id]), int(self.indptr[term_id + 1])
+            docs = self.doc_ids[start:end]
+            tf = self.term_freqs[start:end]
+            # Varje chunk förekommer högst en gång per posting-lista, så vanlig indexering räcker
+            scores[docs] += self._idf[term_id] * tf * (self.k1 + 1.0) / (tf + self._length_norm[docs])
+        return scores
+
+    def save(self, path: str):
+        with open(os.path.join(path, "bm25_terms.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {"tokenizer": TOKENIZER_VERSION, "k1": self.k1, "b": self.b, "terms": list(self.terms)},
+                f, ensure_ascii=False
+            )
+        np.save(os.path.join(path, "bm25_indptr.npy"), self.indptr)
+        np.save(os.path.join(path, "bm25_docs.npy"), self.doc_ids)
+        np.save(os.path.join(path, "bm25_tfs.npy"), self.term_freqs)
+        np.save(os.path.join(path, "bm25_lengths.npy"), self.doc_lengths)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["BM25Index"]:
+        """
+        Öppnar ett sparat index (posting-arrayerna som memmap), eller None om det saknas
+        eller byggts med en annan version av tokeniseringen (då byggs det om från chunkarna).
+        """
+        if not all(os.path.exists(os.path.join(path, name)) for name in cls.FILES):
+            return None
+        with open(os.path.join(path, "bm25_terms.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("tokenizer") != TOKENIZER_VERSION:
+            return None
+        return cls(
+            {term: i for i, term in enumerate(meta["terms"])},
+            np.load(os.path.join(path, "bm25_indptr.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "bm25_docs.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "bm25_tfs.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "bm25_lengths.npy")),
+            meta["k1"], meta["b"]
+        )
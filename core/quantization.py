@@ -0,0 +1,179 @@
+# core/quantization.py
+"""
+Kompakta embeddings för en snabb förstasökning, med exakt omrankning i full precision.
+
+- Matryoshka-trunkering: text-embedding-3-modellerna är tränade så att de första
+  dimensionerna bär det mesta av innehållet; de första 'dims' dimensionerna (256/512)
+  normaliseras om och används som en kortare vektor.
+- Skalär kvantisering till int8 per dimension (symmetrisk, en skala per dimension
+  skattad ur datat), eller float16 (sparar lika mycket minne som int8 på halva
+  dimensionerna, men NumPy räknar långsamt på float16; int8 är oftast bättre).
+
+En int8-vektor med 256 dimensioner tar 256 byte mot 6 144 byte för 1536 float32.
+Poängen blir ungefärliga, så de bästa 'top_k * rerank_factor' kandidaterna rankas om
+mot de fullständiga vektorerna (som kan ligga kvar som memmap på disk).
+"""
+import os
+import json
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from core.retrieval import normalize_rows, top_k_indices
+
+QUANTIZATION_DTYPES = ("float32", "float16", "int8")
+# Andel av värdena per dimension som ryms utan klippning när int8-skalan skattas
+INT8_QUANTILE = 0.9995
+RERANK_FACTOR = 10
+# Koderna avkodas i block om ungefär så många värden (block som ryms i cachen är snabbast)
+BLOCK_ELEMENTS = 1 << 18
+# Skalorna skattas på högst så många vektorer
+SCALE_SAMPLE_SIZE = 65536
+
+
+def truncate_dims(matrix: np.ndarray, dims: Optional[int]) -> np.ndarray:
+    """
+    Matryoshka-trunkering: de första 'dims' dimensionerna, L2-normaliserade igen.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        return truncate_dims(matrix[None, :], dims)[0]
+    if dims is None or dims >= matrix.shape[1]:
+        return normalize_rows(matrix)
+    return normalize_rows(matrix[:, :dims])
+
+
+class CompressedVectors:
+    """
+    Trunkerade och/eller kvantiserade vektorer för ungefärlig cosinuslikhet.
+
+    För int8 gäller vektor ≈ codes * scales (per dimension); skalorna förs över på
+    frågan, så att poängen blir codes @ (fråga * scales) utan att vektorerna avkvantiseras.
+    """
+
+    def __init__(self, codes: np.ndarray, dims: int, dtype: str, scales: Optional[np.ndarray] = None):
+        self.codes = codes
+        self.dims = dims
+        self.dtype = dtype
+        self.scales = scales
+
+    @classmethod
+    def fit(cls, matrix: np.ndarray, dims: Optional[int] = None, dtype: str = "int8") -> "CompressedVectors":
+        """
+        Skattar eventuella int8-skalor ur 'matrix' och kodar den.
+        """
+        if dtype not in QUANTIZATION_DTYPES:
+            raise ValueError(f"Okänd kvantisering: {dtype} (välj bland {', '.join(QUANTIZATION_DTYPES)}).")
+        truncated = truncate_dims(matrix, dims)
+        scales = None
+        if dtype == "int8":
+            if len(truncated):
+                sample = truncated
+                if len(sample) > SCALE_SAMPLE_SIZE:
+                    sample = sample[np.random.default_rng(0).choice(len(sample), SCALE_SAMPLE_SIZE, replace=False)]
+                scales = np.quantile(np.abs(sample), INT8_QUANTILE, axis=0).astype(np.float32) / 127.0
+            else:
+                scales = np.ones(truncated.shape[1], dtype=np.float32)
+            scales[scales == 0] = 1.0
+        compressed = cls(np.empty((0, truncated.shape[1]), dtype=dtype), truncated.shape[1], dtype, scales)
+        compressed.codes = compressed._encode_truncated(truncated)
+        return compressed
+
+    def _encode_truncated(self, truncated: np.ndarray) -> np.ndarray:
+        if self.dtype == "int8":
+            return np.clip(np.rint(truncated / self.scales), -127, 127).astype(np.int8)
+        return truncated.astype(self.dtype)
+
+    def encode(self, matrix: np.ndarray) -> np.ndarray:
+        """
+        Kodar nya vektorer med samma dimensioner och skalor (värden utanför skalan klipps).
+        """
+        return self._encode_truncated(truncate_dims(matrix, self.dims))
+
+    def extend(self, matrix: np.ndarray):
+        self.codes = np.concatenate([self.codes, self.encode(matrix)])
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    def prepare_query(self, query_embedding: Sequence[float]) -> np.ndarray:
+        query = truncate_dims(np.asarray(query_embedding, dtype=np.float32), self.dims)
+        return query * self.scales if self.scales is not None else query
+
+    def scores(self, query_embedding: Sequence[float], rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Ungefärlig cosinuslikhet för alla vektorer, eller bara för 'rows'.
+        Koderna görs om till float32 block för block, så att minnet hålls nere.
+        """
+        query = self.prepare_query(query_embedding)
+        n = len(self) if rows is None else len(rows)
+        block_size = max(64, BLOCK_ELEMENTS // self.dims)
+        out = np.empty(n, dtype=np.float32)
+        for start in range(0, n, block_size):
+            block = self.codes[start:start + block_size] if rows is None else self.codes[rows[start:start + block_size]]
+            out[start:start + block_size] = block.astype(np.float32) @ query
+        return out
+
+    def save(self, path: str):
+        np.save(os.path.join(path, "compact_codes.npy"), self.codes)
+        if self.scales is not None:
+            np.save(os.path.join(path, "compact_scales.npy"), self.scales)
+        with open(os.path.join(path, "compact.json"), "w", encoding="utf-8") as f:
+            json.dump({"dims": self.dims, "dtype": self.dtype}, f)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["CompressedVectors"]:
+        header_path = os.path.join(path, "compact.json")
+        if not os.path.exists(header_path):
+            return None
+        with open(header_path, "r", encoding="utf-8") as f:
+            header = json.load(f)
+        scales_path = os.path.join(path, "compact_scales.npy")
+        return cls(
+            np.load(os.path.join(path, "compact_codes.npy")), header["dims"], header["dtype"],
+            np.load(scales_path) if os.path.exists(scales_path) else None
+        )
+
+
+def rerank_exact(
+    vectors: np.ndarray,
+    query_embedding: Sequence[float],
+    candidates: np.ndarray,
+    top_k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exakt cosinuslikhet för kandidaterna mot de fullständiga (normaliserade) vektorerna.
+    Returnerar (index i 'candidates', poäng) för de top_k bästa, sorterade fallande.
+    """
+    query = normalize_rows(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+    # Sorterade rader ger sekventiell läsning när 'vectors' är en memmap
+    order = np.argsort(candidates, kind="stable")
+    scores = np.empty(len(candidates), dtype=np.float32)
+    scores[order] = np.asarray(vectors[candidates[order]], dtype=np.float32) @ query
+    best = top_k_indices(scores, top_k)
+    return best, scores[best]
+
+
+def compressed_search(
+    compressed: CompressedVectors,
+    vectors: np.ndarray,
+    query_embedding: Sequence[float],
+    top_k: int,
+    rows: Optional[np.ndarray] = None,
+    rerank_factor: int = RERANK_FACTOR
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Tvåstegssökning: ungefärliga poäng över de kompakta vektorerna ('rows' eller alla),
+    därefter exakt omrankning av de top_k * rerank_factor bästa.
+    Returnerar (radindex, exakta poäng) för de top_k bästa, sorterade fallande.
+    """
+    approximate = compressed.scores(query_embedding, rows)
+    shortlist = top_k_indices(approximate, max(top_k, top_k * rerank_factor))
+    if rows is not None:
+        shortlist = rows[shortlist]
+    best, scores = rerank_exact(vectors, query_embedding, shortlist, top_k)
+    return shortlist[best], scores
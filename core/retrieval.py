@@ -0,0 +1,220 @@
+# core/retrieval.py
+
+import os
+import numpy as np
+from typing import List, Dict, Any, Optional, Sequence, Tuple, Union
+
+from core.key_figures import FactIndex
+from core.lexical import BM25Index
+
+# "hybrid" (vektorer + BM25 med reciprocal rank fusion), "vector" eller "lexical"
+RETRIEVAL_MODES = ("hybrid", "vector", "lexical")
+DEFAULT_RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# RRF-konstanten k (60 enligt Cormack m.fl.) och hur djupt varje rankning läses
+RRF_K = 60
+RRF_DEPTH = 50
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    L2-normaliserar varje rad i en matris (nollrader lämnas orörda).
+
+    Args:
+        matrix (np.ndarray): 2D-matris med en vektor per rad.
+
+    Returns:
+        np.ndarray: Ny float32-matris där varje rad har längd 1.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returnerar index för de k högsta värdena, sorterade fallande.
+
+    Använder argpartition (O(n)) och sorterar bara de k vinnarna
+    i stället för att sortera hela poänglistan.
+    """
+    n = scores.shape[0]
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= n:
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class DocumentIndex:
+    """
+    Håller ett dokuments embeddings som en sammanhängande, förnormaliserad
+    float32-matris så att en fråga kan poängsättas med en enda
+    matris-vektor-multiplikation.
+    """
+
+    def __init__(
+        self,
+        texts: Sequence[str],
+        embeddings: np.ndarray,
+        normalized: bool = False,
+        lexical: Optional[BM25Index] = None,
+        facts: Optional[FactIndex] = None,
+        spans: Optional[np.ndarray] = None
+    ):
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(texts):
+            raise ValueError("Antalet texter och embeddings måste stämma överens.")
+        if normalized and embeddings.dtype == np.float32:
+            # Redan normaliserad float32 (t.ex. en memmap) används utan kopiering
+            self.matrix = embeddings
+        else:
+            self.matrix = normalize_rows(embeddings)
+        self.texts = texts
+        # Chunkarnas (start, end) i källtexten, om de är kända (används av core.context_assembly)
+        self.spans = spans
+        self._lexical = lexical
+        self._facts = facts
+
+    @classmethod
+    def from_embedded_chunks(cls, embedded_chunks: List[Dict[str, Any]]) -> "DocumentIndex":
+        """
+        Bygger ett index från appens format: [{"text": ..., "embedding": [...]}, ...].
+        """
+        texts = [item.get("text", "") for item in embedded_chunks]
+        if not embedded_chunks:
+            return cls(texts, np.empty((0, 0), dtype=np.float32), normalized=True)
+        embeddings = np.array([item["embedding"] for item in embedded_chunks], dtype=np.float32)
+        return cls(texts, embeddings)
+
+    @classmethod
+    def from_cached_document(cls, document) -> "DocumentIndex":
+        """
+        Bygger ett index direkt på en CachedDocument (utils.cache_utils) utan att kopiera vektorerna.
+        """
+        return cls(
+            document.texts, document.embeddings,
+            normalized=document.header.get("normalized", False),
+            lexical=document.lexical, facts=document.facts, spans=document.spans
+        )
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def lexical(self) -> BM25Index:
+        """
+        Dokumentets BM25-index; byggs vid första användningen om det inte sparats i cachen.
+        """
+        return self.ensure_lexical()
+
+    @property
+    def facts(self) -> FactIndex:
+        """
+        Dokumentets nyckeltal (core.key_figures); extraheras chunk för chunk om de inte sparats i cachen.
+        """
+        return self.ensure_facts()
+
+    def ensure_lexical(self) -> BM25Index:
+        """
+        Bygger BM25-indexet nu om det saknas (t.ex. i förväg i en arbetstråd i stället för vid första frågan).
+        """
+        if self._lexical is None:
+            self._lexical = BM25Index.build(self.texts)
+        return self._lexical
+
+    def ensure_facts(self) -> FactIndex:
+        """
+        Extraherar nyckeltalen nu om de saknas; se ensure_lexical.
+        """
+        if self._facts is None:
+            self._facts = FactIndex.from_chunks(self.texts)
+        return self._facts
+
+    def cosine_scores(self, query_embedding: Sequence[float]) -> np.ndarray:
+        """
+        Cosinuslikhet mellan frågan och alla chunks i ett enda matrisanrop.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        return self.matrix @ query
+
+
+def as_document_index(embedded_chunks: Union[DocumentIndex, List[Dict[str, Any]]]) -> DocumentIndex:
+    """
+    Returnerar ett DocumentIndex oavsett om indata redan är ett index eller en lista med dicts.
+    """
+    if isinstance(embedded_chunks, DocumentIndex):
+        return embedded_chunks
+    return DocumentIndex.from_embedded_chunks(embedded_chunks)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[np.ndarray], n: int, k: int = RRF_K) -> np.ndarray:
+    """
+    Slår ihop rankningar (index sorterade bäst först) till poängen sum(1 / (k + rang)) per chunk.
+    """
+    fused = np.zeros(n, dtype=np.float32)
+    for ranking in rankings:
+        fused[ranking] += 1.0 / (k + np.arange(1, len(ranking) + 1, dtype=np.float32))
+    return fused
+
+
+def rank_chunks(
+    index: DocumentIndex,
+    query_embedding: Sequence[float],
+    question: str,
+    top_k: int,
+    mode: Optional[str] = None,
+    rrf_k: int = RRF_K,
+    depth: int = RRF_DEPTH
+) -> List[Tuple[float, str]]:
+    """
+    Rankar chunks för en fråga och returnerar (poäng, text) för de top_k bästa (se rank_chunk_indices).
+    """
+    order, scores = rank_chunk_indices(index, query_embedding, question, top_k, mode, rrf_k, depth)
+    return [(float(score), index.texts[i]) for i, score in zip(order.tolist(), scores.tolist())]
+
+
+def rank_chunk_indices(
+    index: DocumentIndex,
+    query_embedding: Sequence[float],
+    question: str,
+    top_k: int,
+    mode: Optional[str] = None,
+    rrf_k: int = RRF_K,
+    depth: int = RRF_DEPTH
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rankar chunks för en fråga. Returnerar (chunkindex, poäng) för de top_k bästa, sorterade fallande.
+
+    - "vector": cosinuslikhet.
+    - "lexical": BM25 över dokumentets inverterade index.
+    - "hybrid": reciprocal rank fusion av de 'depth' bästa ur båda rankningarna,
+      plus chunks som innehåller frågans nyckeltal enligt faktaindexet. Exakta
+      termer som "EBITDA" eller "utdelning per aktie" lyfts även när embeddingen
+      rankar dem lågt. Poängen är då RRF-poängen.
+    """
+    mode = mode or DEFAULT_RETRIEVAL_MODE
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Okänt sökläge: {mode} (välj bland {', '.join(RETRIEVAL_MODES)}).")
+    if len(index) == 0 or top_k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if mode == "lexical":
+        scores = index.lexical.scores(question)
+    else:
+        scores = index.cosine_scores(query_embedding)
+        if mode == "hybrid":
+            depth = max(depth, top_k)
+            lexical_scores = index.lexical.scores(question)
+            lexical_order = top_k_indices(lexical_scores, depth)
+            # Chunks utan någon frågeterm har ingen lexikal rang
+            lexical_order = lexical_order[lexical_scores[lexical_order] > 0]
+            fact_order = index.facts.chunk_ranking(question)[:depth]
+            scores = reciprocal_rank_fusion(
+                [top_k_indices(scores, depth), lexical_order, fact_order], len(index), rrf_k
+            )
+    order = top_k_indices(scores, top_k)
+    return order, scores[order]
@@ -0,0 +1,140 @@
+# core/spreadsheet.py
+"""
+Inläsning av kalkylblad (Excel) som kompakta radposter.
+
+Alla flikar strömmas med openpyxl i read-only-läge, så att även stora arbetsböcker
+läses med begränsat minne. Raderna skrivs som "|"-avgränsade poster utan utfyllnad
+("Nettoomsättning | 12345 | 11002,5") i radgrupper om högst GROUP_MAX_TOKENS tokens.
+Varje grupp inleds med fliknamn, radintervall och kolumnrubrikerna:
+
+    ## Resultat (rad 1–20)
+    MSEK | 2024 | 2023
+    Nettoomsättning | 12345 | 11002.5
+
+Gruppernas rubriker gör att core.chunking (iter_token_chunks och iter_content_defined_chunks)
+delar texten i radgrupper som var för sig säger vilken flik och vilka kolumner de kommer från.
+"""
+import io
+import datetime
+from typing import Any, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from core.chunking import DEFAULT_MAX_TOKENS
+from utils.token_utils import count_tokens
+
+# Radgrupperna packas upp till samma tokenbudget som chunkarna, så att en grupp blir en chunk
+GROUP_MAX_TOKENS = DEFAULT_MAX_TOKENS
+MAX_CELL_CHARS = 200
+
+
+def format_cell(value: Any) -> str:
+    """
+    Cellvärdet som kort text: heltal utan decimaler, datum som ÅÅÅÅ-MM-DD, blanksteg komprimerat.
+    """
+    if isinstance(value, bool):
+        return "ja" if value else "nej"
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return f"{value:.6f}".rstrip("0").rstrip(".")
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat() if value.time() == datetime.time() else value.isoformat(sep=" ")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return " ".join(str(value).split())[:MAX_CELL_CHARS]
+
+
+def _is_header_row(cells: Sequence[Any]) -> bool:
+    # En rubrikrad har bara text (eller årtal) i sina ifyllda celler
+    values = [cell for cell in cells if cell is not None and cell != ""]
+    return bool(values) and all(
+        isinstance(cell, str) or (isinstance(cell, int) and 1900 <= cell <= 2100) for cell in values
+    )
+
+
+def _format_row(cells: Sequence[Any]) -> str:
+    # Tomma celler behålls mellan "|" så att kolumnerna står kvar under sina rubriker
+    values = [format_cell(cell) if cell is not None else "" for cell in cells]
+    while values and not values[-1]:
+        values.pop()
+    return " | ".join(values)
+
+
+def iter_sheet_groups(
+    sheet_name: str, rows: Iterable[Tuple[int, Sequence[Any]]], max_tokens: int = GROUP_MAX_TOKENS
+) -> Iterator[str]:
+    """
+    Gör om en fliks rader, (radnummer i bladet, tupel med cellvärden), till textblock om
+    högst 'max_tokens' tokens. Den första ifyllda raden blir kolumnrubriker om den bara
+    innehåller text (eller årtal) och upprepas i varje block; tomma rader hoppas över.
+    Blockens "rad a–b" är bladets radnummer för blockets första och sista rad.
+    """
+    header: Optional[str] = None
+    header_tokens = 0
+    group: List[str] = []
+    group_tokens = 0
+    first_row = last_row = 0
+
+    def block() -> str:
+        title = f"## {sheet_name} (rad {first_row}–{last_row})\n"
+        return title + (header + "\n" if header else "") + "\n".join(group) + "\n\n"
+
+    for number, cells in rows:
+        if all(cell is None or cell == "" for cell in cells):
+            continue
+        if header is None and not group and _is_header_row(cells):
+            header = _format_row(cells)
+            header_tokens = count_tokens(header + "\n")
+            continue
+        row = _format_row(cells) + "\n"
+        row_tokens = count_tokens(row)
+        # Rubrikraden "## flik (rad a–b)" räknas grovt som 16 tokens
+        if group and header_tokens + 16 + group_tokens + row_tokens > max_tokens:
+            yield block()
+            group, group_tokens = [], 0
+        if not group:
+            first_row = number
+        last_row = number
+        group.append(row.rstrip("\n"))
+        group_tokens += row_tokens
+    if group:
+        yield block()
+
+
+def iter_spreadsheet_text(data: bytes, max_tokens: int = GROUP_MAX_TOKENS) -> Iterator[str]:
+    """
+    Strömmar en .xlsx/.xlsm-arbetsbok flik för flik och ger texten radgrupp för radgrupp.
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            # Raderna ges från rad 1 och saknade rader fylls i, så att numreringen följer bladet
+            rows = enumerate(sheet.iter_rows(min_row=1, values_only=True), start=1)
+            yield from iter_sheet_groups(sheet.title, rows, max_tokens)
+    finally:
+        # read-only-arbetsböcker håller zip-filen öppen tills de stängs
+        workbook.close()
+
+
+def iter_legacy_spreadsheet_text(data: bytes, max_tokens: int = GROUP_MAX_TOKENS) -> Iterator[str]:
+    """
+    Som iter_spreadsheet_text för det gamla .xls-formatet (via pandas, som läser hela fliken).
+    """
+    import pandas as pd
+
+    sheets = pd.read_excel(io.BytesIO(data), sheet_name=None, header=None)
+    for name, frame in sheets.items():
+        # NumPy-skalärer görs om till Python-värden, så att årtal i rubrikraden känns igen
+        # Indexet är bladets radnummer räknat från 0 (header=None)
+        rows = (
+            (index + 1, tuple(None if pd.isna(cell) else getattr(cell, "item", lambda: cell)() for cell in row))
+            for index, *row in frame.itertuples(index=True)
+        )
+        yield from iter_sheet_groups(str(name), rows, max_tokens)
+
+
+def extract_spreadsheet_text(data: bytes, filename: str = "", max_tokens: int = GROUP_MAX_TOKENS) -> str:
+    if filename.lower().endswith(".xls"):
+        return "".join(iter_legacy_spreadsheet_text(data, max_tokens))
+    return "".join(iter_spreadsheet_text(data, max_tokens))
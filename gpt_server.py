@@ -1,9 +1,64 @@
-from fastapi import FastAPI
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from core.gpt_logic import generate_gpt_answer
 
-app = FastAPI()
+from core.embedding_utils import aget_embedding
+from core.file_processing import iter_document_text
+from core.gpt_logic import (
+    ANSWER_PROMPT_VERSION,
+    agenerate_gpt_answer,
+    astream_gpt_answer,
+    astream_full_rapportanalys,
+    detect_language,
+    select_context,
+    select_relevant_chunks,
+)
+from core.ingestion import CHUNKER_PARAMS, EmptyDocumentError, ingest_document as build_document_cache
+from core.retrieval import DocumentIndex
+from services.openai_service import create_async_openai_client
+from utils.answer_cache import get_answer_cache
+from utils.cache_utils import (
+    get_document_fingerprint,
+    get_document_cache_dir,
+    open_document_cache,
+)
+from utils.metrics import metrics, observe
+
+# Gränser per worker-process (kan styras med miljövariabler)
+MAX_CONCURRENT_REQUESTS = int(os.getenv("GPT_SERVER_MAX_CONCURRENCY", "64"))
+MAX_CONCURRENT_INGESTS = int(os.getenv("GPT_SERVER_MAX_INGESTS", "4"))
+REQUEST_TIMEOUT = float(os.getenv("GPT_SERVER_REQUEST_TIMEOUT", "60"))
+QUEUE_TIMEOUT = float(os.getenv("GPT_SERVER_QUEUE_TIMEOUT", "10"))
+INDEX_CACHE_SIZE = int(os.getenv("GPT_SERVER_INDEX_CACHE_SIZE", "32"))
+ANSWER_MODEL = "gpt-4o"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # En delad AsyncOpenAI-klient (med anslutningspool) per worker
+    app.state.openai = create_async_openai_client(max_connections=MAX_CONCURRENT_REQUESTS)
+    app.state.request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    app.state.ingest_slots = asyncio.Semaphore(MAX_CONCURRENT_INGESTS)
+    app.state.indexes = OrderedDict()
+    # LRU:n ändras både från to_thread-trådar och event-loopen
+    app.state.indexes_lock = threading.Lock()
+    app.state.ingesting = {}
+    yield
+    await app.state.openai.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -12,11 +67,370 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Routens mall (t.ex. /ask) i stället för den faktiska sökvägen håller nere antalet serier;
+    # för strömmade svar mäts tiden till första byte
+    route = request.scope.get("route")
+    observe(
+        "http_request_duration_seconds", time.perf_counter() - start,
+        path=getattr(route, "path", "unmatched"), method=request.method, status=response.status_code
+    )
+    return response
+
+
 class Question(BaseModel):
     question: str
 
+class IngestRequest(BaseModel):
+    text: str
+    doc_id: Optional[str] = None
+
+class AnalysisRequest(BaseModel):
+    text: str
+
+
+async def _acquire(semaphore: asyncio.Semaphore):
+    # Väntar högst QUEUE_TIMEOUT sekunder på en ledig plats, annars 503
+    try:
+        await asyncio.wait_for(semaphore.acquire(), QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Servern är överbelastad, försök igen.")
+
+
+@asynccontextmanager
+async def _slot(semaphore: asyncio.Semaphore):
+    await _acquire(semaphore)
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+async def _with_timeout(coro):
+    try:
+        return await asyncio.wait_for(coro, REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Tidsgränsen för anropet överskreds.")
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class _SlotRelease:
+    """
+    Släpper en tagen plats i en semafor högst en gång: när strömmen tar slut och när
+    svaret har skickats eller avbrutits (_SlotStreamingResponse).
+    """
+
+    def __init__(self, semaphore: asyncio.Semaphore):
+        self._semaphore = semaphore
+        self._released = False
+
+    async def __call__(self):
+        if not self._released:
+            self._released = True
+            self._semaphore.release()
+
+
+class _SlotStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse som alltid släpper platsen efter sig. Kopplar klienten ned innan
+    strömmen börjat itereras körs generatorns finally aldrig, och en BackgroundTask
+    hoppas över när sändningen misslyckas; därför släpps platsen här i ett finally.
+    """
+
+    def __init__(self, release: _SlotRelease, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._release()
+
+
+async def _event_stream(release: _SlotRelease, deltas: AsyncIterator[str], first_event: str = None, on_complete=None):
+    """
+    Skickar textbitarna som Server-Sent Events ("token"), följt av "done" eller "error".
+    Platsen är redan tagen och släpps med 'release' när strömmen tar slut eller avbryts.
+    REQUEST_TIMEOUT gäller här som längsta tystnad mellan två bitar. 'on_complete'
+    anropas (i en tråd) med hela texten när strömmen avslutats utan fel.
+    """
+    try:
+        if first_event:
+            yield first_event
+        parts = []
+        while True:
+            try:
+                delta = await asyncio.wait_for(deltas.__anext__(), REQUEST_TIMEOUT)
+            except StopAsyncIteration:
+                break
+            parts.append(delta)
+            yield _sse("token", {"text": delta})
+        if on_complete and parts:
+            await asyncio.to_thread(on_complete, "".join(parts))
+        yield _sse("done", {})
+    except asyncio.TimeoutError:
+        yield _sse("error", {"detail": "Tidsgränsen för anropet överskreds."})
+    except RuntimeError as e:
+        yield _sse("error", {"detail": str(e)})
+    finally:
+        await deltas.aclose()
+        await release()
+
+
+def _streaming_response(
+    semaphore: asyncio.Semaphore, deltas: AsyncIterator[str], first_event: str = None, on_complete=None
+) -> StreamingResponse:
+    """
+    SSE-svar för textbitarna i 'deltas'; platsen i 'semaphore' är redan tagen.
+    """
+    release = _SlotRelease(semaphore)
+    return _SlotStreamingResponse(
+        release,
+        _event_stream(release, deltas, first_event, on_complete),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _get_index(doc_id: str) -> Optional[DocumentIndex]:
+    """
+    Returnerar dokumentets sökindex, med en liten LRU-cache av öppnade index per worker.
+    """
+    indexes: OrderedDict = app.state.indexes
+    with app.state.indexes_lock:
+        index = indexes.get(doc_id)
+        if index is not None:
+            indexes.move_to_end(doc_id)
+            return index
+    # Indexet byggs utan låset; två samtidiga byggen av samma dokument ger samma resultat
+    cached_doc = open_document_cache(get_document_cache_dir(doc_id))
+    if cached_doc is None:
+        return None
+    index = DocumentIndex.from_cached_document(cached_doc)
+    # Äldre cacher saknar BM25- och faktaindex; bygg dem här i tråden i stället för vid första frågan
+    index.ensure_lexical()
+    index.ensure_facts()
+    with app.state.indexes_lock:
+        index = indexes.setdefault(doc_id, index)
+        indexes.move_to_end(doc_id)
+        while len(indexes) > INDEX_CACHE_SIZE:
+            indexes.popitem(last=False)
+    return index
+
+
+def _forget_index(doc_id: str):
+    with app.state.indexes_lock:
+        app.state.indexes.pop(doc_id, None)
+
+
+async def _require_index(doc_id: Optional[str]) -> DocumentIndex:
+    if not doc_id:
+        raise HTTPException(status_code=400, detail="doc_id saknas; ladda upp dokumentet via /ingest först.")
+    index = await asyncio.to_thread(_get_index, doc_id)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"Okänt doc_id: {doc_id}")
+    return index
+
+
+async def _lookup_answer(doc_id: str, question: str, context: str, query_embed, use_cache: bool):
+    """
+    Slår upp svaret i svarscachen (exakt eller semantiskt). Returnerar (träff eller None, språk).
+    """
+    language = detect_language(question)
+    if not use_cache:
+        return None, language
+    hit = await asyncio.to_thread(
+        get_answer_cache().lookup, doc_id, question, context, ANSWER_MODEL, ANSWER_PROMPT_VERSION, query_embed, language
+    )
+    return hit, language
+
+
+def _store_answer(doc_id: str, question: str, context: str, query_embed, language: str, answer: str):
+    get_answer_cache().put(doc_id, question, context, ANSWER_MODEL, ANSWER_PROMPT_VERSION, answer, query_embed, language)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.post("/ingest")
+async def ingest_document(item: IngestRequest) -> Dict[str, Any]:
+    if len(item.text.strip()) <= 20:
+        raise HTTPException(status_code=400, detail="Texten är för kort för analys.")
+    fingerprint = get_document_fingerprint(item.text)
+    doc_id = item.doc_id or fingerprint
+    cache_dir = get_document_cache_dir(doc_id)
+    # En cache från en annan chunker räknas som saknad och byggs om
+    cached_doc = await asyncio.to_thread(open_document_cache, cache_dir, CHUNKER_PARAMS)
+    # Ett eget doc_id med ny text (t.ex. en rättad rapport) indexeras om inkrementellt
+    if cached_doc is not None and cached_doc.header.get("fingerprint") in (None, fingerprint):
+        return {"doc_id": doc_id, "chunks": len(cached_doc), "cached": True}
+
+    # Samtidiga uppladdningar av samma dokument delar på ett och samma bygge
+    task = app.state.ingesting.get(doc_id)
+    if task is None:
+        async def build():
+            async with _slot(app.state.ingest_slots):
+                return await asyncio.to_thread(build_document_cache, item.text, cache_dir)
+        task = asyncio.ensure_future(build())
+        app.state.ingesting[doc_id] = task
+        task.add_done_callback(lambda _: app.state.ingesting.pop(doc_id, None))
+    try:
+        cached_doc, stats = await asyncio.shield(task)
+    except EmptyDocumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _forget_index(doc_id)
+    return {
+        "doc_id": doc_id, "chunks": len(cached_doc), "cached": False,
+        "reused": stats.reused + stats.cached, "embedded": stats.embedded,
+    }
+
+
+@app.post("/ingest/file")
+async def ingest_file(request: Request, filename: str = Query(...)) -> Dict[str, Any]:
+    """
+    Indexerar en fil som skickas som rå request-body (filnamnet anger formatet). En PDF
+    strömmas: sidorna chunkas och embeddas medan resten av filen extraheras. doc_id är
+    textens fingeravtryck, som för /ingest utan eget doc_id.
+    """
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="Filen är tom.")
+    # Samtidiga uppladdningar av samma fil delar på ett och samma bygge
+    key = "file:" + hashlib.sha256(data).hexdigest()
+    task = app.state.ingesting.get(key)
+    if task is None:
+        async def build():
+            async with _slot(app.state.ingest_slots):
+                return await asyncio.to_thread(build_document_cache, iter_document_text(data, filename))
+        task = asyncio.ensure_future(build())
+        app.state.ingesting[key] = task
+        task.add_done_callback(lambda _: app.state.ingesting.pop(key, None))
+    try:
+        cached_doc, stats = await asyncio.shield(task)
+    except EmptyDocumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    doc_id = cached_doc.header["fingerprint"]
+    _forget_index(doc_id)
+    return {
+        "doc_id": doc_id, "chunks": len(cached_doc),
+        "reused": stats.reused + stats.cached, "embedded": stats.embedded,
+    }
+
+
 @app.post("/ask")
-async def ask_question(item: Question):
-    # Just enkel svar utan embeddings
-    answer = generate_gpt_answer(item.question, context="")
-    return {"answer": answer}
+async def ask_question(
+    item: Question,
+    doc_id: Optional[str] = Query(default=None),
+    top_k: int = Query(default=7, ge=1, le=50),
+    use_cache: bool = Query(default=True),
+    mode: Optional[str] = Query(default=None, pattern="^(hybrid|vector|lexical)$")
+):
+    index = await _require_index(doc_id)
+
+    async def answer():
+        client = app.state.openai
+        query_embed = await aget_embedding(client, item.question)
+        # BM25, vektorsökningen och tokenräkningen är CPU-arbete som inte ska blockera event-loopen
+        assembled = await asyncio.to_thread(select_context, item.question, query_embed, index, top_k, mode)
+        context = assembled.text
+        hit, language = await _lookup_answer(doc_id, item.question, context, query_embed, use_cache)
+        if hit:
+            return hit.answer, assembled, hit.match
+        answer_text = await agenerate_gpt_answer(client, item.question, context, model=ANSWER_MODEL)
+        await asyncio.to_thread(_store_answer, doc_id, item.question, context, query_embed, language, answer_text)
+        return answer_text, assembled, None
+
+    async with _slot(app.state.request_slots):
+        answer_text, assembled, cached = await _with_timeout(answer())
+    return {
+        "answer": answer_text,
+        "doc_id": doc_id,
+        "cached": cached,
+        "sources": [{"score": score, "text": text} for score, text in assembled.sources],
+        "context_tokens": assembled.tokens,
+        "context_tokens_saved": assembled.tokens_saved,
+        "facts": [fact._asdict() for fact in index.facts.lookup(item.question)],
+    }
+
+
+@app.get("/facts")
+async def key_figures(doc_id: Optional[str] = Query(default=None), question: str = Query(default="")):
+    """
+    Nyckeltal ur dokumentets faktaindex, utan GPT-anrop. Med 'question' returneras bara
+    nyckeltalen (och perioden) som frågan nämner, annars alla.
+    """
+    index = await _require_index(doc_id)
+    facts = index.facts.lookup(question) if question else index.facts.facts
+    return {"doc_id": doc_id, "facts": [fact._asdict() for fact in facts]}
+
+
+@app.get("/cache/stats")
+async def answer_cache_stats():
+    return get_answer_cache().stats()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Workerns mätvärden i Prometheus textformat (tider per steg, tokens, cacheträffar, omförsök).
+    """
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/ask/stream")
+async def ask_question_stream(
+    item: Question,
+    doc_id: Optional[str] = Query(default=None),
+    top_k: int = Query(default=7, ge=1, le=50),
+    use_cache: bool = Query(default=True),
+    mode: Optional[str] = Query(default=None, pattern="^(hybrid|vector|lexical)$")
+):
+    """
+    Som /ask, men svaret strömmas som Server-Sent Events: först "sources", sedan "token"-händelser.
+    Ett cachat svar skickas som en enda "token"-händelse.
+    """
+    index = await _require_index(doc_id)
+    await _acquire(app.state.request_slots)
+    try:
+        client = app.state.openai
+        query_embed = await _with_timeout(aget_embedding(client, item.question))
+        context, top_chunks = await asyncio.to_thread(
+            select_relevant_chunks, item.question, query_embed, index, top_k, mode
+        )
+        hit, language = await _lookup_answer(doc_id, item.question, context, query_embed, use_cache)
+    except BaseException:
+        app.state.request_slots.release()
+        raise
+    sources = _sse("sources", [{"score": score, "text": text} for score, text in top_chunks])
+    if hit:
+        async def cached_delta():
+            yield hit.answer
+        return _streaming_response(app.state.request_slots, cached_delta(), sources)
+    deltas = astream_gpt_answer(client, item.question, context, model=ANSWER_MODEL)
+
+    def store(answer_text: str):
+        _store_answer(doc_id, item.question, context, query_embed, language, answer_text)
+
+    return _streaming_response(app.state.request_slots, deltas, sources, on_complete=store)
+
+
+@app.post("/analyze/stream")
+async def analyze_stream(item: AnalysisRequest):
+    """
+    Fullständig rapportanalys som Server-Sent Events ("token"-händelser).
+    """
+    if len(item.text.strip()) <= 20:
+        raise HTTPException(status_code=400, detail="Texten är för kort för analys.")
+    await _acquire(app.state.request_slots)
+    deltas = astream_full_rapportanalys(app.state.openai, item.text)
+    return _streaming_response(app.state.request_slots, deltas)
@@ -1,14 +1,230 @@
-import requests
-from bs4 import BeautifulSoup
+# services/html_downloader.py
+"""
+Hämtning av rapporter från webben.
+
+- En delad requests.Session per process (anslutningspool och omförsök vid 429/5xx) och
+  tidsgränser på alla anrop.
+- En HTTP-cache på disk: den extraherade texten sparas med sidans ETag/Last-Modified,
+  och nästa hämtning görs som ett villkorligt anrop (304 = texten återanvänds utan tolkning).
+- lxml används för att tolka HTML när det finns installerat, annars BeautifulSoup.
+- fetch_html_texts/afetch_html_texts hämtar och extraherar många länkar samtidigt
+  (t.ex. när ett helt rapportbibliotek läses in).
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from typing import Iterable, List, NamedTuple, Optional, Tuple, Union
+
+# requests, httpx, lxml och BeautifulSoup importeras först när en länk hämtas
+
+HTML_CACHE_DIR = os.getenv("HTML_CACHE_DIR", os.path.join("data", "cache", "html"))
+# (anslutning, läsning) i sekunder
+CONNECT_TIMEOUT = float(os.getenv("HTML_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTML_READ_TIMEOUT", "30"))
+POOL_SIZE = 16
+MAX_RETRIES = 3
+USER_AGENT = "ai-rapportanalys/1.0 (+https://github.com/siffror/ai-rapportanalys)"
+# Ändra när textextraktionen ändras, så att cachade texter inte återanvänds
+EXTRACTOR_VERSION = "1"
+REMOVED_TAGS = ("script", "style", "nav", "footer", "header", "noscript")
+
+
+class FetchResult(NamedTuple):
+    url: str
+    text: Optional[str]
+    status: Optional[int]       # HTTP-status (304 när cachen återanvänts efter ett villkorligt anrop)
+    from_cache: bool
+    error: Optional[str] = None
+
+
+def _cache_path(url: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+
+def load_cached_page(url: str, cache_dir: str = None) -> Optional[dict]:
+    """
+    Cachad post för en URL: {"url", "etag", "last_modified", "text", ...} eller None.
+    """
+    path = _cache_path(url, cache_dir or HTML_CACHE_DIR)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if entry.get("extractor") == EXTRACTOR_VERSION else None
+
+
+def save_cached_page(url: str, headers, text: str, cache_dir: str = None):
+    """
+    Sparar den extraherade texten med sidans validerare (skrivs atomiskt).
+    """
+    cache_dir = cache_dir or HTML_CACHE_DIR
+    etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+    if not etag and not last_modified:
+        # Utan validerare kan nästa anrop inte göras villkorligt
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(url, cache_dir)
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "url": url, "etag": etag, "last_modified": last_modified, "fetched": time.time(),
+            "extractor": EXTRACTOR_VERSION, "text": text,
+        }, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _conditional_headers(entry: Optional[dict]) -> dict:
+    headers = {"User-Agent": USER_AGENT}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def _lxml_available() -> bool:
+    try:
+        import lxml.html  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def html_to_text(html: Union[bytes, str], parser: str = "auto") -> str:
+    """
+    Texten i ett HTML-dokument, en rad per textnod, utan script, stil, navigation, sidhuvud och sidfot.
+
+    parser="auto" använder lxml direkt om det finns (betydligt snabbare), annars
+    BeautifulSoup med html.parser. "lxml" och "html.parser" väljer uttryckligen.
+    """
+    if parser == "auto":
+        parser = "lxml" if _lxml_available() else "html.parser"
+    if not html or (isinstance(html, (bytes, str)) and not html.strip()):
+        return ""
+    if parser == "lxml":
+        import lxml.html
+        from lxml import etree
+        root = lxml.html.fromstring(html)
+        etree.strip_elements(root, *REMOVED_TAGS, etree.Comment, with_tail=False)
+        return "\n".join(root.itertext())
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(list(REMOVED_TAGS)):
+        tag.decompose()
+    return soup.get_text(separator="\n")
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Processens delade requests.Session med anslutningspool och omförsök (429/5xx, Retry-After).
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                retry = Retry(
+                    total=MAX_RETRIES, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=("GET", "HEAD"), respect_retry_after_header=True
+                )
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["User-Agent"] = USER_AGENT
+                _session = session
+    return _session
+
+
+def fetch_html(
+    url: str,
+    use_cache: bool = True,
+    timeout: Tuple[float, float] = None,
+    cache_dir: str = None
+) -> FetchResult:
+    """
+    Hämtar och extraherar en sida, villkorligt mot HTTP-cachen om den finns där.
+    Fel från servern (4xx/5xx) och nätverksfel kastas som requests-undantag.
+    """
+    entry = load_cached_page(url, cache_dir) if use_cache else None
+    response = get_http_session().get(
+        url, headers=_conditional_headers(entry), timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    )
+    if response.status_code == 304 and entry is not None:
+        return FetchResult(url, entry["text"], 304, True)
+    response.raise_for_status()
+    text = html_to_text(response.content)
+    if use_cache:
+        save_cached_page(url, response.headers, text, cache_dir)
+    return FetchResult(url, text, response.status_code, False)
+
 
 def fetch_html_text(url: str) -> str:
     """
     Hämtar textinnehållet från en HTML-webbsida och rensar bort navigation, script, etc.
     """
-    response = requests.get(url)
-    response.raise_for_status()
-    soup = BeautifulSoup(response.text, "html.parser")
-    for tag in soup(["script", "style", "nav", "footer", "header"]):
-        tag.decompose()
-    text = soup.get_text(separator="\n")
-    return text
+    return fetch_html(url).text
+
+
+async def afetch_html_texts(
+    urls: Iterable[str],
+    max_concurrency: int = 8,
+    use_cache: bool = True,
+    timeout: Tuple[float, float] = None,
+    cache_dir: str = None
+) -> List[FetchResult]:
+    """
+    Hämtar och extraherar många sidor samtidigt (högst 'max_concurrency' anrop åt gången)
+    med en delad httpx.AsyncClient. Tolkningen görs i trådar så att hämtningarna inte
+    blockeras. Fel returneras per URL (FetchResult.error) i stället för att kastas.
+    Resultaten kommer i samma ordning som 'urls'.
+    """
+    import httpx
+
+    connect_timeout, read_timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout), limits=limits, follow_redirects=True
+    ) as client:
+        async def fetch_one(url: str) -> FetchResult:
+            async with semaphore:
+                try:
+                    entry = await asyncio.to_thread(load_cached_page, url, cache_dir) if use_cache else None
+                    for attempt in range(MAX_RETRIES + 1):
+                        response = await client.get(url, headers=_conditional_headers(entry))
+                        if response.status_code not in (429, 500, 502, 503, 504) or attempt == MAX_RETRIES:
+                            break
+                        # Samma väntetid som sessionens Retry: Retry-After om den finns, annars backoff
+                        retry_after = response.headers.get("Retry-After", "")
+                        await asyncio.sleep(float(retry_after) if retry_after.isdigit() else 0.5 * 2 ** attempt)
+                    if response.status_code == 304 and entry is not None:
+                        return FetchResult(url, entry["text"], 304, True)
+                    response.raise_for_status()
+                    text = await asyncio.to_thread(html_to_text, response.content)
+                    if use_cache:
+                        await asyncio.to_thread(save_cached_page, url, response.headers, text, cache_dir)
+                    return FetchResult(url, text, response.status_code, False)
+                except Exception as e:
+                    return FetchResult(url, None, getattr(getattr(e, "response", None), "status_code", None), False, str(e))
+
+        return await asyncio.gather(*(fetch_one(url) for url in urls))
+
+
+def fetch_html_texts(urls: Iterable[str], max_concurrency: int = 8, use_cache: bool = True) -> List[FetchResult]:
+    """
+    Synkron variant av afetch_html_texts (för skript och bakgrundsjobb utan egen event loop).
+    """
+    return asyncio.run(afetch_html_texts(list(urls), max_concurrency, use_cache))
@@ -0,0 +1,373 @@
+# services/openai_scheduler.py
+"""
+Gemensam schemaläggare för alla anrop mot OpenAI, med hänsyn till rate limits.
+
+Varje anrop måste först ta en plats ur två token buckets per modell: anrop per
+minut (RPM) och tokens per minut (TPM, uppskattat med tiktoken: prompt plus
+max_tokens, som OpenAI räknar). Hinkarna ligger i SQLite (WAL), så att alla trådar
+och alla processer på maskinen (Streamlit, gpt_server-workers, batchkörningar) delar
+på samma budget.
+
+- Gränserna anges med OPENAI_RATE_LIMITS ("gpt-4o=500/30000,text-embedding-3-small=3000/1000000")
+  och lärs annars från OpenAI:s svarshuvuden (x-ratelimit-limit-requests/-tokens).
+  x-ratelimit-remaining-* justerar hinkarna nedåt om OpenAI räknat mer än vi.
+- Ett 429-svar med Retry-After pausar alla anrop mot modellen i alla processer, i
+  stället för att varje anrop backar av på egen hand. OpenAI-klientens egna omförsök
+  går genom schemaläggaren igen.
+- Prioritetsklasser: "interactive" (svar till en användare) får ta hela hinken, medan
+  "background" (embedding av dokument, batchkörningar) och "evaluation" (RAGAS) inte får
+  tömma den under en reserv, så att interaktiva anrop har utrymme även under hög last.
+
+Schemaläggaren kopplas in som httpx-hooks på klienterna (se services.openai_service),
+så att varje HTTP-anrop passerar den, också RAGAS:s langchain-klienter.
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from utils.metrics import inc, observe
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCHEDULER_PATH = os.path.join("data", "cache", "openai_scheduler.sqlite3")
+# Andel av hinkarna som lägre prioriteter inte får förbruka
+PRIORITY_RESERVE = {"interactive": 0.0, "background": 0.2, "evaluation": 0.3}
+DEFAULT_PRIORITY = "interactive"
+# Längsta väntan mellan två försök (andra processer kan ha lärt sig nya gränser under tiden)
+MAX_POLL_SECONDS = 2.0
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("openai_priority", default=DEFAULT_PRIORITY)
+
+
+@contextmanager
+def request_priority(priority: str) -> Iterator[None]:
+    """
+    Sätter prioritetsklassen för OpenAI-anrop i det här sammanhanget (tråden eller tasken).
+    """
+    if priority not in PRIORITY_RESERVE:
+        raise ValueError(f"Okänd prioritet: {priority}")
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+def parse_rate_limits(value: str) -> Dict[str, Tuple[float, float]]:
+    """
+    "gpt-4o=500/30000,text-embedding-3-small=3000/1000000" -> {modell: (rpm, tpm)}; 0 = obegränsat.
+    """
+    limits = {}
+    for part in filter(None, (part.strip() for part in value.split(","))):
+        model, _, numbers = part.partition("=")
+        rpm, _, tpm = numbers.partition("/")
+        limits[model.strip()] = (float(rpm or 0), float(tpm or 0))
+    return limits
+
+
+def _parse_reset(value: Optional[str]) -> Optional[float]:
+    # OpenAI anger återställningstider som "1s", "6m0s", "20ms" eller "0.5s"
+    if not value:
+        return None
+    seconds, number = 0.0, ""
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char.isdigit() or char == ".":
+            number += char
+        elif value.startswith("ms", i):
+            seconds += float(number or 0) / 1000
+            number = ""
+            i += 1
+        else:
+            seconds += float(number or 0) * {"h": 3600, "m": 60, "s": 1}.get(char, 0)
+            number = ""
+        i += 1
+    return seconds + (float(number) if number else 0.0)
+
+
+def estimate_request_tokens(body: dict) -> int:
+    """
+    Uppskattar vad ett anrop räknas som mot TPM: promptens tokens (tiktoken) plus max_tokens.
+    """
+    from utils.token_utils import count_tokens
+
+    model = body.get("model") or "gpt-4o"
+    if "input" in body:
+        inputs = body["input"]
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return sum(count_tokens(text, model) if isinstance(text, str) else len(text) for text in inputs)
+    tokens = 0
+    for message in body.get("messages") or []:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        # Ungefär 4 tokens per meddelande för roll och avgränsare
+        tokens += count_tokens(content or "", model) + 4
+    return tokens + int(body.get("max_completion_tokens") or body.get("max_tokens") or 0)
+
+
+class RequestScheduler:
+    """
+    Token buckets (RPM/TPM per modell) och pauser efter 429, delade via SQLite.
+    """
+
+    def __init__(self, path: str = DEFAULT_SCHEDULER_PATH, limits: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " name TEXT PRIMARY KEY,"          # "<modell>:requests" eller "<modell>:tokens"
+                " capacity REAL NOT NULL,"
+                " level REAL NOT NULL,"
+                " updated REAL NOT NULL,"
+                " configured INTEGER NOT NULL)"    # 1 = angiven gräns, skrivs inte över av svarshuvuden
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS pauses (model TEXT PRIMARY KEY, until REAL NOT NULL)")
+        for model, (rpm, tpm) in (limits or {}).items():
+            self.set_limit(model, "requests", rpm, configured=True)
+            self.set_limit(model, "tokens", tpm, configured=True)
+
+    def _connection(self) -> sqlite3.Connection:
+        # En anslutning per tråd; transaktionerna styrs explicit (BEGIN IMMEDIATE)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def set_limit(self, model: str, kind: str, per_minute: float, configured: bool = False):
+        """
+        Sätter kapaciteten för en hink ('kind' = "requests" eller "tokens"); 0 tar bort gränsen.
+        Inlärda gränser skriver inte över konfigurerade.
+        """
+        name = f"{model}:{kind}"
+        with self._transaction() as conn:
+            row = conn.execute("SELECT capacity, configured FROM buckets WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[1] and not configured:
+                return
+            if not per_minute:
+                conn.execute("DELETE FROM buckets WHERE name = ?", (name,))
+            elif row is None:
+                conn.execute(
+                    "INSERT INTO buckets (name, capacity, level, updated, configured) VALUES (?, ?, ?, ?, ?)",
+                    (name, per_minute, per_minute, time.time(), int(configured))
+                )
+            elif row[0] != per_minute:
+                conn.execute(
+                    "UPDATE buckets SET capacity = ?, level = MIN(level, ?), configured = ? WHERE name = ?",
+                    (per_minute, per_minute, int(configured), name)
+                )
+
+    def try_acquire(self, model: str, tokens: int, priority: str = DEFAULT_PRIORITY) -> float:
+        """
+        Tar ett anrop och 'tokens' tokens ur modellens hinkar om det går. Returnerar 0 då,
+        annars hur länge (s) det dröjer innan det kan gå (inget tas ur hinkarna).
+        """
+        reserve = PRIORITY_RESERVE.get(priority, 0.0)
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT until FROM pauses WHERE model = ?", (model,)).fetchone()
+            if row is not None and row[0] > now:
+                return row[0] - now
+            takes, wait = [], 0.0
+            for kind, cost in (("requests", 1), ("tokens", tokens)):
+                name = f"{model}:{kind}"
+                row = conn.execute("SELECT capacity, level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                if row is None:
+                    continue  # okänd gräns
+                capacity, level, updated = row
+                rate = capacity / 60.0
+                level = min(capacity, level + (now - updated) * rate)
+                # Ett anrop större än hela hinken släpps igenom när hinken är full
+                need = min(cost + reserve * capacity, capacity)
+                if level < need:
+                    wait = max(wait, (need - level) / rate)
+                takes.append((name, level - cost))
+            if wait > 0:
+                return wait
+            for name, level in takes:
+                conn.execute("UPDATE buckets SET level = ?, updated = ? WHERE name = ?", (level, now, name))
+        return 0.0
+
+    def _sleep_time(self, wait: float) -> float:
+        # Lite slump, så att väntande processer inte försöker samtidigt
+        return min(wait, MAX_POLL_SECONDS) * random.uniform(1.0, 1.2)
+
+    def acquire(self, model: str, tokens: int, priority: Optional[str] = None) -> float:
+        """
+        Väntar tills anropet får plats. Returnerar väntetiden i sekunder.
+        """
+        priority = priority or current_priority()
+        start = time.monotonic()
+        while True:
+            wait = self.try_acquire(model, tokens, priority)
+            if wait <= 0:
+                break
+            time.sleep(self._sleep_time(wait))
+        return self._record_wait(model, priority, time.monotonic() - start)
+
+    async def aacquire(self, model: str, tokens: int, priority: Optional[str] = None) -> float:
+        """
+        Som acquire, men väntar utan att blockera event loopen.
+        """
+        priority = priority or current_priority()
+        start = time.monotonic()
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, model, tokens, priority)
+            if wait <= 0:
+                break
+            await asyncio.sleep(self._sleep_time(wait))
+        return self._record_wait(model, priority, time.monotonic() - start)
+
+    def _record_wait(self, model: str, priority: str, waited: float) -> float:
+        observe("openai_scheduler_wait_seconds", waited, model=model, priority=priority)
+        return waited
+
+    def pause(self, model: str, seconds: float):
+        """
+        Pausar alla anrop mot modellen (t.ex. efter 429 med Retry-After).
+        """
+        until = time.time() + seconds
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO pauses (model, until) VALUES (?, ?)"
+                " ON CONFLICT(model) DO UPDATE SET until = MAX(until, excluded.until)",
+                (model, until)
+            )
+
+    def observe_response(self, model: str, status: int, headers, priority: str = DEFAULT_PRIORITY):
+        """
+        Lär sig gränser ur svarshuvudena, justerar hinkarna och pausar efter 429.
+        """
+        for kind in ("requests", "tokens"):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            if limit:
+                self.set_limit(model, kind, float(limit))
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining:
+                with self._transaction() as conn:
+                    conn.execute(
+                        "UPDATE buckets SET level = MIN(level, ?) WHERE name = ?", (float(remaining), f"{model}:{kind}")
+                    )
+        if status in RETRYABLE_STATUSES:
+            inc("openai_retries_total", model=model, priority=priority, status=status)
+        if status == 429:
+            retry_after = headers.get("retry-after-ms")
+            seconds = float(retry_after) / 1000 if retry_after else None
+            if seconds is None and headers.get("retry-after"):
+                try:
+                    seconds = float(headers["retry-after"])
+                except ValueError:
+                    seconds = None
+            if seconds is None:
+                seconds = max(filter(None, (
+                    _parse_reset(headers.get("x-ratelimit-reset-requests")),
+                    _parse_reset(headers.get("x-ratelimit-reset-tokens")),
+                )), default=1.0)
+            inc("openai_rate_limited_total", model=model, priority=priority)
+            logger.info("429 från OpenAI för %s, pausar i %.2f s", model, seconds)
+            self.pause(model, seconds)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def scheduler_enabled() -> bool:
+    return os.getenv("OPENAI_SCHEDULER", "1") != "0"
+
+
+def get_scheduler() -> RequestScheduler:
+    """
+    Processens delade schemaläggare. Sökväg och gränser styrs med OPENAI_SCHEDULER_PATH och OPENAI_RATE_LIMITS.
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler(
+                    os.getenv("OPENAI_SCHEDULER_PATH", DEFAULT_SCHEDULER_PATH),
+                    parse_rate_limits(os.getenv("OPENAI_RATE_LIMITS", ""))
+                )
+    return _scheduler
+
+
+def _request_info(request) -> Tuple[Optional[str], int]:
+    # Modell och uppskattade tokens ur JSON-kroppen (None för anrop utan modell, t.ex. /models)
+    try:
+        body = json.loads(request.content or b"{}")
+    except (ValueError, RuntimeError):
+        return None, 0
+    if not isinstance(body, dict) or not body.get("model"):
+        return None, 0
+    return body["model"], estimate_request_tokens(body)
+
+
+def scheduler_hooks(priority: Optional[str] = None, asynchronous: bool = False) -> Dict[str, list]:
+    """
+    httpx-hooks ("request"/"response") som låter varje anrop passera schemaläggaren.
+    'priority' låser prioriteten för en klient (t.ex. RAGAS); annars gäller request_priority.
+    """
+    if not scheduler_enabled():
+        return {"request": [], "response": []}
+
+    def before(request):
+        model, tokens = _request_info(request)
+        request.extensions["openai_scheduler"] = (model, priority or current_priority())
+        return model, tokens, request.extensions["openai_scheduler"][1]
+
+    def after(response):
+        model, request_priority_ = response.request.extensions.get("openai_scheduler", (None, DEFAULT_PRIORITY))
+        if model:
+            get_scheduler().observe_response(model, response.status_code, response.headers, request_priority_)
+
+    if asynchronous:
+        async def on_request(request):
+            model, tokens, request_priority_ = before(request)
+            if model:
+                await get_scheduler().aacquire(model, tokens, request_priority_)
+
+        async def on_response(response):
+            await asyncio.to_thread(after, response)
+
+        return {"request": [on_request], "response": [on_response]}
+
+    def on_request(request):
+        model, tokens, request_priority_ = before(request)
+        if model:
+            get_scheduler().acquire(model, tokens, request_priority_)
+
+    return {"request": [on_request], "response": [after]}
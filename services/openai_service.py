@@ -1 +1,90 @@
-# Placeholder for future OpenAI service code
+# services/openai_service.py
+import os
+import threading
+from typing import Dict, Optional
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from services.openai_scheduler import scheduler_hooks
+from utils.metrics import inc
+
+# Klienten försöker själv igen vid 429/5xx (med Retry-After); varje försök passerar schemaläggaren
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_api_key() -> str:
+    """
+    Hämtar API-nyckeln från Streamlit secrets och faller tillbaka på miljövariabeln
+    OPENAI_API_KEY (t.ex. i gpt_server, skript och benchmarks).
+    """
+    try:
+        import streamlit as st
+        return st.secrets["OPENAI_API_KEY"]
+    except Exception:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY saknas i både Streamlit secrets och miljövariabler.")
+        return api_key
+
+
+def _count_response(response: httpx.Response):
+    # Räknar svar per statuskod; 429 och 5xx gör att klienten försöker igen
+    inc("openai_http_responses_total", status=response.status_code)
+
+
+async def _acount_response(response: httpx.Response):
+    _count_response(response)
+
+
+def openai_event_hooks(priority: Optional[str] = None, asynchronous: bool = False) -> Dict[str, list]:
+    """
+    httpx-hooks för alla klienter mot OpenAI: schemaläggaren (rate limits, prioritet) och svarsräkning.
+    """
+    hooks = scheduler_hooks(priority, asynchronous)
+    hooks["response"].append(_acount_response if asynchronous else _count_response)
+    return hooks
+
+
+def get_openai_client() -> OpenAI:
+    """
+    Returnerar en delad OpenAI-klient (skapas vid första anropet).
+
+    Klienten är trådsäker och återanvänder sin HTTP-anslutningspool mellan anrop.
+    OPENAI_BASE_URL kan sättas för att peka mot en lokal testserver.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=get_openai_api_key(),
+                    max_retries=OPENAI_MAX_RETRIES,
+                    http_client=DefaultHttpxClient(event_hooks=openai_event_hooks()),
+                )
+    return _client
+
+
+def create_async_openai_client(
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    timeout: float = 60.0
+) -> AsyncOpenAI:
+    """
+    Skapar en AsyncOpenAI-klient med en gemensam anslutningspool.
+
+    Tänkt att skapas en gång per process/event loop (t.ex. i FastAPI:s lifespan)
+    och stängas med 'await client.close()' vid nedstängning.
+    """
+    return AsyncOpenAI(
+        api_key=get_openai_api_key(),
+        timeout=timeout,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+            event_hooks=openai_event_hooks(asynchronous=True),
+        ),
+    )
@@ -0,0 +1,61 @@
+# tests/test_answer_cache.py
+"""
+Tester för utils.answer_cache: exakta och semantiska träffar, och att semantiska
+träffar bara ges för frågor på samma språk som det cachade svaret; storleksgränsen
+hålls utan att posterna räknas vid varje put.
+"""
+import numpy as np
+import pytest
+
+from utils.answer_cache import AnswerCache
+
+CONTEXT = "Styrelsen föreslår en utdelning om 4 kr per aktie."
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnswerCache(str(tmp_path / "answers.sqlite3"), similarity_threshold=0.95)
+
+
+def embedding(*values):
+    return np.asarray(values, dtype=np.float32)
+
+
+def test_exact_hit(cache):
+    key = cache.put("doc", "Vilken utdelning föreslås?", CONTEXT, "gpt-4o", "1", "4 kr per aktie.", language="sv")
+    hit = cache.lookup("doc", "vilken  utdelning föreslås?", CONTEXT, "gpt-4o", "1")
+    assert hit is not None and hit.match == "exact" and hit.key == key
+    assert cache.lookup("doc", "Vilken utdelning föreslås?", CONTEXT, "gpt-4o", "2") is None
+
+
+def test_semantic_hit_requires_same_language(cache):
+    cache.put(
+        "doc", "Vilken utdelning föreslås?", CONTEXT, "gpt-4o", "1", "4 kr per aktie.",
+        embedding(1.0, 0.0, 0.0), language="sv"
+    )
+    near = embedding(0.99, 0.1, 0.0)
+
+    hit = cache.lookup("doc", "Hur stor utdelning föreslås?", CONTEXT, "gpt-4o", "1", near, "sv")
+    assert hit is not None and hit.match == "semantic" and hit.answer == "4 kr per aktie."
+    # Ett svenskt svar ges inte på en engelsk fråga, hur lika frågorna än är
+    assert cache.lookup("doc", "What dividend is proposed?", CONTEXT, "gpt-4o", "1", near, "en") is None
+    assert cache.lookup("doc", "Utdelning?", CONTEXT, "gpt-4o", "1", near, None) is not None
+    assert cache.lookup("doc", "Utdelning?", CONTEXT, "gpt-4o", "1", embedding(0.0, 1.0, 0.0), "sv") is None
+    assert cache.lookup("annat", "Utdelning?", CONTEXT, "gpt-4o", "1", near, "sv") is None
+
+    stats = cache.stats()
+    assert (stats["semantic_hits"], stats["misses"]) == (2, 3)
+
+
+def test_entries_are_not_counted_on_every_put(tmp_path, monkeypatch):
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"), max_entries=10)
+    counts = []
+    monkeypatch.setattr(AnswerCache, "__len__", lambda self: counts.append(1) or self._connection().execute(
+        "SELECT COUNT(*) FROM answers").fetchone()[0])
+    for i in range(25):
+        cache.put("doc", f"Fråga {i}?", CONTEXT, "gpt-4o", "1", f"Svar {i}.")
+
+    assert len(counts) < 10
+    assert cache._connection().execute("SELECT COUNT(*) FROM answers").fetchone()[0] <= 10
+    # De senast sparade svaren finns kvar
+    assert cache.lookup("doc", "Fråga 24?", CONTEXT, "gpt-4o", "1") is not None
@@ -0,0 +1,37 @@
+# tests/test_batch_analysis.py
+"""
+Tester för batch_analysis: att en återupptagen körning räknar besvarade par och att
+felrader som ett senare svar eller fel ersätter tas bort ur utfilen.
+"""
+import json
+
+from batch_analysis import ResultWriter, load_answered, prune_superseded_errors
+
+
+def read(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_superseded_error_rows_are_removed(tmp_path):
+    path = str(tmp_path / "svar.jsonl")
+    writer = ResultWriter(path)
+    writer.write({"source": "a.pdf", "question": "Q1", "error": "RateLimitError: 429"})
+    writer.write({"source": "a.pdf", "question": "Q2", "error": "RateLimitError: 429"})
+    writer.write({"source": "b.pdf", "question": "Q1", "answer": "Svar b1"})
+    # En omkörning: Q1 besvaras, Q2 misslyckas igen
+    writer.write({"source": "a.pdf", "question": "Q1", "answer": "Svar a1"})
+    writer.write({"source": "a.pdf", "question": "Q2", "error": "APITimeoutError: timeout"})
+    writer.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"source": "a.pdf", "quest')
+
+    # Två ersatta fel och den avbrutna sista raden
+    assert prune_superseded_errors(path) == 3
+    assert read(path) == [
+        {"source": "b.pdf", "question": "Q1", "answer": "Svar b1"},
+        {"source": "a.pdf", "question": "Q1", "answer": "Svar a1"},
+        {"source": "a.pdf", "question": "Q2", "error": "APITimeoutError: timeout"},
+    ]
+    assert load_answered(path) == {("a.pdf", "Q1"), ("b.pdf", "Q1")}
+    assert prune_superseded_errors(path) == 0
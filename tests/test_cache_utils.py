@@ -0,0 +1,74 @@
+# tests/test_cache_utils.py
+"""
+Tester för utils.cache_utils: find_previous_version slår upp kandidater i hashindexet,
+även för cacher som sparades innan indexet fanns, och open_document_cache räknar en
+cache från en annan chunker som saknad; samtidiga skrivningar av samma textnyckel krockar inte.
+"""
+import os
+import shutil
+
+import numpy as np
+
+from utils import cache_utils
+from utils.cache_utils import HASH_INDEX_NAME, find_previous_version, open_document_cache, save_document_cache
+
+
+def save(root, name: str, hashes, model: str = "test"):
+    path = os.path.join(str(root), name)
+    texts = [f"chunk {value}" for value in hashes]
+    save_document_cache(path, texts, np.ones((len(texts), 4), dtype=np.float32), model=model, hashes=hashes)
+    return path
+
+
+def hashes(*numbers):
+    return [f"{n:032x}" for n in numbers]
+
+
+def test_finds_document_with_most_shared_chunks(tmp_path):
+    save(tmp_path, "doc_a", hashes(1, 2, 3, 4))
+    best = save(tmp_path, "doc_b", hashes(1, 2, 3, 5, 6))
+    save(tmp_path, "doc_c", hashes(1, 2, 3, 5, 6), model="annan-modell")
+
+    found = find_previous_version(hashes(1, 2, 3, 5, 7), "test", cache_root=str(tmp_path))
+    assert found is not None and found.path == best
+    found.close()
+    assert find_previous_version(hashes(1, 2, 3, 5, 7), "test", exclude=best, cache_root=str(tmp_path)).path.endswith("doc_a")
+    assert find_previous_version(hashes(8, 9, 10, 11), "test", cache_root=str(tmp_path)) is None
+
+
+def test_existing_caches_are_indexed_once(tmp_path):
+    path = save(tmp_path, "doc_a", hashes(1, 2, 3))
+    # Som en cache från före hashindexet
+    cache_utils._hash_indexes.clear()
+    for name in os.listdir(str(tmp_path)):
+        if name.startswith(HASH_INDEX_NAME):
+            os.remove(os.path.join(str(tmp_path), name))
+
+    found = find_previous_version(hashes(1, 2, 3), "test", cache_root=str(tmp_path))
+    assert found is not None and found.path == os.path.join(str(tmp_path), "doc_a")
+    found.close()
+
+    shutil.rmtree(path)
+    assert find_previous_version(hashes(1, 2, 3), "test", cache_root=str(tmp_path)) is None
+
+
+def test_cache_from_other_chunker_counts_as_missing(tmp_path):
+    path = os.path.join(str(tmp_path), "doc_a")
+    params = {"chunker": "iter_content_defined_chunks", "version": 1, "max_tokens": 400}
+    save_document_cache(path, ["text"], np.ones((1, 4), dtype=np.float32), model="test", chunker_params=params)
+
+    assert open_document_cache(path, params) is not None
+    assert open_document_cache(path, dict(params, version=2)) is None
+    assert open_document_cache(path) is not None
+
+
+def test_concurrent_writes_of_the_same_text_key(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setattr(cache_utils, "TEXT_CACHE_DIR", str(tmp_path))
+    texts = [f"sammanfattning {i} " * 200 for i in range(16)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda text: cache_utils.save_cached_text("summaries", "nyckel", text), texts))
+
+    assert cache_utils.load_cached_text("summaries", "nyckel") in texts
+    assert os.listdir(os.path.join(str(tmp_path), "summaries")) == ["nyckel.txt"]
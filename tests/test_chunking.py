@@ -0,0 +1,110 @@
+# tests/test_chunking.py
+"""
+Tester för den strömmande chunkningen (core.chunking.iter_streaming_chunks): samma chunkar
+som iter_content_defined_chunks över den sammanfogade texten, oavsett hur texten delas,
+och linjär tid även för PDF-text utan tomrader.
+"""
+import random
+import time
+
+import pytest
+
+from core.chunking import iter_content_defined_chunks, iter_streaming_chunks
+
+WORDS = (
+    "koncernens nettoomsättning ökade till MSEK och rörelseresultatet uppgick styrelsen "
+    "föreslår utdelning kr per aktie kassaflödet från den löpande verksamheten"
+).split()
+
+
+def pdf_like_text(lines: int, seed: int = 0, structure: bool = True) -> str:
+    """
+    Sidtext som från en PDF: korta rader utan tomrader, meningar som fortsätter över
+    radbrytningar och, med 'structure', enstaka rubriker och tabellrader.
+    """
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(lines):
+        line = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 14)))
+        if rnd.random() < 0.3:
+            line += ". " + " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 6)))
+        if rnd.random() < 0.2:
+            line += "."
+        if not structure:
+            out.append(line)
+            continue
+        if rnd.random() < 0.03:
+            line = "  " + line
+        if rnd.random() < 0.02:
+            line = line.upper()[:40]
+        if rnd.random() < 0.02:
+            line = f"Summa {rnd.randint(1, 999)} {rnd.randint(1, 999)}"
+        out.append(line)
+    return "\n".join(out) + "\n"
+
+
+def structured_text() -> str:
+    sections = []
+    for i in range(30):
+        sections.append(f"## Avsnitt {i}\n\n" + pdf_like_text(12, seed=i) + "\n")
+        sections.append(f"## Resultat (rad {i * 10 + 1}–{i * 10 + 10})\nÅr  Omsättning  Resultat\n" +
+                        "".join(f"{2000 + j}  {j * 100}  {j * 7}\n" for j in range(10)) + "\n")
+    return "".join(sections)
+
+
+def split_text(text: str, rnd: random.Random, on_lines: bool):
+    if on_lines:
+        cuts = sorted({i + 1 for i, c in enumerate(text) if c == "\n" and rnd.random() < 0.05})
+    else:
+        cuts = sorted(rnd.sample(range(1, len(text)), min(len(text) - 1, rnd.randint(1, 200))))
+    bounds = [0] + cuts + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+@pytest.mark.parametrize("text", [
+    structured_text(),
+    pdf_like_text(3000, seed=1),
+    pdf_like_text(800, seed=2).replace("\n", " ", 300),
+    "x" * 5000 + "\n" + pdf_like_text(200, seed=3),
+], ids=["structured", "pdf_lines", "long_lines", "giant_word"])
+def test_streamed_chunks_match_whole_text(text):
+    expected = [(span.start, span.end) for span in iter_content_defined_chunks(text)]
+    rnd = random.Random(42)
+    for trial in range(5):
+        pieces = split_text(text, rnd, on_lines=trial % 2 == 0)
+        streamed = list(iter_streaming_chunks(pieces))
+        assert [(span.start, span.end) for span, _ in streamed] == expected
+        assert all(chunk == text[span.start:span.end] for span, chunk in streamed)
+
+
+def test_streamed_chunks_yield_before_input_ends():
+    text = pdf_like_text(2000, seed=4)
+    lines = text.splitlines(True)
+    consumed = []
+
+    def pages():
+        for i in range(0, len(lines), 50):
+            consumed.append(i)
+            yield "".join(lines[i:i + 50])
+
+    first = next(iter(iter_streaming_chunks(pages())))
+    assert first[0].start == 0
+    assert len(consumed) < 5
+
+
+def test_streaming_is_linear_for_text_without_blank_lines():
+    # Ett enda stycke på ca 700 kB utan tomrader, rubriker eller tabellrader, 50 rader
+    # per sida: tidigare chunkades hela stycket om för varje sida
+    text = pdf_like_text(12000, seed=5, structure=False)
+    lines = text.splitlines(True)
+    pages = ["".join(lines[i:i + 50]) for i in range(0, len(lines), 50)]
+
+    started = time.perf_counter()
+    expected = [(span.start, span.end) for span in iter_content_defined_chunks(text)]
+    whole = time.perf_counter() - started
+    started = time.perf_counter()
+    streamed = [(span.start, span.end) for span, _ in iter_streaming_chunks(pages)]
+    streaming = time.perf_counter() - started
+
+    assert streamed == expected
+    assert streaming < 5 * whole + 1.0
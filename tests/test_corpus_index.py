@@ -0,0 +1,51 @@
+# tests/test_corpus_index.py
+"""
+Tester för core.corpus_index: borttagna dokument filtreras bort vid sökning och tas bort
+på riktigt när indexet kompakteras, även med kompakta vektorer och efter save/load.
+"""
+import numpy as np
+import pytest
+
+from core.corpus_index import CorpusIndex
+
+
+def add(index: CorpusIndex, doc_id: str, seed: int, rows: int = 10):
+    vectors = np.random.default_rng(seed).normal(size=(rows, 8)).astype(np.float32)
+    index.add_document(doc_id, [f"{doc_id} {i}" for i in range(rows)], vectors, {"company": doc_id})
+    return vectors
+
+
+@pytest.mark.parametrize("quantization", [None, "int8"])
+def test_removed_documents_are_compacted(tmp_path, quantization):
+    # Med en lista tränas indexet redan efter 39 rader
+    index = CorpusIndex(str(tmp_path), n_lists=1, quantization=quantization)
+    vectors = {doc_id: add(index, doc_id, seed) for seed, doc_id in enumerate(["a", "b", "c", "d", "e"])}
+
+    index.remove_document("b")
+    # 10 av 50 rader är borttagna: under gränsen, så raderna ligger kvar men hittas inte
+    assert len(index) == 50 and index.centroids is not None
+    assert all(hit[2]["doc_id"] != "b" for hit in index.search(vectors["b"][0], top_k=50))
+
+    index.remove_document("d")
+    assert len(index) == 30
+    assert sorted(index.documents) == ["a", "c", "e"]
+    hit = index.search(vectors["e"][3], top_k=1)[0]
+    assert hit[1] == "e 3" and hit[2]["doc_id"] == "e"
+
+    index.save()
+    loaded = CorpusIndex.load(str(tmp_path))
+    assert len(loaded) == 30
+    assert loaded.search(vectors["c"][5], top_k=1)[0][1] == "c 5"
+    assert loaded.search(vectors["a"][0], top_k=1, filters={"company": "c"})[0][2]["company"] == "c"
+
+
+def test_replaced_documents_count_as_removed_rows():
+    index = CorpusIndex("", n_lists=2)
+    for seed, doc_id in enumerate(["a", "b", "c"]):
+        add(index, doc_id, seed)
+    vectors = add(index, "a", 10)
+
+    # Den gamla versionen av "a" (10 av 40 rader) har kompakterats bort
+    assert len(index) == 30
+    assert [text for _, text, _ in index.search(vectors[0], top_k=30)].count("a 0") == 1
+    assert index.search(vectors[0], top_k=1)[0][1] == "a 0"
@@ -0,0 +1,31 @@
+# tests/test_embedding_store.py
+"""
+Tester för utils.embedding_store: uppslag på normaliserad text och att storleksgränsen
+hålls utan att posterna räknas vid varje skrivning.
+"""
+from utils.embedding_store import EmbeddingStore
+
+
+def stored(store: EmbeddingStore) -> int:
+    return store._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+def test_lookup_uses_normalized_text(tmp_path):
+    store = EmbeddingStore(str(tmp_path / "store.sqlite3"))
+    store.put_many("m", ["Nettoomsättning  ökade\n", "Rörelseresultat"], [[1.0, 0.0], [0.0, 1.0]])
+    assert store.get_many("m", ["Nettoomsättning ökade", "Okänd", "Rörelseresultat"]) == [[1.0, 0.0], None, [0.0, 1.0]]
+    assert store.get("annan-modell", "Rörelseresultat") is None
+
+
+def test_eviction_keeps_the_limit_without_counting_every_put(tmp_path, monkeypatch):
+    store = EmbeddingStore(str(tmp_path / "store.sqlite3"), max_entries=100)
+    counts = []
+    monkeypatch.setattr(EmbeddingStore, "__len__", lambda self: counts.append(1) or stored(self))
+    for i in range(300):
+        store.put("m", f"text {i}", [float(i)])
+
+    assert len(counts) < 30
+    assert stored(store) <= 100
+    # De senast skrivna posterna finns kvar, de äldsta har rensats
+    assert store.get("m", "text 299") == [299.0]
+    assert store.get("m", "text 0") is None
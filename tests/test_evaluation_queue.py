@@ -0,0 +1,107 @@
+# tests/test_evaluation_queue.py
+"""
+Tester för utils.evaluation_queue: flera köer (processer) på samma databas utvärderar
+varje post en gång, och poster vars anspråk löpt ut tas upp igen.
+"""
+import sqlite3
+import threading
+import time
+
+from utils.evaluation_queue import EvaluationQueue, triple_hash
+
+
+class FakeEvaluator:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seen = []
+
+    def __call__(self, triples):
+        time.sleep(0.05)
+        with self.lock:
+            self.seen.extend(question for question, _, _ in triples)
+        return [{"faithfulness": 1.0} for _ in triples]
+
+
+def wait_for(queue: EvaluationQueue, keys, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        results = [queue.get(key) for key in keys]
+        if all(result is not None for result in results):
+            return results
+        time.sleep(0.02)
+    raise AssertionError("utvärderingarna blev inte klara")
+
+
+def test_pending_rows_are_evaluated_once_across_queues(tmp_path):
+    path = str(tmp_path / "evaluations.sqlite3")
+    first_evaluator = FakeEvaluator()
+    first = EvaluationQueue(path, batch_size=4, max_wait_seconds=0.05, evaluate_batch=first_evaluator)
+    # Poster som lagts in men inte hunnit utvärderas (t.ex. av en process som avslutats)
+    conn = sqlite3.connect(path)
+    keys = []
+    with conn:
+        for i in range(20):
+            key = triple_hash(f"fråga {i}", "svar", ["kontext"])
+            keys.append(key)
+            conn.execute(
+                "INSERT INTO evaluations (key, question, answer, contexts, status, result, created, updated)"
+                " VALUES (?, ?, 'svar', '[\"kontext\"]', 'pending', NULL, ?, ?)",
+                (key, f"fråga {i}", time.time(), time.time())
+            )
+    conn.close()
+
+    evaluators = [first_evaluator] + [FakeEvaluator() for _ in range(2)]
+    queues = [first] + [
+        EvaluationQueue(path, batch_size=4, max_wait_seconds=0.05, evaluate_batch=evaluator)
+        for evaluator in evaluators[1:]
+    ]
+    first._requeue_pending()
+    assert all(result == {"faithfulness": 1.0} for result in wait_for(queues[1], keys))
+    seen = [question for evaluator in evaluators for question in evaluator.seen]
+    assert sorted(seen) == sorted(f"fråga {i}" for i in range(20))
+
+
+def test_expired_claims_are_requeued(tmp_path):
+    path = str(tmp_path / "evaluations.sqlite3")
+    evaluator = FakeEvaluator()
+    queue = EvaluationQueue(path, max_wait_seconds=0.05, evaluate_batch=evaluator, lease_seconds=0.2)
+    key = triple_hash("fråga", "svar", ["kontext"])
+    conn = sqlite3.connect(path)
+    with conn:
+        # Anspråk från en process som kraschade mitt i utvärderingen
+        conn.execute(
+            "INSERT INTO evaluations (key, question, answer, contexts, status, result, created, updated, owner)"
+            " VALUES (?, 'fråga', 'svar', '[\"kontext\"]', 'running', NULL, ?, ?, 'död-process')",
+            (key, time.time(), time.time())
+        )
+    conn.close()
+    assert queue.get(key) is None
+    assert wait_for(queue, [key]) == [{"faithfulness": 1.0}]
+    assert evaluator.seen == ["fråga"]
+
+
+def test_submit_returns_cached_result(tmp_path):
+    evaluator = FakeEvaluator()
+    queue = EvaluationQueue(str(tmp_path / "evaluations.sqlite3"), max_wait_seconds=0.05, evaluate_batch=evaluator)
+    key = queue.submit("fråga", "svar", ["kontext"])
+    wait_for(queue, [key])
+    assert queue.submit("fråga", "svar", ["kontext"]) == key
+    time.sleep(0.2)
+    assert evaluator.seen == ["fråga"]
+
+
+def test_worker_survives_a_failing_batch(tmp_path):
+    calls = []
+
+    def evaluate(triples):
+        calls.append(len(triples))
+        if len(calls) == 1:
+            return []  # fel antal resultat: batchen markeras som misslyckad
+        return [{"faithfulness": 0.5} for _ in triples]
+
+    queue = EvaluationQueue(str(tmp_path / "evaluations.sqlite3"), max_wait_seconds=0.05, evaluate_batch=evaluate)
+    failed = queue.submit("första", "svar", ["kontext"])
+    assert "error" in wait_for(queue, [failed])[0]
+    ok = queue.submit("andra", "svar", ["kontext"])
+    assert wait_for(queue, [ok]) == [{"faithfulness": 0.5}]
+    assert queue._worker.is_alive()
@@ -0,0 +1,165 @@
+# tests/test_html_downloader.py
+"""
+Tester för services.html_downloader mot en lokal http.server: återanvända anslutningar
+i den delade sessionen, villkorliga anrop (ETag/Last-Modified → 304), omförsök vid 5xx
+och den asynkrona bulkhämtningen.
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from services import html_downloader
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 01 Oct 2025 08:00:00 GMT"
+
+
+def _page(title: str) -> bytes:
+    return (
+        '<html><head><meta charset="utf-8"><script>var x = 1;</script></head><body>'
+        f"<nav>Meny</nav><h1>{title}</h1><p>Nettoomsättningen uppgick till 1 234 MSEK.</p>"
+        "<footer>Sidfot</footer></body></html>"
+    ).encode("utf-8")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 med Content-Length, så att klienten kan hålla anslutningen öppen
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        with server.lock:
+            server.requests.append((path, self.client_address[1], dict(self.headers)))
+            server.hits[path] = server.hits.get(path, 0) + 1
+            hits = server.hits[path]
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            if path.startswith("/flaky") and hits <= 2:
+                self._send(503, b"", {"Retry-After": "0"})
+            elif path == "/missing":
+                self._send(404, b"")
+            elif path == "/etag":
+                if self.headers.get("If-None-Match") == ETAG:
+                    self._send(304, None, {"ETag": ETAG})
+                else:
+                    self._send(200, _page("ETag"), {"ETag": ETAG})
+            elif path == "/last-modified":
+                if self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+                    self._send(304, None, {"Last-Modified": LAST_MODIFIED})
+                else:
+                    self._send(200, _page("Last-Modified"), {"Last-Modified": LAST_MODIFIED})
+            elif self.headers.get("If-None-Match") == f'"{path}"':
+                self._send(304, None, {"ETag": f'"{path}"'})
+            else:
+                self._send(200, _page(path.strip("/")), {"ETag": f'"{path}"'})
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _send(self, status: int, body, headers: dict = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.requests, httpd.hits = [], {}
+    httpd.active = httpd.max_active = 0
+    httpd.delay = 0.0
+    httpd.base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_session(monkeypatch, tmp_path):
+    # En ny delad session och en tom HTTP-cache per test
+    monkeypatch.setattr(html_downloader, "_session", None)
+    monkeypatch.setattr(html_downloader, "HTML_CACHE_DIR", str(tmp_path / "html"))
+    yield
+    if html_downloader._session is not None:
+        html_downloader._session.close()
+
+
+def test_shared_session_reuses_connection(server):
+    session = html_downloader.get_http_session()
+    for i in range(5):
+        result = html_downloader.fetch_html(f"{server.base_url}/page{i}", use_cache=False)
+        assert result.status == 200
+    assert html_downloader.get_http_session() is session
+    ports = {port for _, port, _ in server.requests}
+    assert len(server.requests) == 5
+    assert len(ports) == 1
+
+
+def test_extracts_text_without_boilerplate(server):
+    text = html_downloader.fetch_html_text(f"{server.base_url}/rapport")
+    assert "Nettoomsättningen uppgick till 1 234 MSEK." in text
+    assert "Meny" not in text and "Sidfot" not in text and "var x" not in text
+
+
+@pytest.mark.parametrize("path, header, value", [
+    ("/etag", "If-None-Match", ETAG),
+    ("/last-modified", "If-Modified-Since", LAST_MODIFIED),
+])
+def test_conditional_request_reuses_cached_text(server, path, header, value):
+    url = server.base_url + path
+    first = html_downloader.fetch_html(url)
+    second = html_downloader.fetch_html(url)
+    assert (first.status, first.from_cache) == (200, False)
+    assert (second.status, second.from_cache) == (304, True)
+    assert second.text == first.text
+    assert header not in server.requests[0][2]
+    assert server.requests[1][2][header] == value
+
+
+def test_no_cache_without_validators(tmp_path):
+    # Utan ETag/Last-Modified kan nästa anrop inte göras villkorligt, så inget sparas
+    url = "http://example.invalid/rapport"
+    html_downloader.save_cached_page(url, {}, "text", str(tmp_path))
+    assert html_downloader.load_cached_page(url, str(tmp_path)) is None
+
+
+def test_retries_on_5xx(server):
+    result = html_downloader.fetch_html(f"{server.base_url}/flaky", use_cache=False)
+    assert result.status == 200
+    assert server.hits["/flaky"] == 3
+
+
+def test_bulk_fetch_in_order_with_errors_per_url(server):
+    server.delay = 0.05
+    urls = [f"{server.base_url}/p{i}" for i in range(12)] + [f"{server.base_url}/flaky-bulk", f"{server.base_url}/missing"]
+    results = html_downloader.fetch_html_texts(urls, max_concurrency=4)
+
+    assert [result.url for result in results] == urls
+    assert all(result.status == 200 and result.text and not result.error for result in results[:13])
+    assert "p7" in results[7].text
+    assert server.hits["/flaky-bulk"] == 3
+    assert results[-1].status == 404 and results[-1].text is None and results[-1].error
+    assert 1 < server.max_active <= 4
+
+    # Andra körningen görs villkorligt och återanvänder de cachade texterna
+    again = html_downloader.fetch_html_texts(urls[:12], max_concurrency=4)
+    assert all(result.status == 304 and result.from_cache for result in again)
+    assert [result.text for result in again] == [result.text for result in results[:12]]
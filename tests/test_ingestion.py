@@ -0,0 +1,38 @@
+# tests/test_ingestion.py
+"""
+Tester för core.ingestion: en föregående version som ingest_document själv öppnar
+stängs även när indexeringen misslyckas, och en text utan chunks ger EmptyDocumentError.
+"""
+import numpy as np
+import pytest
+
+from core import ingestion
+from utils.cache_utils import save_document_cache
+
+
+def test_previous_version_is_closed_on_error(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "doc")
+    save_document_cache(cache_dir, ["Gammal text om utdelningen."], np.ones((1, 4), dtype=np.float32), model="test")
+    opened = []
+    open_document_cache = ingestion.open_document_cache
+
+    def open_and_record(path):
+        document = open_document_cache(path)
+        opened.append(document)
+        return document
+
+    def fail(texts, model):
+        raise RuntimeError("API:et svarar inte")
+
+    monkeypatch.setattr(ingestion, "open_document_cache", open_and_record)
+    monkeypatch.setattr(ingestion, "_embed_missing", fail)
+
+    with pytest.raises(RuntimeError):
+        ingestion.ingest_document("Ny text om rörelseresultatet.\n", cache_dir, model="test")
+    assert len(opened) == 1 and opened[0] is not None
+    assert opened[0].embeddings is None
+
+
+def test_empty_text_raises_empty_document_error(tmp_path):
+    with pytest.raises(ingestion.EmptyDocumentError):
+        ingestion.ingest_document(["", "\n\n"], str(tmp_path / "doc"), model="test")
@@ -0,0 +1,78 @@
+# tests/test_key_figures.py
+"""
+Tester för core.key_figures: nyckeltal ur löptext och tabeller, att förändringar och
+procenttal för belopp inte tolkas som nyckeltalets värde, och uppslag i FactIndex.
+"""
+import pytest
+
+from core.key_figures import FactIndex, extract_key_figures, format_facts
+
+
+def facts_of(text: str):
+    return [(fact.metric, fact.value, fact.unit, fact.period) for fact in extract_key_figures(text)]
+
+
+def test_running_text_with_period():
+    assert facts_of("Rörelseresultatet uppgick till 512 MSEK 2024.") == [("operating_income", 512.0, "MSEK", "2024")]
+    assert facts_of("Styrelsen föreslår en utdelning om 4,50 kr per aktie.") == [
+        ("dividend_per_share", 4.5, "SEK", None)
+    ]
+
+
+def test_table_rows_take_periods_and_unit_from_header():
+    text = "MSEK   2024   2023\nNettoomsättning   1 234   1 100\nRörelsemarginal, %   12,5   11,0\n"
+    assert facts_of(text) == [
+        ("net_sales", 1234.0, "MSEK", "2024"),
+        ("net_sales", 1100.0, "MSEK", "2023"),
+        ("operating_margin", 12.5, "%", "2024"),
+        ("operating_margin", 11.0, "%", "2023"),
+    ]
+
+
+@pytest.mark.parametrize("text", [
+    "Nettoomsättningen ökade med 10 procent.",
+    "Nettoomsättningen ökade med 10 procent jämfört med 2023.",
+    "Rörelseresultatet minskade med 25 MSEK.",
+    "Net sales increased by 8%.",
+    "Utdelningsandelen var 40 %.",
+    "Nettoomsättning, förändring %    10    5\n",
+])
+def test_changes_and_percentages_are_not_amounts(text):
+    assert facts_of(text) == []
+
+
+def test_value_after_a_change_is_kept():
+    assert facts_of("Nettoomsättningen ökade med 10 procent till 1 100 MSEK 2024.") == [
+        ("net_sales", 1100.0, "MSEK", "2024")
+    ]
+    assert facts_of("Rörelsemarginalen ökade med 1,2 procentenheter till 12,5 procent.") == [
+        ("operating_margin", 12.5, "%", None)
+    ]
+    assert facts_of("Soliditeten uppgick till 45 %.") == [("equity_ratio", 45.0, "%", None)]
+
+
+def test_fact_index_lookup_and_chunks():
+    text = (
+        "Nettoomsättningen uppgick till 1 234 MSEK 2024.\n"
+        "Nettoomsättningen uppgick till 1 100 MSEK 2023.\n"
+        "Styrelsen föreslår en utdelning om 4,50 kr per aktie.\n"
+    )
+    first_line = text.index("\n") + 1
+    index = FactIndex.from_text(text, [(0, first_line), (first_line, len(text))])
+
+    assert len(index) == 3
+    assert [fact.value for fact in index.lookup("Hur stor var nettoomsättningen 2023?")] == [1100.0]
+    assert [fact.value for fact in index.lookup("Vad blev nettoomsättningen?")] == [1234.0, 1100.0]
+    # Den generella frågan hittar utdelningen per aktie
+    assert [fact.metric for fact in index.lookup("Vilken utdelning föreslås?")] == ["dividend_per_share"]
+    assert index.chunk_ranking("nettoomsättning").tolist() == [0, 1]
+    assert "Utdelning per aktie: 4,50 kr" in format_facts(index.lookup("utdelning"))
+
+
+def test_fact_index_save_and_load(tmp_path):
+    index = FactIndex.from_chunks(["Rörelseresultatet uppgick till 512 MSEK 2024.", "Soliditet 45 %"])
+    index.save(str(tmp_path))
+    loaded = FactIndex.load(str(tmp_path))
+    assert loaded.facts == index.facts
+    assert [fact.chunk for fact in loaded.facts] == [0, 1]
+    assert FactIndex.load(str(tmp_path / "saknas")) is None
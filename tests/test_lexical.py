@@ -0,0 +1,73 @@
+# tests/test_lexical.py
+"""
+Tester för core.lexical: stammning av böjningsformer, tokenisering och BM25-indexet
+(poängsättning, sparande och att ett index från en äldre tokenisering inte läses in).
+"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from core.lexical import BM25Index, stem, tokenize
+
+
+@pytest.mark.parametrize("forms", [
+    ("utdelning", "utdelningen", "utdelningar", "utdelningarna"),
+    ("nettoomsättning", "nettoomsättningen", "nettoomsättningens"),
+    ("aktie", "aktien", "aktier", "aktierna", "aktiernas"),
+    ("resultat", "resultatet", "resultatets"),
+    ("dividend", "dividends"),
+])
+def test_inflected_forms_share_stem(forms):
+    assert len({stem(form) for form in forms}) == 1
+
+
+def test_stem_keeps_short_words_and_numbers():
+    assert stem("år") == "år"
+    assert stem("ökar") == "ökar"
+    assert stem("12,5") == "12,5"
+
+
+def test_tokenize_lowercases_and_drops_stopwords():
+    assert tokenize("Utdelningen till aktieägarna och 1.234 MSEK") == [
+        stem("utdelningen"), stem("aktieägarna"), "1.234", "msek"
+    ]
+    assert tokenize("och i att the of") == []
+
+
+def test_bm25_ranks_matching_chunks():
+    texts = [
+        "Styrelsen föreslår en utdelning om 4 kr per aktie.",
+        "Nettoomsättningen ökade till 1 234 MSEK.",
+        "Utdelningarna till aktieägarna har ökat under flera år, utdelning varje år.",
+    ]
+    index = BM25Index.build(texts)
+    scores = index.scores("Hur stor är utdelningen?")
+    assert len(index) == 3
+    assert scores[1] == 0
+    assert scores[0] > 0 and scores[2] > 0
+    assert list(np.argsort(-scores)[:2]) in ([0, 2], [2, 0])
+    assert not index.scores("koncernens kassaflöde").any()
+
+
+def test_bm25_save_and_load(tmp_path):
+    texts = ["Rörelseresultatet uppgick till 120 MSEK.", "Utdelningen föreslås till 2 kr."]
+    index = BM25Index.build(texts)
+    index.save(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path))
+    assert loaded is not None
+    assert np.allclose(loaded.scores("utdelning"), index.scores("utdelning"))
+    assert np.allclose(loaded.scores("rörelseresultat"), index.scores("rörelseresultat"))
+
+
+def test_index_from_older_tokenizer_is_not_loaded(tmp_path):
+    BM25Index.build(["Utdelningen föreslås till 2 kr."]).save(str(tmp_path))
+    path = os.path.join(str(tmp_path), "bm25_terms.json")
+    with open(path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    del meta["tokenizer"]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    assert BM25Index.load(str(tmp_path)) is None
+    assert BM25Index.load(str(tmp_path / "saknas")) is None
@@ -0,0 +1,35 @@
+# tests/test_spreadsheet.py
+"""
+Tester för core.spreadsheet: radgruppernas "rad a–b" är bladets radnummer, även när
+tomma rader och kolumnrubriker hoppas över.
+"""
+import io
+
+from core.spreadsheet import extract_spreadsheet_text, iter_sheet_groups
+
+
+def test_groups_are_labelled_with_sheet_rows():
+    rows = [(1, (None, None)), (3, ("MSEK", 2024)), (4, ("Nettoomsättning", 1234)), (6, ("Rörelseresultat", 120))]
+    assert list(iter_sheet_groups("Resultat", rows)) == [
+        "## Resultat (rad 4–6)\nMSEK | 2024\nNettoomsättning | 1234\nRörelseresultat | 120\n\n"
+    ]
+    groups = list(iter_sheet_groups("Resultat", rows, max_tokens=20))
+    assert [group.splitlines()[0] for group in groups] == ["## Resultat (rad 4–4)", "## Resultat (rad 6–6)"]
+
+
+def test_workbook_rows_keep_their_numbers():
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = "Resultat"
+    sheet.append(["MSEK", 2024, 2023])
+    sheet.append([])
+    sheet.append(["Nettoomsättning", 1234, 1100])
+    sheet["A7"] = "Rörelseresultat"
+    sheet["B7"] = 120
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+
+    text = extract_spreadsheet_text(buffer.getvalue(), "rapport.xlsx")
+    assert text.startswith("## Resultat (rad 3–7)\nMSEK | 2024 | 2023\n")
@@ -0,0 +1,287 @@
+# utils/answer_cache.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from typing import Any, Dict, NamedTuple, Optional, Sequence
+
+from utils.embedding_store import EVICT_EVERY_WRITES, EVICT_LOW_WATER, normalize_chunk_text
+from utils.metrics import inc
+
+# Utfall i cache_requests_total för respektive räknare i stats()
+_CACHE_RESULTS = {"exact_hits": "hit", "semantic_hits": "semantic_hit", "misses": "miss"}
+
+DEFAULT_ANSWER_CACHE_PATH = os.path.join("data", "cache", "answer_cache.sqlite3")
+DEFAULT_MAX_ENTRIES = 20_000
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+
+
+def context_hash(context: str) -> str:
+    """
+    sha256 av den hämtade kontexten (normaliserat blanksteg).
+    """
+    return hashlib.sha256(normalize_chunk_text(context).encode("utf-8")).hexdigest()
+
+
+def answer_key(doc_id: str, context: str, model: str, prompt_version: str, question: str) -> str:
+    """
+    Exakt nyckel: (dokument, kontext-hash, modell, promptversion) plus den normaliserade
+    frågan, så att olika frågor som råkar hämta samma kontext inte delar svar.
+    """
+    question = normalize_chunk_text(question).casefold()
+    payload = "\x00".join([doc_id, context_hash(context), model, prompt_version, question])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CachedAnswer(NamedTuple):
+    key: str
+    question: str
+    answer: str
+    evaluation: Optional[Dict[str, Any]]
+    match: str          # "exact" eller "semantic"
+    similarity: float
+
+
+class AnswerCache:
+    """
+    Svarscache i SQLite för frågor mot samma rapport.
+
+    - Exakt träff: samma dokument, kontext, modell, promptversion och fråga.
+    - Semantisk träff: en tidigare fråga mot samma dokument (samma modell, promptversion
+      och språk) vars embedding har cosinuslikhet >= similarity_threshold.
+      Språket ingår med avsikt: svaret skrivs på frågans språk (se systemprompten i
+      core.gpt_logic), så ett cachat svenskt svar duger inte som svar på en engelsk fråga
+      utan en översättning. Samma fråga på två språk ligger dessutom normalt klart under
+      en så hög tröskel, så en parafras på ett annat språk genererar ett nytt svar, som
+      sedan cachas för det språket.
+    - Poster äldre än ttl_seconds ignoreras och rensas; över max_entries tas de minst
+      nyligen använda bort, ned till EVICT_LOW_WATER av gränsen. Rensningen körs som i
+      EmbeddingStore först när det uppskattade antalet passerar gränsen eller efter
+      EVICT_EVERY_WRITES skrivningar.
+    - RAGAS-resultatet sparas med svaret så att utvärderingen inte heller görs om.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_ANSWER_CACHE_PATH,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+        self._evict_lock = threading.Lock()
+        # Senast räknade antal poster (None: inte räknat än) och skrivna svar sedan dess
+        self._counted: Optional[int] = None
+        self._written = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " key TEXT PRIMARY KEY,"
+                " doc_id TEXT NOT NULL,"
+                " model TEXT NOT NULL,"
+                " prompt_version TEXT NOT NULL,"
+                " language TEXT,"
+                " question TEXT NOT NULL,"
+                " question_vector BLOB,"
+                " answer TEXT NOT NULL,"
+                " evaluation TEXT,"
+                " created REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_doc ON answers(doc_id, model, prompt_version)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers(last_used)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # En anslutning per tråd; sqlite3-anslutningar får inte delas mellan trådar
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+        inc("cache_requests_total", cache="answers", result=_CACHE_RESULTS[name])
+
+    def _touch(self, key: str):
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+
+    def lookup(
+        self,
+        doc_id: str,
+        question: str,
+        context: str,
+        model: str,
+        prompt_version: str,
+        query_embedding: Optional[Sequence[float]] = None,
+        language: Optional[str] = None
+    ) -> Optional[CachedAnswer]:
+        """
+        Söker först en exakt träff och sedan (om 'query_embedding' ges) en semantisk bland
+        frågor på samma språk ('language'; None jämför med alla språk).
+        """
+        conn = self._connection()
+        min_created = time.time() - self.ttl_seconds
+        key = answer_key(doc_id, context, model, prompt_version, question)
+        row = conn.execute(
+            "SELECT question, answer, evaluation FROM answers WHERE key = ? AND created >= ?",
+            (key, min_created)
+        ).fetchone()
+        if row is not None:
+            self._touch(key)
+            self._count("exact_hits")
+            return CachedAnswer(key, row[0], row[1], json.loads(row[2]) if row[2] else None, "exact", 1.0)
+
+        if query_embedding is not None:
+            rows = conn.execute(
+                "SELECT key, question, answer, evaluation, question_vector FROM answers"
+                " WHERE doc_id = ? AND model = ? AND prompt_version = ? AND created >= ?"
+                " AND question_vector IS NOT NULL AND (language IS ? OR ? IS NULL)",
+                (doc_id, model, prompt_version, min_created, language, language)
+            ).fetchall()
+            if rows:
+                query = np.asarray(query_embedding, dtype=np.float32)
+                query = query / (np.linalg.norm(query) or 1.0)
+                vectors = np.stack([np.frombuffer(r[4], dtype=np.float32) for r in rows])
+                similarities = vectors @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    hit_key, hit_question, answer, evaluation, _ = rows[best]
+                    self._touch(hit_key)
+                    self._count("semantic_hits")
+                    return CachedAnswer(
+                        hit_key, hit_question, answer, json.loads(evaluation) if evaluation else None,
+                        "semantic", float(similarities[best])
+                    )
+        self._count("misses")
+        return None
+
+    def put(
+        self,
+        doc_id: str,
+        question: str,
+        context: str,
+        model: str,
+        prompt_version: str,
+        answer: str,
+        query_embedding: Optional[Sequence[float]] = None,
+        language: Optional[str] = None,
+        evaluation: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        Sparar ett svar och returnerar dess nyckel (används av set_evaluation).
+        """
+        key = answer_key(doc_id, context, model, prompt_version, question)
+        vector = None
+        if query_embedding is not None:
+            array = np.asarray(query_embedding, dtype=np.float32)
+            vector = (array / (np.linalg.norm(array) or 1.0)).tobytes()
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, doc_id, model, prompt_version, language, question,"
+                " question_vector, answer, evaluation, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, doc_id, model, prompt_version, language, question, vector, answer,
+                 json.dumps(evaluation) if evaluation else None, now, now)
+            )
+        self._maybe_evict()
+        return key
+
+    def set_evaluation(self, key: str, evaluation: Dict[str, Any]):
+        """
+        Sparar RAGAS-resultatet för ett cachat svar.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE answers SET evaluation = ? WHERE key = ?", (json.dumps(evaluation), key))
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def _maybe_evict(self):
+        # Utgångna poster ignoreras redan av lookup, så de kan ligga kvar till nästa rensning
+        with self._evict_lock:
+            self._written += 1
+            if (
+                self._counted is not None
+                and self._counted + self._written <= self.max_entries
+                and self._written < EVICT_EVERY_WRITES
+            ):
+                return
+        self.evict()
+
+    def evict(self):
+        """
+        Tar bort utgångna poster och, över storleksgränsen, de minst nyligen använda ned
+        till EVICT_LOW_WATER av gränsen.
+        """
+        conn = self._connection()
+        with self._evict_lock:
+            self._written = 0
+        with conn:
+            conn.execute("DELETE FROM answers WHERE created < ?", (time.time() - self.ttl_seconds,))
+        count = len(self)
+        if count > self.max_entries:
+            excess = count - int(self.max_entries * EVICT_LOW_WATER)
+            with conn:
+                conn.execute(
+                    "DELETE FROM answers WHERE key IN ("
+                    " SELECT key FROM answers ORDER BY last_used ASC LIMIT ?)",
+                    (excess,)
+                )
+            count -= excess
+        with self._evict_lock:
+            self._counted = count
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Träff- och missräknare för den här processen.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["semantic_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """
+    Returnerar processens delade AnswerCache. Kan styras med miljövariablerna
+    ANSWER_CACHE_PATH, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS och
+    ANSWER_CACHE_SIMILARITY.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnswerCache(
+                    os.getenv("ANSWER_CACHE_PATH", DEFAULT_ANSWER_CACHE_PATH),
+                    int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                    float(os.getenv("ANSWER_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+                    float(os.getenv("ANSWER_CACHE_SIMILARITY", DEFAULT_SIMILARITY_THRESHOLD))
+                )
+    return _cache
@@ -1,18 +1,506 @@
 import os
+import json
+import mmap
+import shutil
+import sqlite3
+import uuid
+import threading
 import pickle
 import hashlib
+import numpy as np
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from core.chunking import chunk_hash
+from core.key_figures import FactIndex
+from core.lexical import BM25Index
+from core.retrieval import normalize_rows
+
+# Binärt cacheformat per dokument (en katalog):
+#   header.json  - format, modell, dimension, antal, dtype, chunker-parametrar
+#   vectors.npy  - (antal x dimension) normaliserade vektorer, öppnas med memmap
+#   texts.bin    - alla chunk-texter som en UTF-8-blob
+#   offsets.npy  - byte-offset (antal + 1) för varje text i texts.bin
+#   spans.npy    - (valfri) teckenintervall (start, end) för varje chunk i källtexten
+#   hashes.npy   - innehållshash (core.chunking.chunk_hash) per chunk, för inkrementell omindexering
+#   bm25_*       - (valfritt) inverterat BM25-index över chunkarna (core.lexical)
+#   facts.json   - (valfri) nyckeltal med värde, enhet, period och offset (core.key_figures)
+# Bredvid dokumentkatalogerna ligger hashes.sqlite3 (_HashIndex): chunkhash -> dokument, så att
+# find_previous_version inte behöver läsa varje dokuments hashes.npy.
+CACHE_FORMAT_VERSION = 1
+DOCUMENT_CACHE_DIR = os.path.join("data", "embeddings")
+HASH_INDEX_NAME = "hashes.sqlite3"
+TEXT_CACHE_DIR = os.path.join("data", "cache")
+
 
 def get_embedding_cache_name(source_id: str) -> str:
     hashed = hashlib.md5(source_id.encode("utf-8")).hexdigest()
     return os.path.join("embeddings", f"embeddings_{hashed}.pkl")
 
+
+def get_document_fingerprint(text: str) -> str:
+    """
+    Innehållsbaserat id för ett dokument: sha256 av texten med normaliserat blanksteg.
+    Samma rapport ger samma id oavsett filnamn eller källa.
+    """
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+
+def get_document_cache_dir(source_id: str) -> str:
+    """
+    Returnerar katalogen för ett dokuments binära embedding-cache.
+    """
+    hashed = hashlib.md5(source_id.encode("utf-8")).hexdigest()
+    return os.path.join(DOCUMENT_CACHE_DIR, f"doc_{hashed}")
+
+
 def save_embeddings(filename, data):
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     with open(filename, "wb") as f:
         pickle.dump(data, f)
 
+
 def load_embeddings_if_exists(filename):
     if os.path.exists(filename):
         with open(filename, "rb") as f:
             return pickle.load(f)
     return None
+
+
+def text_cache_key(*parts: str) -> str:
+    """
+    Stabil nyckel (sha256) för en textcache, byggd av alla delar som påverkar resultatet.
+    """
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def load_cached_text(namespace: str, key: str) -> Optional[str]:
+    """
+    Läser en cachad text (t.ex. en avsnittssammanfattning), eller None om den saknas.
+    """
+    path = os.path.join(TEXT_CACHE_DIR, namespace, f"{key}.txt")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    return None
+
+
+def save_cached_text(namespace: str, key: str, text: str):
+    """
+    Sparar en text i cachen; skrivs till en temporär fil som sedan flyttas på plats.
+    """
+    directory = os.path.join(TEXT_CACHE_DIR, namespace)
+    os.makedirs(directory, exist_ok=True)
+    # Unikt per anrop: samma nyckel kan skrivas samtidigt från flera trådar i samma process
+    tmp_path = os.path.join(directory, f"{key}.tmp-{uuid.uuid4().hex}")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, os.path.join(directory, f"{key}.txt"))
+
+
+class ChunkTexts(Sequence):
+    """
+    Läser chunk-texter direkt ur en minnesmappad blob; en text avkodas först när den efterfrågas.
+    """
+
+    def __init__(self, blob_path: str, offsets: np.ndarray):
+        self._offsets = offsets
+        self._file = open(blob_path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._blob[start:end].decode("utf-8")
+
+    def close(self):
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._file.close()
+
+
+class CachedDocument:
+    """
+    Ett öppnat dokument i det binära cacheformatet.
+
+    'embeddings' är en read-only memmap och 'texts' en lat sekvens, så att öppna
+    dokumentet tar i stort sett konstant tid oavsett storlek.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "header.json"), "r", encoding="utf-8") as f:
+            self.header: Dict[str, Any] = json.load(f)
+        self.embeddings = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.texts = ChunkTexts(os.path.join(path, "texts.bin"), offsets)
+        spans_path = os.path.join(path, "spans.npy")
+        self.spans = np.load(spans_path, mmap_mode="r") if os.path.exists(spans_path) else None
+        # Saknas i cacher från före hybridsökningen; byggs då vid behov av DocumentIndex
+        self.lexical = BM25Index.load(path)
+        self.facts = FactIndex.load(path)
+        self._hashes: Optional[List[str]] = None
+
+    @property
+    def model(self) -> str:
+        return self.header["model"]
+
+    def close(self):
+        """
+        Stänger textblobben och släpper vektorernas memmap (frigörs när inga vyer av den finns kvar).
+        """
+        self.texts.close()
+        self.embeddings = None
+        self.spans = None
+
+    def __enter__(self) -> "CachedDocument":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.header["count"]
+
+    @property
+    def hashes(self) -> List[str]:
+        """
+        Chunkarnas innehållshashar; beräknas ur texterna för cacher som sparades utan hashes.npy.
+        """
+        if self._hashes is None:
+            hashes_path = os.path.join(self.path, "hashes.npy")
+            if os.path.exists(hashes_path):
+                self._hashes = [value.decode("ascii") for value in np.load(hashes_path).tolist()]
+            else:
+                self._hashes = [chunk_hash(text) for text in self.texts]
+        return self._hashes
+
+    def to_embedded_chunks(self) -> List[Dict[str, Any]]:
+        """
+        Bakåtkompatibelt format: [{"text": ..., "embedding": [...]}, ...].
+        """
+        return [
+            {"text": self.texts[i], "embedding": self.embeddings[i].astype(np.float32).tolist()}
+            for i in range(len(self))
+        ]
+
+
+def save_document_cache(
+    path: str,
+    texts: Sequence[str],
+    embeddings: Any,
+    model: str,
+    chunker_params: Optional[Dict[str, Any]] = None,
+    dtype: str = "float32",
+    spans: Optional[Sequence[Sequence[int]]] = None,
+    facts: Optional[FactIndex] = None,
+    hashes: Optional[Sequence[str]] = None,
+    fingerprint: Optional[str] = None
+) -> CachedDocument:
+    """
+    Sparar ett dokuments chunks och embeddings i det binära cacheformatet.
+
+    Vektorerna L2-normaliseras innan de sparas, så att sökning kan använda
+    memmap-matrisen direkt. dtype="float16" halverar storleken på disk.
+    'spans' är chunkarnas (start, end) i källtexten, om chunkern ger offsets.
+    BM25-indexet för hybridsökning byggs och sparas samtidigt, liksom nyckeltalen:
+    'facts' (FactIndex.from_text över hela källtexten) eller, om det saknas, chunk för chunk.
+    Chunkarnas innehållshashar ('hashes', annars beräknade) och källtextens 'fingerprint'
+    sparas så att en senare version av dokumentet kan jämföras mot den här.
+    Katalogen skrivs först under ett unikt temporärt namn och flyttas sedan på plats under
+    ett lås per dokument; en befintlig version flyttas först undan, så att läsare aldrig
+    ser en halvskriven katalog. Finns en komplett katalog på plats när flytten misslyckas
+    räknas det som lyckat och den används.
+    """
+    if dtype not in ("float32", "float16"):
+        raise ValueError("dtype måste vara 'float32' eller 'float16'.")
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[0] != len(texts):
+        raise ValueError("Antalet texter och embeddings måste stämma överens.")
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(blob) for blob in encoded])
+    header = {
+        "format": CACHE_FORMAT_VERSION,
+        "model": model,
+        "dim": int(matrix.shape[1]),
+        "count": len(texts),
+        "dtype": dtype,
+        "normalized": True,
+        "chunker": chunker_params or {},
+        "fingerprint": fingerprint,
+    }
+
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "vectors.npy"), normalize_rows(matrix).astype(dtype))
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    if spans is not None:
+        np.save(os.path.join(tmp_path, "spans.npy"), np.asarray(spans, dtype=np.int64).reshape(-1, 2))
+    with open(os.path.join(tmp_path, "texts.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+    hashes = list(hashes) if hashes is not None else [chunk_hash(text) for text in texts]
+    np.save(os.path.join(tmp_path, "hashes.npy"), np.asarray(hashes, dtype="S32"))
+    BM25Index.build(texts).save(tmp_path)
+    (facts if facts is not None else FactIndex.from_chunks(texts)).save(tmp_path)
+    with open(os.path.join(tmp_path, "header.json"), "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False)
+    with _document_lock(path):
+        _move_into_place(tmp_path, path)
+        _get_hash_index(os.path.dirname(os.path.abspath(path))).register(
+            os.path.basename(os.path.abspath(path)), model, hashes
+        )
+        return CachedDocument(path)
+
+
+_path_locks: Dict[str, threading.Lock] = {}
+_path_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _document_lock(path: str) -> Iterator[None]:
+    """
+    Låser ett dokuments cachekatalog för skrivning: mellan trådar med ett lås per sökväg och
+    mellan processer med flock på en låsfil bredvid katalogen (där fcntl finns).
+    """
+    key = os.path.abspath(path)
+    with _path_locks_guard:
+        lock = _path_locks.setdefault(key, threading.Lock())
+    with lock:
+        try:
+            import fcntl
+        except ImportError:  # Windows: bara låset inom processen
+            yield
+            return
+        with open(f"{path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _move_into_place(tmp_path: str, path: str):
+    """
+    Flyttar en färdigskriven cachekatalog till 'path' med atomära namnbyten.
+    """
+    old_path = None
+    if os.path.exists(path):
+        # En katalog kan inte ersättas atomärt med os.replace; den gamla byter namn först
+        old_path = f"{path}.old-{uuid.uuid4().hex}"
+        try:
+            os.replace(path, old_path)
+        except FileNotFoundError:
+            old_path = None  # en annan skrivare hann flytta undan den
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Målet finns igen: en annan skrivare hann före. Är dess katalog komplett gäller den.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, "header.json")):
+            if old_path is not None and not os.path.exists(path):
+                os.replace(old_path, path)
+                old_path = None
+            raise
+    finally:
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+
+def open_document_cache(path: str, chunker_params: Optional[Dict[str, Any]] = None) -> Optional[CachedDocument]:
+    """
+    Öppnar en binär dokumentcache om den finns och har ett känt format, annars None.
+    Med 'chunker_params' räknas även en cache som chunkats med andra parametrar (eller en
+    äldre chunker) som saknad, så att dokumentet indexeras om.
+    """
+    for _ in range(3):
+        if not os.path.exists(os.path.join(path, "header.json")):
+            return None
+        try:
+            document = CachedDocument(path)
+        except FileNotFoundError:
+            # En ny version flyttades på plats medan filerna öppnades; försök igen
+            continue
+        if document.header.get("format") != CACHE_FORMAT_VERSION or (
+            chunker_params is not None and document.header.get("chunker") != chunker_params
+        ):
+            document.close()
+            return None
+        return document
+    return None
+
+
+def _is_document_dir(name: str) -> bool:
+    # doc_<md5>; temporära, undanflyttade kataloger, låsfiler och hashindexet har en ändelse
+    return name.startswith("doc_") and "." not in name
+
+
+def _read_hashes(path: str) -> Optional[tuple]:
+    """
+    Läser en cachekatalogs (modell, chunkhashar), eller None om den saknar hashar eller har ett annat format.
+    """
+    try:
+        with open(os.path.join(path, "header.json"), "r", encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("format") != CACHE_FORMAT_VERSION:
+            return None
+        return header.get("model"), [value.decode("ascii") for value in np.load(os.path.join(path, "hashes.npy")).tolist()]
+    except (OSError, ValueError):
+        return None
+
+
+class _HashIndex:
+    """
+    SQLite-index chunkhash -> dokumentkatalog för en cachekatalog. save_document_cache
+    registrerar varje sparat dokument; cacher som fanns innan indexet skapades läses in
+    en gång när det skapas.
+    """
+
+    def __init__(self, cache_root: str):
+        self.path = os.path.join(cache_root, HASH_INDEX_NAME)
+        self._local = threading.local()
+        os.makedirs(cache_root, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, model TEXT NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                " hash TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " PRIMARY KEY (hash, name)) WITHOUT ROWID"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            backfilled = conn.execute("SELECT value FROM meta WHERE key = 'backfilled'").fetchone()
+        if backfilled is None:
+            self._backfill(cache_root)
+
+    def _connection(self) -> sqlite3.Connection:
+        # En anslutning per tråd; sqlite3-anslutningar får inte delas mellan trådar
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _backfill(self, cache_root: str):
+        for name in os.listdir(cache_root):
+            found = _read_hashes(os.path.join(cache_root, name)) if _is_document_dir(name) else None
+            if found is not None:
+                self.register(name, *found)
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', '1')")
+
+    def register(self, name: str, model: str, hashes: Sequence[str]):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM chunks WHERE name = ?", (name,))
+            conn.execute("INSERT OR REPLACE INTO documents (name, model) VALUES (?, ?)", (name, model))
+            conn.executemany(
+                "INSERT OR IGNORE INTO chunks (hash, name) VALUES (?, ?)", ((value, name) for value in set(hashes))
+            )
+
+    def forget(self, name: str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM chunks WHERE name = ?", (name,))
+            conn.execute("DELETE FROM documents WHERE name = ?", (name,))
+
+    def overlaps(self, hashes: Sequence[str], model: str) -> List[tuple]:
+        """
+        Returnerar [(dokument, antal gemensamma hashar), ...] för dokument med samma modell, flest först.
+        """
+        counts: Counter = Counter()
+        conn = self._connection()
+        wanted = list(set(hashes))
+        # SQLite begränsar antalet parametrar per fråga
+        for i in range(0, len(wanted), 500):
+            batch = wanted[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            for name, overlap in conn.execute(
+                f"SELECT c.name, COUNT(*) FROM chunks c JOIN documents d ON d.name = c.name"
+                f" WHERE d.model = ? AND c.hash IN ({placeholders}) GROUP BY c.name",
+                (model, *batch)
+            ):
+                counts[name] += overlap
+        return counts.most_common()
+
+
+_hash_indexes: Dict[str, _HashIndex] = {}
+_hash_indexes_lock = threading.Lock()
+
+
+def _get_hash_index(cache_root: str) -> _HashIndex:
+    key = os.path.abspath(cache_root)
+    index = _hash_indexes.get(key)
+    if index is None:
+        with _hash_indexes_lock:
+            index = _hash_indexes.get(key)
+            if index is None:
+                index = _hash_indexes[key] = _HashIndex(key)
+    return index
+
+
+def find_previous_version(
+    hashes: Sequence[str],
+    model: str,
+    exclude: Optional[str] = None,
+    min_overlap: float = 0.3,
+    cache_root: str = DOCUMENT_CACHE_DIR
+) -> Optional[CachedDocument]:
+    """
+    Letar bland de cachade dokumenten efter en tidigare version av ett dokument: det med
+    flest gemensamma chunkhashar, om minst 'min_overlap' av de nya chunkarna finns där.
+    Kandidaterna slås upp i hashindexet (_HashIndex) i stället för att varje cachad
+    katalog läses; bara cacher med samma embedding-modell jämförs.
+    """
+    wanted = set(hashes)
+    if not wanted or not os.path.isdir(cache_root):
+        return None
+    index = _get_hash_index(cache_root)
+    excluded = os.path.basename(os.path.abspath(exclude)) if exclude else None
+    for name, overlap in index.overlaps(list(wanted), model):
+        if overlap < min_overlap * len(wanted):
+            break
+        if name == excluded:
+            continue
+        document = open_document_cache(os.path.join(cache_root, name))
+        if document is None:
+            # Katalogen har tagits bort sedan den registrerades
+            index.forget(name)
+            continue
+        return document
+    return None
+
+
+def migrate_pickle_cache(
+    pickle_path: str,
+    path: str,
+    model: str = "text-embedding-3-small",
+    chunker_params: Optional[Dict[str, Any]] = None
+) -> Optional[CachedDocument]:
+    """
+    Konverterar en gammal pickle-cache (lista med {"text", "embedding"}) till det binära formatet.
+    Returnerar None om det inte finns någon pickle att migrera.
+    """
+    embedded_chunks = load_embeddings_if_exists(pickle_path)
+    if not embedded_chunks:
+        return None
+    params = dict(chunker_params or {"chunker": "chunk_text", "max_length": 1500, "overlap": 200})
+    params["migrated_from"] = pickle_path
+    return save_document_cache(
+        path,
+        [item["text"] for item in embedded_chunks],
+        [item["embedding"] for item in embedded_chunks],
+        model=model,
+        chunker_params=params,
+    )
@@ -0,0 +1,183 @@
+# utils/embedding_store.py
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from typing import List, Optional, Sequence
+
+DEFAULT_STORE_PATH = os.path.join("data", "embeddings", "embedding_store.sqlite3")
+DEFAULT_MAX_ENTRIES = 250_000
+# Rensningen räknar posterna (COUNT(*)) först när den egna uppskattningen passerar gränsen,
+# eller efter så här många skrivningar (andra processer skriver till samma fil), och
+# rensar då ned till EVICT_LOW_WATER av gränsen så att nästa rensning dröjer
+EVICT_EVERY_WRITES = 1000
+EVICT_LOW_WATER = 0.9
+
+
+def normalize_chunk_text(text: str) -> str:
+    """
+    Normaliserar en text innan den hashas: Unicode NFC och komprimerat blanksteg,
+    så att samma chunk ger samma nyckel oavsett radbrytningar eller indrag.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_key(model: str, text: str) -> str:
+    """
+    Innehållsadresserad nyckel: sha256 av (modell, normaliserad text).
+    """
+    payload = f"{model}\x00{normalize_chunk_text(text)}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Diskbaserad embedding-cache i SQLite, delad mellan dokument, användare och processer.
+
+    - Nyckel: embedding_key(model, text), värde: float32-vektor som BLOB.
+    - WAL-läge och busy_timeout gör samtidig åtkomst från flera processer säker.
+    - När antalet poster överstiger max_entries tas de minst nyligen använda bort, ned
+      till EVICT_LOW_WATER av gränsen. Antalet räknas inte vid varje skrivning utan
+      uppskattas från det senast räknade antalet plus skrivningarna sedan dess.
+    """
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._evict_lock = threading.Lock()
+        # Senast räknade antal poster (None: inte räknat än) och skrivna rader sedan dess
+        self._counted: Optional[int] = None
+        self._written = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT NOT NULL,"
+                " dim INTEGER NOT NULL,"
+                " vector BLOB NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # En anslutning per tråd; sqlite3-anslutningar får inte delas mellan trådar
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """
+        Slår upp flera texter på en gång. Returnerar None för texter som saknas.
+        """
+        keys = [embedding_key(model, text) for text in texts]
+        found = {}
+        conn = self._connection()
+        unique_keys = list(dict.fromkeys(keys))
+        # SQLite begränsar antalet parametrar per fråga
+        for start in range(0, len(unique_keys), 500):
+            part = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+            ).fetchall()
+            found.update({key: np.frombuffer(blob, dtype=np.float32).tolist() for key, blob in rows})
+        if found:
+            now = time.time()
+            with conn:
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+        return [found.get(key) for key in keys]
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model: str, texts: Sequence[str], embeddings: Sequence[Sequence[float]]):
+        """
+        Sparar embeddings för flera texter i en transaktion och rensar vid behov.
+        """
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32)
+            rows.append((embedding_key(model, text), model, vector.shape[0], vector.tobytes(), now))
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dim, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        self._maybe_evict(len(rows))
+
+    def put(self, model: str, text: str, embedding: Sequence[float]):
+        self.put_many(model, [text], [embedding])
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _maybe_evict(self, written: int):
+        # Det uppskattade antalet är en övre gräns för den egna processens skrivningar
+        # (INSERT OR REPLACE kan ersätta en befintlig post)
+        with self._evict_lock:
+            self._written += written
+            if (
+                self._counted is not None
+                and self._counted + self._written <= self.max_entries
+                and self._written < EVICT_EVERY_WRITES
+            ):
+                return
+        self.evict()
+
+    def evict(self):
+        """
+        Tar bort de minst nyligen använda posterna om storleksgränsen överskrids, ned till
+        EVICT_LOW_WATER av gränsen.
+        """
+        conn = self._connection()
+        with self._evict_lock:
+            self._written = 0
+        count = len(self)
+        if count > self.max_entries:
+            excess = count - int(self.max_entries * EVICT_LOW_WATER)
+            with conn:
+                conn.execute(
+                    "DELETE FROM embeddings WHERE key IN ("
+                    " SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (excess,)
+                )
+            count -= excess
+        with self._evict_lock:
+            self._counted = count
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_embedding_store() -> EmbeddingStore:
+    """
+    Returnerar processens delade EmbeddingStore. Sökväg och storlek kan styras
+    med miljövariablerna EMBEDDING_STORE_PATH och EMBEDDING_STORE_MAX_ENTRIES.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = EmbeddingStore(
+                    os.getenv("EMBEDDING_STORE_PATH", DEFAULT_STORE_PATH),
+                    int(os.getenv("EMBEDDING_STORE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+                )
+    return _store
@@ -0,0 +1,263 @@
+# utils/evaluation_queue.py
+import os
+import json
+import time
+import queue
+import sqlite3
+import hashlib
+import logging
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+from utils.embedding_store import normalize_chunk_text
+from utils.metrics import span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVALUATION_DB_PATH = os.path.join("data", "cache", "evaluations.sqlite3")
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT_SECONDS = 2.0
+# En påbörjad utvärdering vars process dött (eller hängt sig) tas upp igen efter så här lång tid
+DEFAULT_LEASE_SECONDS = 600.0
+
+
+def triple_hash(question: str, answer: str, contexts: Sequence[str]) -> str:
+    """
+    sha256 av (fråga, svar, kontexter) med normaliserat blanksteg; nyckel för utvärderingscachen.
+    """
+    parts = [question, answer, *contexts]
+    payload = "\x00".join(normalize_chunk_text(part) for part in parts)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EvaluationQueue:
+    """
+    Kö för RAGAS-utvärderingar i en bakgrundstråd.
+
+    - submit() sparar (fråga, svar, kontexter) och returnerar direkt en nyckel.
+    - Arbetstråden samlar upp till 'batch_size' väntande svar (eller vad som kommit
+      inom 'max_wait_seconds') och utvärderar dem i ett RAGAS-anrop.
+    - Resultaten sparas i SQLite per triple_hash, så samma trippel utvärderas bara en
+      gång. Flera processer kan dela databasen: en arbetstråd gör anspråk på sina poster
+      atomärt (status 'running' med ägare) innan de utvärderas, och poster vars anspråk
+      är äldre än 'lease_seconds' (t.ex. efter en krasch) blir väntande igen.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_EVALUATION_DB_PATH,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS,
+        evaluate_batch=None,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.lease_seconds = lease_seconds
+        # Identifierar den här köns anspråk i en databas som delas mellan processer
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        if evaluate_batch is None:
+            from utils.evaluation_utils import ragas_evaluate_batch
+            evaluate_batch = ragas_evaluate_batch
+        self._evaluate_batch = evaluate_batch
+        self._local = threading.local()
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS evaluations ("
+                " key TEXT PRIMARY KEY,"
+                " question TEXT NOT NULL,"
+                " answer TEXT NOT NULL,"
+                " contexts TEXT NOT NULL,"
+                " status TEXT NOT NULL,"     # pending, running, done eller error
+                " result TEXT,"
+                " created REAL NOT NULL,"
+                " updated REAL NOT NULL,"
+                " owner TEXT)"               # kön som gjort anspråk på en post med status running
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(evaluations)")}
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE evaluations ADD COLUMN owner TEXT")
+        # Väntande poster (även från en tidigare process) köas; den som hinner först gör anspråk på dem
+        self._requeue_pending()
+        self._worker = threading.Thread(target=self._run, name="ragas-evaluation", daemon=True)
+        self._worker.start()
+
+    def _connection(self) -> sqlite3.Connection:
+        # En anslutning per tråd; sqlite3-anslutningar får inte delas mellan trådar
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def submit(self, question: str, answer: str, contexts: Sequence[str]) -> str:
+        """
+        Lägger svaret i kön (om det inte redan är utvärderat eller köat) och returnerar dess nyckel.
+        """
+        key = triple_hash(question, answer, contexts)
+        conn = self._connection()
+        row = conn.execute("SELECT status FROM evaluations WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[0] in ("done", "pending", "running"):
+            return key
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO evaluations (key, question, answer, contexts, status, result, created, updated, owner)"
+                " VALUES (?, ?, ?, ?, 'pending', NULL, ?, ?, NULL)",
+                (key, question, answer, json.dumps(list(contexts)), now, now)
+            )
+        self._queue.put(key)
+        return key
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Returnerar resultatet om utvärderingen är klar (eller misslyckad, då med "error"), annars None.
+        """
+        row = self._connection().execute(
+            "SELECT status, result FROM evaluations WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[0] in ("pending", "running"):
+            return None
+        return json.loads(row[1])
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _requeue_pending(self):
+        """
+        Släpper anspråk som löpt ut och lägger alla väntande poster i den här processens kö.
+        """
+        self._requeue_at = time.monotonic() + self.lease_seconds
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "UPDATE evaluations SET status = 'pending', owner = NULL"
+                " WHERE status = 'running' AND updated < ?",
+                (time.time() - self.lease_seconds,)
+            )
+        for (key,) in conn.execute("SELECT key FROM evaluations WHERE status = 'pending' ORDER BY created"):
+            self._queue.put(key)
+
+    def _claim(self, keys: Sequence[str]) -> List[tuple]:
+        """
+        Gör anspråk på de av 'keys' som fortfarande väntar och returnerar deras rader. En
+        enda UPDATE är atomär, så en post tas bara av en kö även om flera processer köat den.
+        """
+        conn = self._connection()
+        placeholders = ",".join("?" * len(keys))
+        with conn:
+            conn.execute(
+                f"UPDATE evaluations SET status = 'running', owner = ?, updated = ?"
+                f" WHERE key IN ({placeholders}) AND status = 'pending'",
+                (self.owner, time.time(), *keys)
+            )
+        return conn.execute(
+            f"SELECT key, question, answer, contexts FROM evaluations"
+            f" WHERE key IN ({placeholders}) AND status = 'running' AND owner = ?",
+            (*keys, self.owner)
+        ).fetchall()
+
+    def _next_batch(self) -> List[str]:
+        while True:
+            # Då och då tas poster upp från processer som dött mitt i en utvärdering
+            if time.monotonic() >= self._requeue_at:
+                self._requeue_pending()
+            try:
+                keys = [self._queue.get(timeout=max(0.0, self._requeue_at - time.monotonic()))]
+                break
+            except queue.Empty:
+                continue
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(keys) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                keys.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return list(dict.fromkeys(keys))
+
+    def _run(self):
+        # Arbetstråden får aldrig dö: ett fel i en batch (t.ex. en låst databas eller ett
+        # oväntat resultat) loggas och batchens poster markeras som misslyckade
+        while True:
+            keys = []
+            try:
+                keys = self._next_batch()
+                self._process(keys)
+            except Exception as e:
+                logger.exception("RAGAS-kön kunde inte behandla en batch")
+                self._mark_failed(keys, e)
+
+    def _process(self, keys: Sequence[str]):
+        rows = self._claim(keys)
+        if not rows:
+            return
+        try:
+            with span("ragas", batch_size=len(rows)):
+                results = self._evaluate_batch([(q, a, json.loads(c)) for _, q, a, c in rows])
+        except Exception as e:
+            logger.error(f"RAGAS-batch misslyckades: {e}")
+            results = [{"error": str(e)} for _ in rows]
+        if len(results) != len(rows):
+            raise ValueError(f"RAGAS gav {len(results)} resultat för {len(rows)} svar.")
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "UPDATE evaluations SET status = ?, result = ?, updated = ?, owner = NULL WHERE key = ? AND owner = ?",
+                [("error" if "error" in result else "done", json.dumps(result), now, row[0], self.owner)
+                 for row, result in zip(rows, results)]
+            )
+        logger.info(f"RAGAS-batch klar: {len(rows)} svar utvärderade.")
+
+    def _mark_failed(self, keys: Sequence[str], error: Exception):
+        """
+        Markerar batchens poster som den här kön gjort anspråk på som misslyckade.
+        """
+        if not keys:
+            return
+        placeholders = ",".join("?" * len(keys))
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    f"UPDATE evaluations SET status = 'error', result = ?, updated = ?, owner = NULL"
+                    f" WHERE key IN ({placeholders}) AND status = 'running' AND owner = ?",
+                    (json.dumps({"error": str(error)}), time.time(), *keys, self.owner)
+                )
+        except Exception:
+            # Posterna tas upp igen när anspråket löpt ut
+            logger.exception("Kunde inte markera RAGAS-batchen som misslyckad")
+
+
+_evaluation_queue = None
+_evaluation_queue_lock = threading.Lock()
+
+
+def get_evaluation_queue() -> EvaluationQueue:
+    """
+    Returnerar processens delade utvärderingskö (startar arbetstråden vid första anropet).
+    Kan styras med miljövariablerna EVALUATION_DB_PATH, EVALUATION_BATCH_SIZE och
+    EVALUATION_MAX_WAIT_SECONDS.
+    """
+    global _evaluation_queue
+    if _evaluation_queue is None:
+        with _evaluation_queue_lock:
+            if _evaluation_queue is None:
+                _evaluation_queue = EvaluationQueue(
+                    os.getenv("EVALUATION_DB_PATH", DEFAULT_EVALUATION_DB_PATH),
+                    int(os.getenv("EVALUATION_BATCH_SIZE", DEFAULT_BATCH_SIZE)),
+                    float(os.getenv("EVALUATION_MAX_WAIT_SECONDS", DEFAULT_MAX_WAIT_SECONDS))
+                )
+    return _evaluation_queue
@@ -1,99 +1,127 @@
 # utils/evaluation_utils.py (Anpassad för RAGAS 0.2.15 - med Hugging Face Dataset)
 
 import os
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
 from dotenv import load_dotenv
 
-# RAGAS Importer för v0.2.x
-from ragas.metrics import faithfulness, answer_relevancy
-from ragas import evaluate
+# ragas, langchain_openai och datasets är tunga att importera och laddas därför
+# först när en utvärdering faktiskt körs (se ragas_evaluate_batch)
 
-from langchain_openai import ChatOpenAI
+load_dotenv()
 
-# Importera Dataset från Hugging Face datasets-biblioteket
-from datasets import Dataset # <--- NY IMPORT
+logger = logging.getLogger(__name__)
 
-load_dotenv()
+RAGAS_MODEL = "gpt-4o"
 
-def ragas_evaluate(question: str, answer: str, contexts: list[str]):
+# En LLM- och embedding-klient för RAGAS-domaren per process, återanvänds mellan utvärderingar
+_ragas_llm = None
+_ragas_embeddings = None
+_ragas_llm_lock = threading.Lock()
+
+
+def _get_ragas_llm(openai_api_key: str):
+    """
+    (LLM, embeddings) för RAGAS. Båda går via schemaläggaren med prioriteten "evaluation",
+    så att utvärderingar inte tränger undan interaktiva anrop.
+    """
+    global _ragas_llm, _ragas_embeddings
+    if _ragas_llm is None:
+        with _ragas_llm_lock:
+            if _ragas_llm is None:
+                from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+                from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
+                from services.openai_service import OPENAI_MAX_RETRIES, openai_event_hooks
+
+                clients = {
+                    "openai_api_key": openai_api_key,
+                    "max_retries": OPENAI_MAX_RETRIES,
+                    "http_client": DefaultHttpxClient(event_hooks=openai_event_hooks("evaluation")),
+                    "http_async_client": DefaultAsyncHttpxClient(
+                        event_hooks=openai_event_hooks("evaluation", asynchronous=True)
+                    ),
+                }
+                # answer_relevancy behöver embeddings; annars skapar RAGAS en egen klient utanför schemaläggaren
+                _ragas_embeddings = OpenAIEmbeddings(**clients)
+                _ragas_llm = ChatOpenAI(model=RAGAS_MODEL, temperature=0, **clients)
+                logger.info("LLM och embeddings för RAGAS initierade.")
+    return _ragas_llm, _ragas_embeddings
+
+
+def _score(value) -> Optional[float]:
+    # Saknade värden kommer som None eller NaN från RAGAS
+    if value is None or value != value:
+        return None
+    return float(value)
+
+
+def ragas_evaluate_batch(triples: Sequence[Tuple[str, str, List[str]]]) -> List[Dict]:
     """
-    Utvärderar ett givet svar med RAGAS-metriker (anpassad för RAGAS v0.2.x med HF Dataset).
+    Utvärderar flera (fråga, svar, kontexter) i ett enda RAGAS-anrop med ett
+    flerradigt Hugging Face Dataset. Returnerar ett resultat per trippel, i samma
+    ordning: {"faithfulness": ..., "answer_relevancy": ...} eller {"error": ...}.
     """
-    print(f"[RAGAS v0.2.x Debug] ragas_evaluate anropad. Fråga (user_input): '{question[:30]}...'")
+    if not triples:
+        return []
+    logger.debug("ragas_evaluate_batch anropad med %d svar.", len(triples))
     try:
-        # Steg 1: Förbered data som en lista av dictionaries (samma som tidigare)
-        dataset_list_of_dicts = [
+        # RAGAS-importer för v0.2.x (fördröjda till första utvärderingen)
+        from ragas.metrics import faithfulness, answer_relevancy
+        from ragas import evaluate
+        # Importera Dataset från Hugging Face datasets-biblioteket
+        from datasets import Dataset
+
+        # Steg 1: En rad per svar, konverterad till ett Hugging Face Dataset
+        hf_dataset = Dataset.from_list([
             {
                 "user_input": question,
                 "response": answer,
-                "retrieved_contexts": contexts
+                "retrieved_contexts": list(contexts)
                 # "ground_truth": "..." # Lägg till om du har referenssvar
             }
-        ]
-        print(f"[RAGAS v0.2.x Debug] Python list of dicts förberett: {dataset_list_of_dicts}")
-
-        # Steg 1.5: Konvertera listan av dictionaries till ett Hugging Face Dataset-objekt
-        # Detta är ofta det föredragna och mest robusta formatet för RAGAS 'evaluate'-funktion.
-        hf_dataset = Dataset.from_list(dataset_list_of_dicts)
-        print(f"[RAGAS v0.2.x Debug] Hugging Face Dataset skapat: {hf_dataset}")
+            for question, answer, contexts in triples
+        ])
 
-
-        # Steg 2: Initiera LLM för RAGAS-metriker
+        # Steg 2: Hämta (eller skapa) LLM- och embedding-klienterna för RAGAS-metriker
         openai_api_key = os.getenv("OPENAI_API_KEY")
         if not openai_api_key:
-            print("[RAGAS v0.2.x Debug] Fel: OPENAI_API_KEY saknas.")
-            return {"error": "OPENAI_API_KEY hittades inte i miljövariablerna."}
-        
-        llm_for_ragas = ChatOpenAI(model="gpt-4o", openai_api_key=openai_api_key, temperature=0)
-        print("[RAGAS v0.2.x Debug] LLM för RAGAS initierad.")
-
-        # Steg 3: Definiera metriker och kör utvärderingen
-        metrics_to_evaluate = [faithfulness, answer_relevancy]
-        print(f"[RAGAS v0.2.x Debug] Kör utvärdering med metriker: {metrics_to_evaluate}")
-        
-        # Skicka nu Hugging Face Dataset-objektet till 'dataset'-argumentet
+            logger.error("OPENAI_API_KEY saknas; RAGAS-utvärderingen hoppas över.")
+            return [{"error": "OPENAI_API_KEY hittades inte i miljövariablerna."} for _ in triples]
+        llm_for_ragas, embeddings_for_ragas = _get_ragas_llm(openai_api_key)
+
+        # Steg 3: Kör utvärderingen för hela batchen
         result = evaluate(
-            dataset=hf_dataset, 
-            metrics=metrics_to_evaluate, 
-            llm=llm_for_ragas
+            dataset=hf_dataset,
+            metrics=[faithfulness, answer_relevancy],
+            llm=llm_for_ragas,
+            embeddings=embeddings_for_ragas
         )
-        
-        print(f"[RAGAS v0.2.x Debug] Utvärdering klar. Resultattyp: {type(result)}")
-
-        # Steg 4: Extrahera och returnera resultat
-        # När input är ett Hugging Face Dataset, är output (result) vanligtvis också ett 
-        # Hugging Face Dataset som innehåller de ursprungliga kolumnerna plus de nya score-kolumnerna.
-        if hasattr(result, 'to_pandas'): 
-             result_df = result.to_pandas()
-             print(f"[RAGAS v0.2.x Debug] Resultat (som DataFrame): \n{result_df}")
-             # För ett enskilt sample i en DataFrame
-             faithfulness_score = result_df["faithfulness"].iloc[0] if "faithfulness" in result_df.columns and not result_df.empty else None
-             answer_relevancy_score = result_df["answer_relevancy"].iloc[0] if "answer_relevancy" in result_df.columns and not result_df.empty else None
-        elif isinstance(result, dict): # Fallback om resultatet är en direkt dictionary
-            print(f"[RAGAS v0.2.x Debug] Resultat (som dict): {result}")
-            faithfulness_score = result.get("faithfulness")
-            answer_relevancy_score = result.get("answer_relevancy")
-        else: 
-            print(f"[RAGAS v0.2.x Debug] Oväntad resultattyp. Försöker komma åt 'scores'-attribut ifall det är RAGAS 1.0+ stil.")
-            # För RAGAS 1.0+ är result.scores en dict. Detta är en gissning om 0.2.15 skulle ha en liknande struktur.
-            faithfulness_score = result.scores.get("faithfulness") if hasattr(result, 'scores') and isinstance(result.scores, dict) else None
-            answer_relevancy_score = result.scores.get("answer_relevancy") if hasattr(result, 'scores') and isinstance(result.scores, dict) else None
-
-        if faithfulness_score is None or answer_relevancy_score is None:
-            missing = []
-            if faithfulness_score is None: missing.append("faithfulness")
-            if answer_relevancy_score is None: missing.append("answer_relevancy")
-            error_msg = f"Kunde inte hämta alla scores för: {', '.join(missing)}. Mottaget resultat: {result}"
-            print(f"[RAGAS v0.2.x Debug] Fel vid hämtning av scores: {error_msg}")
-            return {"error": error_msg}
-
-        print(f"[RAGAS v0.2.x Debug] Faithfulness: {faithfulness_score}, Answer Relevancy: {answer_relevancy_score}")
-        return {
-            "faithfulness": float(faithfulness_score),
-            "answer_relevancy": float(answer_relevancy_score)
-        }
+        logger.debug("RAGAS-utvärdering klar. Resultattyp: %s", type(result))
+
+        # Steg 4: Extrahera ett resultat per rad
+        result_df = result.to_pandas()
+        results = []
+        for i in range(len(triples)):
+            row = result_df.iloc[i] if i < len(result_df) else {}
+            faithfulness_score = _score(row.get("faithfulness"))
+            answer_relevancy_score = _score(row.get("answer_relevancy"))
+            if faithfulness_score is None or answer_relevancy_score is None:
+                missing = [name for name, score in (("faithfulness", faithfulness_score),
+                                                    ("answer_relevancy", answer_relevancy_score)) if score is None]
+                results.append({"error": f"Kunde inte hämta alla scores för: {', '.join(missing)}."})
+            else:
+                results.append({"faithfulness": faithfulness_score, "answer_relevancy": answer_relevancy_score})
+        return results
 
     except Exception as e:
-        import traceback
-        detailed_error = traceback.format_exc()
-        print(f"[RAGAS v0.2.x Debug] Detaljerad traceback för RAGAS-fel:\n{detailed_error}")
-        return {"error": f"Generellt fel under RAGAS-utvärdering (v0.2.15): {str(e)}"}
+        logger.exception("RAGAS-utvärderingen misslyckades")
+        return [{"error": f"Generellt fel under RAGAS-utvärdering (v0.2.15): {str(e)}"} for _ in triples]
+
+
+def ragas_evaluate(question: str, answer: str, contexts: list[str]):
+    """
+    Utvärderar ett givet svar med RAGAS-metriker (synkront; se utils.evaluation_queue
+    för utvärdering i bakgrunden).
+    """
+    return ragas_evaluate_batch([(question, answer, contexts)])[0]
@@ -1,9 +1,9 @@
 # utils/general.py
 import re
 
+# Förkompilerade en gång; se core.key_figures för extraktion av själva värdena
+_AMOUNT_PATTERN = re.compile(r"\b\d+[\.,]?\d*\s*(SEK|MSEK|kr|miljoner|tkr|USD|\$|€|%)", re.IGNORECASE)
+_METRIC_PATTERN = re.compile(r"(resultat|omsättning|utdelning|kassaflöde|kapital|intäkter|EBITDA|vinst).*?\d", re.IGNORECASE)
+
 def is_key_figure(row):
-    patterns = [
-        r"\b\d+[\.,]?\d*\s*(SEK|MSEK|kr|miljoner|tkr|USD|\$|€|%)",
-        r"(resultat|omsättning|utdelning|kassaflöde|kapital|intäkter|EBITDA|vinst).*?\d"
-    ]
-    return any(re.search(p, row, re.IGNORECASE) for p in patterns)
+    return bool(_AMOUNT_PATTERN.search(row) or _METRIC_PATTERN.search(row))
@@ -0,0 +1,194 @@
+# utils/metrics.py
+"""
+Lättviktig instrumentering: tidsspann per steg, räknare och tokenförbrukning,
+utan externa beroenden. Allt samlas i ett register per process och kan visas i
+Prometheus textformat (gpt_server /metrics) eller som tabeller i appens debugpanel.
+"""
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict, List, Optional, Tuple
+
+METRIC_PREFIX = "rapportanalys_"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Beskrivningar för Prometheus (# HELP); okända mätvärden får ingen beskrivning
+DESCRIPTIONS = {
+    "stage_duration_seconds": "Tid per steg (extraktion, chunking, embedding, retrieval, generering, RAGAS).",
+    "stage_errors_total": "Antal steg som avslutades med ett undantag.",
+    "pages_extracted_total": "Extraherade sidor per källa (textlager eller OCR).",
+    "openai_tokens_total": "Tokens enligt OpenAI:s usage, per steg, modell och typ (prompt/completion).",
+    "openai_http_responses_total": "HTTP-svar från OpenAI per statuskod (429/5xx leder till omförsök).",
+    "openai_retries_total": "Svar från OpenAI som leder till omförsök (429/5xx), per modell, prioritet och status.",
+    "openai_rate_limited_total": "429-svar från OpenAI; modellen pausas i alla processer enligt Retry-After.",
+    "context_tokens_total": "Kontexttokens per fråga: kind=raw om träffarna skarvats ihop rakt av, kind=assembled efter sammanslagning och budget.",
+    "context_chunks_total": "Träffar som slagits ihop med en granne, tagits bort som nästan-dubbletter eller inte rymts i tokenbudgeten.",
+    "openai_scheduler_wait_seconds": "Väntetid i schemaläggaren innan ett OpenAI-anrop fick skickas, per modell och prioritet.",
+    "cache_requests_total": "Uppslag i cacher per cache och utfall (hit/miss).",
+    "chunks_indexed_total": "Chunks vid indexering per källa (reused = föregående version, cached = embedding-cachen, embedded = API).",
+    "generation_ttft_seconds": "Tid till första token för strömmade svar.",
+    "http_request_duration_seconds": "Svarstid per endpoint i gpt_server.",
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _format_labels(labels: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class MetricsRegistry:
+    """
+    Trådsäkert register med räknare och histogram (samt de senaste spannen för felsökning).
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS, recent_spans: int = 200):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, List]] = {}
+        self.recent_spans = deque(maxlen=recent_spans)
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            # [antal per hink, summa, antal]
+            state = series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def counter_value(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_label_key(labels), 0.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Kopia av alla mätvärden: {"counters": {namn: [(labels, värde)]}, "histograms": {namn: [(labels, antal, summa)]}}.
+        """
+        with self._lock:
+            counters = {
+                name: [(dict(key), value) for key, value in series.items()]
+                for name, series in self._counters.items()
+            }
+            histograms = {
+                name: [(dict(key), state[2], state[1]) for key, state in series.items()]
+                for name, series in self._histograms.items()
+            }
+        return {"counters": counters, "histograms": histograms, "recent_spans": list(self.recent_spans)}
+
+    def render_prometheus(self) -> str:
+        """
+        Alla mätvärden i Prometheus textformat (version 0.0.4).
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full_name = METRIC_PREFIX + name
+                if name in DESCRIPTIONS:
+                    lines.append(f"# HELP {full_name} {DESCRIPTIONS[name]}")
+                lines.append(f"# TYPE {full_name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{full_name}{_format_labels(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                full_name = METRIC_PREFIX + name
+                if name in DESCRIPTIONS:
+                    lines.append(f"# HELP {full_name} {DESCRIPTIONS[name]}")
+                lines.append(f"# TYPE {full_name} histogram")
+                for key, (bucket_counts, total, count) in sorted(series.items()):
+                    for bound, bucket_count in zip(self.buckets, bucket_counts):
+                        lines.append(f"{full_name}_bucket{_format_labels(key, (('le', f'{bound:g}'),))} {bucket_count}")
+                    lines.append(f"{full_name}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}")
+                    lines.append(f"{full_name}_sum{_format_labels(key)} {total:.6f}")
+                    lines.append(f"{full_name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.recent_spans.clear()
+
+
+# Processens register; varje worker-process (t.ex. uvicorn --workers) har sitt eget
+metrics = MetricsRegistry()
+
+
+def inc(name: str, value: float = 1.0, **labels):
+    metrics.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    metrics.observe(name, value, **labels)
+
+
+@contextmanager
+def span(stage: str, **labels):
+    """
+    Mäter tiden för ett steg: stage_duration_seconds{stage=...}. Undantag räknas i
+    stage_errors_total och kastas vidare.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            metrics.inc("stage_errors_total", stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("stage_duration_seconds", seconds, stage=stage, **labels)
+        metrics.recent_spans.append({"stage": stage, "seconds": seconds, "at": time.time(), **labels})
+
+
+def timed(stage: str, **labels):
+    """
+    Dekorator som kör funktionen i ett span(stage).
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_usage(stage: str, model: str, usage: Optional[Any]):
+    """
+    Bokför tokens från ett OpenAI-svar (response.usage); None ignoreras.
+    """
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    if prompt_tokens:
+        metrics.inc("openai_tokens_total", prompt_tokens, stage=stage, model=model, kind="prompt")
+    if completion_tokens:
+        metrics.inc("openai_tokens_total", completion_tokens, stage=stage, model=model, kind="completion")
+
+
+def record_cache(cache: str, hits: int = 0, misses: int = 0):
+    if hits:
+        metrics.inc("cache_requests_total", hits, cache=cache, result="hit")
+    if misses:
+        metrics.inc("cache_requests_total", misses, cache=cache, result="miss")
@@ -1,20 +1,114 @@
-import easyocr
 import os
-import tempfile
-from typing import Tuple
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Tuple, Union
 
-reader = easyocr.Reader(['sv', 'en'])
+import numpy as np
 
-def extract_text_from_image_or_pdf(file) -> Tuple[str, str]:
+from utils.metrics import span
+
+OCR_LANGUAGES = ("sv", "en")
+# Varje arbetsprocess laddar sin egen modell (flera hundra MB), så poolen hålls liten
+OCR_MAX_WORKERS = int(os.getenv("OCR_MAX_WORKERS", str(min(2, os.cpu_count() or 1))))
+OCR_GPU = os.getenv("OCR_GPU", "0") == "1"
+OCR_DPI = 200
+
+_reader = None
+_reader_lock = threading.Lock()
+_pool = None
+_pool_workers = 0  # antal arbetsprocesser i _pool
+_pool_lock = threading.Lock()
+
+
+def get_ocr_reader():
+    """
+    Returnerar processens easyocr.Reader. easyocr (och torch) importeras och modellerna
+    laddas först vid första anropet, en gång per process.
+    """
+    global _reader
+    if _reader is None:
+        with _reader_lock:
+            if _reader is None:
+                import easyocr
+                _reader = easyocr.Reader(list(OCR_LANGUAGES), gpu=OCR_GPU)
+    return _reader
+
+
+def ocr_image(image: Union[bytes, np.ndarray]) -> str:
+    """
+    OCR av en bild i minnet: kodade bildbytes (PNG/JPG) eller en NumPy-array (H x B x kanaler).
+    """
+    return "\n".join(get_ocr_reader().readtext(image, detail=0))
+
+
+def render_pdf_pages(pdf_bytes: bytes, page_numbers: Iterable[int], dpi: int = OCR_DPI) -> Iterator[Tuple[int, bytes]]:
+    """
+    Rasteriserar valda PDF-sidor med PyMuPDF och ger (sidnummer, PNG-bytes).
+    """
+    import fitz
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_number in page_numbers:
+            pixmap = doc[page_number].get_pixmap(dpi=dpi)
+            yield page_number, pixmap.tobytes("png")
+
+
+def _get_pool(max_workers: int) -> ProcessPoolExecutor:
+    # Poolen (och därmed varje arbetsprocess laddade modell) återanvänds mellan anrop
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != max_workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=max_workers)
+            _pool_workers = max_workers
+        return _pool
+
+
+def ocr_pdf_pages(
+    pdf_bytes: bytes,
+    page_numbers: Iterable[int],
+    dpi: int = OCR_DPI,
+    max_workers: int = None
+) -> Iterator[Tuple[int, str]]:
     """
-    Tar en PNG, JPG eller PDF, och returnerar OCR-utläst text.
+    OCR av valda PDF-sidor (t.ex. inskannade sidor utan textlager). Ger (sidnummer, text) i ordning.
+
+    Sidorna rasteriseras i den här processen och skickas som PNG-bytes till en begränsad
+    processpool; högst två sidor per process är i luften åt gången. Med en arbetsprocess
+    körs OCR direkt i den här processen.
     """
-    suffix = os.path.splitext(file.name)[1].lower()
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
-        temp_file.write(file.read())
-        temp_path = temp_file.name
+    max_workers = max_workers or OCR_MAX_WORKERS
+    pages = render_pdf_pages(pdf_bytes, page_numbers, dpi)
+    if max_workers <= 1:
+        for page_number, png in pages:
+            yield page_number, ocr_image(png)
+        return
+
+    executor = _get_pool(max_workers)
+    pending = deque()
+    for page_number, png in pages:
+        pending.append((page_number, executor.submit(ocr_image, png)))
+        if len(pending) >= 2 * max_workers:
+            done_page, future = pending.popleft()
+            yield done_page, future.result()
+    while pending:
+        done_page, future = pending.popleft()
+        yield done_page, future.result()
 
-    result = reader.readtext(temp_path, detail=0)
-    text = "\n".join(result)
 
-    return text, temp_path
+def extract_text_from_image_or_pdf(file) -> Tuple[str, str]:
+    """
+    Tar en PNG, JPG eller PDF (t.ex. Streamlits UploadedFile), och returnerar (OCR-utläst text, filnamn).
+    Filen läses i minnet; inga temporära filer skapas.
+    """
+    data = file.getvalue() if hasattr(file, "getvalue") else file.read()
+    if file.name.lower().endswith(".pdf"):
+        import fitz
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            page_count = doc.page_count
+        with span("ocr", kind="pdf"):
+            texts: List[str] = [text for _, text in ocr_pdf_pages(data, range(page_count))]
+        return "\n".join(texts), file.name
+    with span("ocr", kind="image"):
+        return ocr_image(data), file.name
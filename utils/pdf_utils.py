@@ -1,6 +1,4 @@
 
-from fpdf import FPDF
-
 def answer_to_pdf(answer: str) -> bytes:
     """
     Konverterar ett GPT-svar till en PDF och returnerar det som bytes.
@@ -11,6 +9,8 @@ def answer_to_pdf(answer: str) -> bytes:
     Returns:
         bytes: PDF-data redo att laddas ner.
     """
+    from fpdf import FPDF  # Importeras först när en PDF skapas
+
     pdf = FPDF()
     pdf.add_page()
     pdf.set_font("Arial", size=12)
@@ -0,0 +1,49 @@
+# utils/token_utils.py
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Grov uppskattning som används om tiktoken-kodningen inte kan laddas (t.ex. offline)
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model: str = "text-embedding-3-small"):
+    """
+    Returnerar tiktoken-kodningen för en modell (cachas, eftersom den är dyr att ladda).
+    Okända modeller faller tillbaka på cl100k_base. Returnerar None om kodningen
+    inte går att ladda, så att räkningen kan falla tillbaka på en uppskattning.
+    """
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Kunde inte ladda tiktoken-kodning, uppskattar tokens från tecken: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str = "text-embedding-3-small") -> int:
+    """
+    Räknar antalet tokens i en text för en given modell.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "text-embedding-3-small") -> str:
+    """
+    Kortar texten till högst 'max_tokens' tokens (från början av texten).
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])